@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Benchmark of registration email text extraction.
+
+Generates a synthetic mbox of realistic student registration emails
+(plain text and HTML bodies, utf-8/cp1251/koi8-r charsets, base64 and
+quoted-printable encodings, signatures, quoted replies, attachments),
+then measures how many messages per second are processed by the tiered
+extractor used by mailbox.process_students and by BeautifulSoup alone.
+
+    python benchmarks/bench_mail_extract.py -n 5000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from email import policy
+from email.parser import BytesParser
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+# this is mailbox.py of the grader, not the standard library module
+import mailbox
+
+
+GROUPS = ['4931', '4932', 'Z4933К', '4936В', 'М4937']
+SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнова', 'Кузнецова', 'Попов', 'Васильев']
+NAMES = ['Иван Иванович', 'Пётр\xa0Петрович', 'Анна Сергеевна', 'Мария', 'Олег']
+SIGNATURES = [
+    "\n-- \nОтправлено из мобильной Почты Mail.ru\n",
+    "\n--\nС уважением,\nстудент группы 4931\n",
+    "\n\nSent from my iPhone\n",
+    "",
+]
+QUOTED_REPLY = (
+    "\n\nПн, 2 мар. 2026 г. в 10:00, <k43guap@ya.ru>:\n"
+    "> Unable to process request from student\n"
+    "> Student with GitHub account not found in any of the groups!\n"
+)
+
+
+def _student_lines(rnd, i):
+    return [
+        rnd.choice(GROUPS),
+        "{} {}".format(rnd.choice(SURNAMES), rnd.choice(NAMES)),
+        "student-{}".format(i),
+    ]
+
+
+def generate_message(rnd, i):
+    """
+    Generate a synthetic registration email
+
+    :returns: raw message bytes
+    """
+    lines = _student_lines(rnd, i)
+    charset = rnd.choice(['utf-8', 'cp1251', 'koi8-r'])
+    kind = rnd.choice(['plain', 'plain', 'html', 'alternative', 'attachment'])
+    plain_body = "\n".join(lines)
+    if rnd.random() < 0.3:
+        plain_body = "  ".join(lines)
+    plain_body += rnd.choice(SIGNATURES)
+    if rnd.random() < 0.3:
+        plain_body += QUOTED_REPLY
+    html_body = (
+        "<html><head><style>div {{ color: black; }}</style></head><body>"
+        "<div>{}</div><div><b>{}</b></div><p>{}</p>"
+        "<div class=\"signature\">{}</div></body></html>".format(
+            *lines, rnd.choice(SIGNATURES).replace("\n", "<br>"))
+    )
+    if kind == 'plain':
+        msg = MIMEText(plain_body, 'plain', charset)
+    elif kind == 'html':
+        msg = MIMEText(html_body, 'html', charset)
+    else:
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(plain_body, 'plain', charset))
+        msg.attach(MIMEText(html_body, 'html', charset))
+        if kind == 'attachment':
+            mixed = MIMEMultipart('mixed')
+            mixed.attach(msg)
+            mixed.attach(MIMEApplication(os.urandom(rnd.randint(1000, 50000)), Name='photo.jpg'))
+            msg = mixed
+    msg['From'] = "Student {} <student{}@example.com>".format(i, i)
+    msg['Subject'] = "Регистрация"
+    msg['Date'] = "Mon, 02 Mar 2026 10:{:02d}:00 +0300".format(i % 60)
+    return msg.as_bytes()
+
+
+def write_mbox(path, count, seed=0):
+    """
+    Write a synthetic mbox file with 'count' messages
+    """
+    rnd = random.Random(seed)
+    with open(path, 'wb') as f:
+        for i in range(count):
+            f.write(b"From student@example.com Mon Mar  2 10:00:00 2026\n")
+            raw = generate_message(rnd, i).replace(b"\r\n", b"\n")
+            # mboxrd escaping of 'From ' lines
+            raw = raw.replace(b"\nFrom ", b"\n>From ")
+            f.write(raw)
+            f.write(b"\n")
+
+
+def read_mbox(path):
+    """
+    Read raw messages from an mbox file
+    """
+    messages = []
+    current = None
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b"From "):
+                if current is not None:
+                    messages.append(b"".join(current))
+                current = []
+            elif current is not None:
+                current.append(line[1:] if line.startswith(b">From ") else line)
+    if current is not None:
+        messages.append(b"".join(current))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark registration email text extraction")
+    parser.add_argument('-n', '--messages', type=int, default=2000, help="number of messages in the corpus")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the corpus")
+    parser.add_argument('--mbox', help="use an existing mbox file instead of a synthetic one")
+    params = parser.parse_args()
+
+    if params.mbox:
+        path = params.mbox
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'registrations.mbox')
+        write_mbox(path, params.messages, params.seed)
+    raw_messages = read_mbox(path)
+    print("Corpus: {} messages, {:.1f} MB".format(len(raw_messages), os.path.getsize(path) / 2**20))
+
+    start = time.perf_counter()
+    bodies = []
+    for raw in raw_messages:
+        msg = BytesParser(policy=policy.default).parsebytes(raw)
+        body = msg.get_body(preferencelist=('plain', 'html'))
+        bodies.append((body.get_content(), body.get_content_subtype()))
+    parse_seconds = time.perf_counter() - start
+    print("{:<28} {:10.0f} messages/s".format("MIME parsing", len(bodies) / parse_seconds))
+
+    extractors = [
+        ("tiered extractor", lambda text, subtype: mailbox._extract_text_chunks(text, subtype, limit=3)),
+    ]
+    try:
+        import bs4  # noqa: F401
+        extractors.append(("BeautifulSoup", lambda text, subtype: mailbox._extract_soup_chunks(text, limit=3)))
+    except ImportError:
+        print("BeautifulSoup is not installed, skipping it")
+    results = {}
+    for name, extract in extractors:
+        start = time.perf_counter()
+        results[name] = [extract(text, subtype) for text, subtype in bodies]
+        seconds = time.perf_counter() - start
+        print("{:<28} {:10.0f} messages/s".format(name, len(bodies) / seconds))
+    if len(results) > 1:
+        reference = results["BeautifulSoup"]
+        mismatches = sum(1 for a, b in zip(results["tiered extractor"], reference) if a != b)
+        print("Messages parsed differently from BeautifulSoup: {}".format(mismatches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,727 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the update pipeline on a synthetic course.
+
+Generates a course of N groups of M students with K repositories per lab
+(CI outcomes, build log sizes, numbers of commits and issues are
+configurable), serves it by local stand-ins for GitHub, Travis, AppVeyor,
+Google Sheets and IMAP with injected latency and grades it. Every course
+size is graded by a separate process, which runs the stages of an update
+run one after another and reports wall time, requests made to every
+service and peak RSS after every stage:
+
+* sheets load - google_sheets.get_sheet_names and get_multiple_sheets_data
+* org repos - common.get_github_repos
+* update_students - registration emails of the run
+* check_lab N - grading of every lab
+* batch_update - all pending updates in a single request
+
+    python benchmarks/bench_pipeline.py --repos 100 1000 10000
+    python benchmarks/bench_pipeline.py --repos 1000 --labs 1 --latency 0.1
+
+The grader runs with synthetic settings, requests to API hosts are
+redirected to the local stand-ins, anything else fails, so no real
+service is ever contacted. Emails are not sent (dry-run mail queue).
+"""
+import io
+import os
+import re
+import sys
+import json
+import math
+import time
+import types
+import random
+import hashlib
+import argparse
+import datetime
+import tempfile
+import threading
+import contextlib
+import subprocess
+import collections
+import http.server
+import urllib.parse
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from imap_standin import ImapStandin
+
+
+ORGANIZATION = "synthetic-course"
+APPVEYOR_ACCOUNT = "synthetic"
+TEACHER_LOGIN = "course-teacher"
+# deadline of every lab, dd.mm of the current year
+DEADLINE = "15.03"
+
+# labs of the synthetic course: 1 - Travis CI, 3 - AppVeyor, 5 - Travis CI
+# and commit/issue requirements
+LABS = {
+    '1': {'taskid_max': 20, 'taskid_shift': 0, 'github_prefix': 'os-task1', 'penalty_max': 6},
+    '3': {'taskid_max': 20, 'taskid_shift': 0, 'github_prefix': 'os-task3', 'penalty_max': 8},
+    '5': {
+        'taskid_max': 20, 'taskid_shift': 2, 'github_prefix': 'os-task5', 'penalty_max': 8,
+        'repo_requirements': {
+            'commit': {'min_quantity': 2, 'grade_percent': 15, 'msg_part': 'Lab5:'},
+            'issue': {'min_quantity': 1, 'grade_percent': 15, 'prefix': 'Lab5:', 'linked_commit_msg_part': 'Lab5:'},
+        },
+    },
+}
+
+# API hosts served by the stand-ins, see route_requests
+SERVICES = {
+    'api.github.com': 'github',
+    'api.travis-ci.com': 'travis',
+    'ci.appveyor.com': 'appveyor',
+}
+REPORTED_SERVICES = ('github', 'travis', 'appveyor', 'sheets', 'imap')
+
+GITHUB_PAGE_SIZE = 30
+APPVEYOR_PAGE_SIZE = 100
+LOG_FILLER = "make[1]: Entering directory '/home/travis/build/synthetic-course/os-task'\n"
+
+
+class SyntheticCourse:
+    """
+    Deterministic synthetic course: the same options give the same course
+    in the stand-in process and in the grading process
+    """
+
+    def __init__(self, repos, groups=None, students=30, labs=('1', '3', '5'), seed=0, success=0.8,
+                 wrong_taskid=0.05, reduction=0.2, graded=0.2, registrations=0.05, unknown=0.02, log_kb=20,
+                 commits=10, issues=3):
+        """
+        :param repos: repositories per lab
+        :param groups: number of groups, enough for all repositories if None
+        :param students: students per group
+        :param labs: labs of the course, keys of LABS
+        :param seed: random seed
+        :param success: share of repositories with a successful CI build
+        :param wrong_taskid: share of builds reporting a wrong TASKID
+        :param reduction: share of builds reporting a grade reduction
+        :param graded: share of labs already graded in the spreadsheet
+        :param registrations: share of students registering by email in
+        this run, a fifth of that sends emails with unknown GitHub accounts
+        :param unknown: share of repositories of unregistered accounts
+        :param log_kb: build log size, KiB
+        :param commits: commits per repository
+        :param issues: issues per repository
+        """
+        self.repos = repos
+        self.students = students
+        self.groups = groups or max(1, math.ceil(repos * 1.1 / students))
+        self.labs = [str(lab_id) for lab_id in labs]
+        self.seed = seed
+        self.success = success
+        self.wrong_taskid = wrong_taskid
+        self.reduction = reduction
+        self.graded = graded
+        self.registrations = registrations
+        self.unknown = unknown
+        self.log_kb = log_kb
+        self.commits = commits
+        self.issues = issues
+        self.student_count = self.groups * self.students
+        self.unknown_count = int(repos * unknown)
+        self.student_repo_count = min(repos - self.unknown_count, self.student_count)
+        self.year = datetime.datetime.now().year
+
+    def options(self):
+        return {
+            key: getattr(self, key) for key in (
+                'repos', 'groups', 'students', 'labs', 'seed', 'success', 'wrong_taskid', 'reduction', 'graded',
+                'registrations', 'unknown', 'log_kb', 'commits', 'issues')
+        }
+
+    def _random(self, *key):
+        # str seeds are hashed with SHA-512, so they are stable between processes
+        return random.Random(":".join(str(x) for x in (self.seed,) + key))
+
+    # students and spreadsheet
+
+    def group_name(self, group):
+        return str(4001 + group)
+
+    def student_group(self, i):
+        return self.group_name(i // self.students)
+
+    def student_name(self, i):
+        return "Student{:05d} Synthetic".format(i)
+
+    def student_github(self, i):
+        return "student-{}".format(i)
+
+    def student_task_id(self, i):
+        return i % 30 + 1
+
+    def registers_now(self, i):
+        return self._random('register', i).random() < self.registrations
+
+    def lab_status(self, i, lab_id):
+        return 'v' if self._random('graded', lab_id, i).random() < self.graded else ''
+
+    def sends_invalid_account(self, i):
+        return self._random('invalid', i).random() < self.registrations / 5
+
+    def sheets(self):
+        """
+        Spreadsheet data by columns
+
+        :returns: dict with sheet title as key and list of columns as value
+        """
+        max_lab = max(int(lab_id) for lab_id in LABS)
+        github_column = 2 + max_lab
+        sheets = {}
+        for group in range(self.groups):
+            members = range(group * self.students, (group + 1) * self.students)
+            columns = [[""] for _ in range(github_column + 1)]
+            columns[0] = ["Вариант"] + [str(self.student_task_id(i)) for i in members]
+            columns[1] = ["ФИО"] + [self.student_name(i) for i in members]
+            for lab_id in self.labs:
+                columns[1 + int(lab_id)] = [DEADLINE] + [self.lab_status(i, lab_id) for i in members]
+            columns[github_column] = ["GitHub"] + [
+                "" if self.registers_now(i) else self.student_github(i) for i in members]
+            sheets[self.group_name(group)] = columns
+        sheets['План'] = [[""], [""]]
+        return sheets
+
+    def emails(self):
+        """
+        Registration emails of the run
+
+        :returns: list of raw messages
+        """
+        registrations = [(i, self.student_github(i)) for i in range(self.student_count) if self.registers_now(i)]
+        registrations += [
+            (i, "ghost-{}".format(i)) for i in range(self.student_count) if self.sends_invalid_account(i)]
+        messages = []
+        for n, (i, github) in enumerate(registrations):
+            msg = MIMEText("{}\n{}\n{}\n".format(self.student_group(i), self.student_name(i), github), 'plain', 'utf-8')
+            msg['From'] = "Student {} <student{}@example.com>".format(i, i)
+            msg['Subject'] = "Регистрация"
+            msg['Date'] = "Mon, 02 Mar {} 10:{:02d}:00 +0300".format(self.year, n % 60)
+            messages.append(msg.as_bytes())
+        return messages
+
+    # repositories
+
+    def lab_accounts(self, lab_id):
+        """
+        :returns: GitHub accounts having a repository of a lab
+        """
+        accounts = [self.student_github(i) for i in range(self.student_repo_count)]
+        return accounts + ["stranger-{}".format(j) for j in range(self.unknown_count)]
+
+    def repo_name(self, lab_id, account):
+        return "{}-{}".format(LABS[lab_id]['github_prefix'], account)
+
+    def parse_repo(self, name):
+        """
+        :returns: tuple (lab id, account) or None if there is no such repo
+        """
+        for lab_id in self.labs:
+            prefix = LABS[lab_id]['github_prefix'] + '-'
+            if name.startswith(prefix):
+                return lab_id, name[len(prefix):]
+        return None
+
+    def user_exists(self, login):
+        return login.startswith('student-') or login.startswith('stranger-')
+
+    def build(self, lab_id, account):
+        """
+        CI outcome of a repository
+
+        :returns: dict with keys 'success', 'completed_at', 'task_id',
+        'reduction', 'commits' and 'issues'
+        """
+        rnd = self._random('repo', lab_id, account)
+        lab = LABS[lab_id]
+        task_id = rnd.randint(1, lab['taskid_max'])
+        if account.startswith('student-'):
+            i = int(account[len('student-'):])
+            task_id = (self.student_task_id(i) + lab['taskid_shift']) % lab['taskid_max'] or lab['taskid_max']
+        if rnd.random() < self.wrong_taskid:
+            task_id = task_id % lab['taskid_max'] + 1
+        deadline = datetime.datetime(self.year, 3, 15, 12, tzinfo=datetime.timezone.utc)
+        completed_at = deadline + datetime.timedelta(hours=rnd.randint(-30 * 24, 40 * 24))
+        return {
+            'success': rnd.random() < self.success,
+            'completed_at': completed_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'task_id': task_id,
+            'reduction': rnd.choice([10, 20, 30]) if rnd.random() < self.reduction else None,
+            'commits': max(0, int(rnd.gauss(self.commits, self.commits / 3))),
+            'issues': max(0, int(rnd.gauss(self.issues, self.issues / 3))),
+        }
+
+    def build_log(self, lab_id, account):
+        build = self.build(lab_id, account)
+        log = LOG_FILLER * max(1, self.log_kb * 1024 // len(LOG_FILLER))
+        log += "TASKID is {}\n".format(build['task_id'])
+        if build['reduction'] is not None:
+            log += "\nGrading reduced by {}%\n".format(build['reduction'])
+        return log + "Done. Your build exited with 0.\n"
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GitHub, Travis and AppVeyor APIs of a synthetic course, the service is
+    the first path component (see route_requests)
+    """
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, do not wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._respond('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, method):
+        course = self.server.course
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        parts = urllib.parse.urlsplit(self.path)
+        service, _, path = parts.path[1:].partition('/')
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        handler = getattr(self, '_' + service, None)
+        result = handler(course, method, '/' + path, query) if handler else None
+        if result is None:
+            status, body, content_type = 404, {'message': 'Not Found'}, 'application/json'
+        else:
+            status, body, content_type = result
+        if not isinstance(body, bytes):
+            body = (json.dumps(body) if content_type == 'application/json' else body).encode('utf-8')
+        headers = {'Content-Type': content_type}
+        if service == 'github':
+            headers['ETag'] = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            headers['X-RateLimit-Remaining'] = '4999'
+            headers['X-RateLimit-Reset'] = str(int(time.time()) + 3600)
+            if status == 200 and self.headers.get('If-None-Match') == headers['ETag']:
+                status, body = 304, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _repo(self, course, owner, name):
+        if owner != ORGANIZATION:
+            return None
+        return course.parse_repo(name)
+
+    def _github(self, course, method, path, query):
+        match = re.fullmatch(r'/orgs/([^/]+)/repos', path)
+        if match:
+            repos = [
+                course.repo_name(lab_id, account) for lab_id in course.labs for account in course.lab_accounts(lab_id)]
+            page = int(query.get('page', 1))
+            return 200, [
+                {
+                    'name': name,
+                    'full_name': "{}/{}".format(ORGANIZATION, name),
+                    'private': False,
+                    'html_url': "https://github.com/{}/{}".format(ORGANIZATION, name),
+                    'url': "https://api.github.com/repos/{}/{}".format(ORGANIZATION, name),
+                    'default_branch': 'master',
+                    'pushed_at': "{}-03-01T10:00:00Z".format(course.year),
+                }
+                for name in repos[(page - 1) * GITHUB_PAGE_SIZE:page * GITHUB_PAGE_SIZE]
+            ], 'application/json'
+        if path == '/search/users':
+            login = query.get('q', '').replace('user:', '')
+            exists = course.user_exists(login)
+            return 200, {'total_count': 1 if exists else 0, 'items': [{'login': login}] if exists else []}, \
+                'application/json'
+        match = re.fullmatch(r'/repos/([^/]+)/([^/]+)(/.*)', path)
+        if not match:
+            return None
+        repo = self._repo(course, match.group(1), match.group(2))
+        if repo is None:
+            return None
+        lab_id, account = repo
+        full_name = "{}/{}".format(match.group(1), match.group(2))
+        build = course.build(lab_id, account)
+        rest = match.group(3)
+        if rest == '/commits/master/check-runs':
+            return 200, {'total_count': 1, 'check_runs': [{
+                'name': "Travis CI - Branch",
+                'conclusion': 'success' if build['success'] else 'failure',
+                'external_id': "{}-{}".format(lab_id, account),
+                'completed_at': build['completed_at'],
+                'head_sha': hashlib.sha1(full_name.encode('utf-8')).hexdigest(),
+            }]}, 'application/json'
+        if rest == '/commits/master/status':
+            state = 'success' if build['success'] else 'failure'
+            return 200, {'state': state, 'statuses': [{
+                'state': state,
+                'description': "AppVeyor build succeeded" if build['success'] else "AppVeyor build failed",
+                'updated_at': build['completed_at'],
+                'target_url': "https://ci.appveyor.com/project/{}/{}".format(APPVEYOR_ACCOUNT, match.group(2)),
+            }]}, 'application/json'
+        if rest == '/commits':
+            return 200, [self._commit(full_name, account, k) for k in range(build['commits'])], 'application/json'
+        match = re.fullmatch(r'/commits/commit-(\d+)', rest)
+        if match:
+            return 200, self._commit(full_name, account, int(match.group(1))), 'application/json'
+        if rest == '/issues':
+            return 200, [
+                {'number': n, 'title': "Lab5: issue {}".format(n), 'state': 'closed'}
+                for n in range(1, build['issues'] + 1)
+            ], 'application/json'
+        match = re.fullmatch(r'/issues/(\d+)/events', rest)
+        if match:
+            number = int(match.group(1))
+            return 200, [
+                {'event': 'labeled', 'actor': {'login': TEACHER_LOGIN}, 'commit_id': None, 'commit_url': None},
+                {
+                    'event': 'referenced',
+                    'actor': {'login': account},
+                    'commit_id': "commit-{}".format(number),
+                    'commit_url': "https://api.github.com/repos/{}/commits/commit-{}".format(full_name, number),
+                },
+            ], 'application/json'
+        return None
+
+    @staticmethod
+    def _commit(full_name, account, k):
+        return {
+            'sha': "commit-{}".format(k),
+            'author': {'login': TEACHER_LOGIN if k == 0 else account},
+            'commit': {'message': "Initial commit" if k == 0 else "Lab5: step {} of {}".format(k, full_name)},
+        }
+
+    def _travis(self, course, method, path, query):
+        match = re.fullmatch(r'/(build|job)/(\w+)-(.+?)(/log)?', path)
+        if not match or match.group(2) not in course.labs:
+            return None
+        lab_id, account = match.group(2), match.group(3)
+        if match.group(1) == 'build':
+            return 200, {'id': "{}-{}".format(lab_id, account), 'jobs': [{'id': "{}-{}".format(lab_id, account)}]}, \
+                'application/json'
+        return 200, {'content': course.build_log(lab_id, account)}, 'application/json'
+
+    def _appveyor(self, course, method, path, query):
+        if '3' not in course.labs:
+            return None
+        if path == '/api/account/{}/projects/paged'.format(APPVEYOR_ACCOUNT):
+            accounts = course.lab_accounts('3')
+            index = int(query.get('pageIndex', 0))
+            page = accounts[index * APPVEYOR_PAGE_SIZE:(index + 1) * APPVEYOR_PAGE_SIZE]
+            return 200, {
+                'list': [
+                    {
+                        'repositoryName': "{}/{}".format(ORGANIZATION, course.repo_name('3', account)),
+                        'slug': course.repo_name('3', account),
+                    }
+                    for account in page
+                ],
+                'hasNextPage': (index + 1) * APPVEYOR_PAGE_SIZE < len(accounts),
+            }, 'application/json'
+        match = re.fullmatch(r'/api/projects/{}/(.+)'.format(APPVEYOR_ACCOUNT), path)
+        if match:
+            repo = course.parse_repo(match.group(1))
+            if repo is None:
+                return None
+            build = course.build(*repo)
+            return 200, {'build': {
+                'buildId': match.group(1),
+                'status': 'success' if build['success'] else 'failed',
+                'jobs': [{'jobId': match.group(1)}],
+            }}, 'application/json'
+        match = re.fullmatch(r'/api/buildjobs/(.+)/log', path)
+        if match:
+            repo = course.parse_repo(match.group(1))
+            if repo is None:
+                return None
+            return 200, course.build_log(*repo), 'text/plain'
+        return None
+
+
+def start_standins(course, latency, imap_latency):
+    """
+    Start HTTP and IMAP stand-ins of a course in background threads
+
+    :returns: tuple (HTTP server, IMAP server)
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandinHandler)
+    server.daemon_threads = True
+    server.course = course
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    imap_server = ImapStandin(('127.0.0.1', 0), latency=imap_latency)
+    for raw in course.emails():
+        imap_server.add_message(raw)
+    imap_server.start()
+    return server, imap_server
+
+
+# grading process
+
+
+class _SheetsRequest:
+    def __init__(self, standin, respond):
+        self._standin = standin
+        self._respond = respond
+
+    def execute(self):
+        if self._standin.latency:
+            time.sleep(self._standin.latency)
+        with self._standin.lock:
+            self._standin.requests += 1
+        # responses are serialized as they would be by the API client
+        return json.loads(json.dumps(self._respond()))
+
+
+class SheetsStandin:
+    """
+    service.spreadsheets() stand-in serving spreadsheet data of a course
+    """
+
+    def __init__(self, sheets, latency=0):
+        self.sheets = sheets
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def get(self, spreadsheetId):
+        return _SheetsRequest(self, lambda: {'sheets': [{'properties': {'title': title}} for title in self.sheets]})
+
+    def values(self):
+        return self
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS'):
+        return _SheetsRequest(self, lambda: {'valueRanges': [
+            {'range': name, 'majorDimension': majorDimension, 'values': self.sheets[name.strip("'")]}
+            for name in ranges
+        ]})
+
+    def batchUpdate(self, spreadsheetId, body):
+        return _SheetsRequest(self, lambda: {'totalUpdatedCells': len(body['data'])})
+
+
+def make_settings(course, imap_port):
+    """
+    Install a synthetic settings module, before any module of the grader
+    is imported
+    """
+    module = types.ModuleType('settings')
+    module.__dict__.update({
+        'github_token': "synthetic-github-token",
+        'github_organization': ORGANIZATION,
+        'appveyor_token': "synthetic-appveyor-token",
+        'appveyor_account': APPVEYOR_ACCOUNT,
+        'travis_token': "synthetic-travis-token",
+        'requests_timeout': 30,
+        'mail_imap_server': '127.0.0.1',
+        'mail_imap_port': imap_port,
+        'mail_imap_ssl': False,
+        'mail_login': "grader",
+        'mail_password': "synthetic-password",
+        'mail_return_address': "grader@example.com",
+        'google_spreadsheet_id': "synthetic-spreadsheet",
+        'teacher_github_logins': [TEACHER_LOGIN],
+        'os_labs': {lab_id: LABS[lab_id] for lab_id in course.labs},
+    })
+    sys.modules['settings'] = module
+
+
+_request_counts = collections.Counter()
+_request_counts_lock = threading.Lock()
+
+
+def route_requests(base_url):
+    """
+    Redirect requests to API hosts to the stand-in server at base_url,
+    requests to any other host fail
+    """
+    import requests
+    import requests.adapters
+    original_send = requests.adapters.HTTPAdapter.send
+
+    def send(adapter, request, **kwargs):
+        parts = urllib.parse.urlsplit(request.url)
+        service = SERVICES.get(parts.hostname)
+        if service is None:
+            raise requests.exceptions.ConnectionError(
+                "Host '{}' is not served by the benchmark".format(parts.hostname), request=request)
+        request.url = "{}/{}{}{}".format(base_url, service, parts.path, '?' + parts.query if parts.query else '')
+        with _request_counts_lock:
+            _request_counts[service] += 1
+        return original_send(adapter, request, **kwargs)
+
+    requests.adapters.HTTPAdapter.send = send
+
+
+def _peak_rss_mib():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def grade(options, http_port, imap_port, sheets_latency, verbose=False):
+    """
+    Run the stages of an update run on a synthetic course served by
+    stand-ins of another process
+
+    :returns: list of dicts with keys 'stage', 'seconds', 'requests',
+    'peak_rss_mib' and 'updates'
+    """
+    course = SyntheticCourse(**options)
+    make_settings(course, imap_port)
+    route_requests("http://127.0.0.1:{}".format(http_port))
+    import main as grader
+    import common
+    import mailbox
+    import metrics
+    import google_sheets
+
+    gs = SheetsStandin(course.sheets(), latency=sheets_latency)
+
+    def request_counts():
+        with _request_counts_lock:
+            counts = collections.Counter(_request_counts)
+        counts['sheets'] = gs.requests
+        counts['imap'] = sum(
+            value for (name, _), value in metrics.registry.snapshot()['counters'].items()
+            if name == 'imap_command_total')
+        return counts
+
+    results = []
+
+    def stage(name, function):
+        before = request_counts()
+        start = time.perf_counter()
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            value = function()
+        seconds = time.perf_counter() - start
+        requests = request_counts() - before
+        results.append({
+            'stage': name,
+            'seconds': seconds,
+            'requests': {service: requests[service] for service in REPORTED_SERVICES},
+            'peak_rss_mib': _peak_rss_mib(),
+            'updates': len(value) if name.startswith(('update_students', 'check_lab')) else None,
+        })
+        return value
+
+    def load_data():
+        sheets = ["'{}'".format(s) for s in google_sheets.get_sheet_names(gs)]
+        return sheets, google_sheets.get_multiple_sheets_data(gs, sheets)
+
+    sheets, data = stage("sheets load", load_data)
+    org_repos = stage("org repos", lambda: common.get_github_repos(ORGANIZATION))
+
+    def register_students():
+        imap = mailbox.get_imap_connection()
+        try:
+            return grader.update_students(imap, data, data_update=[], dry_run=True)
+        finally:
+            imap.logout()
+
+    data_update = stage("update_students", register_students)
+    for lab_id in course.labs:
+        data_update += stage("check_lab {}".format(lab_id), lambda: grader.check_lab(
+            lab_id, sheets[:-1], data, data_update=[], org_repos=org_repos))
+    data_update.append({'range': "'План'!B1", 'values': [[datetime.datetime.now().isoformat()]]})
+    stage("batch_update", lambda: google_sheets.batch_update(gs, data_update))
+    return results
+
+
+def print_results(course, results):
+    print("\n{} repositories per lab (labs {}), {} groups of {} students".format(
+        course.repos, ", ".join(course.labs), course.groups, course.students))
+    print("{:<16} {:>9} {:>8}".format("stage", "seconds", "updates") +
+          "".join(" {:>9}".format(service) for service in REPORTED_SERVICES) + " {:>13}".format("peak RSS MiB"))
+    for result in results:
+        print("{:<16} {:>9.2f} {:>8}".format(
+            result['stage'], result['seconds'], "" if result['updates'] is None else result['updates']) +
+            "".join(" {:>9}".format(result['requests'][service]) for service in REPORTED_SERVICES) +
+            " {:>13.1f}".format(result['peak_rss_mib']))
+    print("{:<16} {:>9.2f} {:>8}".format("total", sum(r['seconds'] for r in results), "") + "".join(
+        " {:>9}".format(sum(r['requests'][service] for r in results)) for service in REPORTED_SERVICES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the update pipeline on a synthetic course")
+    parser.add_argument('--repos', type=int, nargs='+', default=[100, 1000],
+                        help="repositories per lab, a course of every size is benchmarked")
+    parser.add_argument('--labs', nargs='+', default=['1', '3', '5'], choices=sorted(LABS),
+                        help="labs of the course: 1 - Travis CI, 3 - AppVeyor, 5 - Travis CI and "
+                        "commit/issue requirements")
+    parser.add_argument('--groups', type=int, default=None, help="number of groups, enough for all repositories "
+                        "by default")
+    parser.add_argument('--students', type=int, default=30, help="students per group")
+    parser.add_argument('--success', type=float, default=0.8, help="share of successful CI builds")
+    parser.add_argument('--wrong-taskid', type=float, default=0.05, help="share of builds with a wrong TASKID")
+    parser.add_argument('--graded', type=float, default=0.2, help="share of labs graded already")
+    parser.add_argument('--registrations', type=float, default=0.05,
+                        help="share of students registering by email in the run")
+    parser.add_argument('--log-kb', type=int, default=20, help="build log size, KiB")
+    parser.add_argument('--commits', type=int, default=10, help="commits per repository")
+    parser.add_argument('--issues', type=int, default=3, help="issues per repository")
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help="seconds added to every GitHub, Travis and AppVeyor request")
+    parser.add_argument('--sheets-latency', type=float, default=0.3,
+                        help="seconds added to every Google Sheets request")
+    parser.add_argument('--imap-latency', type=float, default=0.01, help="seconds added to every IMAP command")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the course")
+    parser.add_argument('--json', help="also save results to this file")
+    parser.add_argument('-v', '--verbose', action='store_true', help="show output of the grader")
+    # a grading process started by the benchmark
+    parser.add_argument('--grade', help=argparse.SUPPRESS)
+    params = parser.parse_args()
+
+    if params.grade:
+        job = json.loads(params.grade)
+        results = grade(job['options'], job['http_port'], job['imap_port'], job['sheets_latency'], params.verbose)
+        with open(job['result_file'], 'w') as f:
+            json.dump(results, f)
+        return
+
+    all_results = []
+    for repos in params.repos:
+        course = SyntheticCourse(
+            repos, groups=params.groups, students=params.students, labs=params.labs, seed=params.seed,
+            success=params.success, wrong_taskid=params.wrong_taskid, graded=params.graded,
+            registrations=params.registrations, log_kb=params.log_kb, commits=params.commits, issues=params.issues,
+        )
+        server, imap_server = start_standins(course, params.latency, params.imap_latency)
+        result_file = os.path.join(tempfile.mkdtemp(), 'results.json')
+        job = {
+            'options': course.options(),
+            'http_port': server.server_address[1],
+            'imap_port': imap_server.port,
+            'sheets_latency': params.sheets_latency,
+            'result_file': result_file,
+        }
+        # a fresh process for every size, so that peak RSS is its own
+        command = [sys.executable, os.path.realpath(__file__), '--grade', json.dumps(job)]
+        if params.verbose:
+            command.append('--verbose')
+        try:
+            subprocess.run(command, check=True)
+        finally:
+            server.shutdown()
+            server.server_close()
+            imap_server.stop()
+        with open(result_file) as f:
+            results = json.load(f)
+        print_results(course, results)
+        all_results.append({'course': course.options(), 'stages': results})
+    if params.json:
+        with open(params.json, 'w') as f:
+            json.dump(all_results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
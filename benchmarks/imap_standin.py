@@ -0,0 +1,342 @@
+"""
+Minimal local IMAP server for testing and benchmarks.
+
+Implements the subset of IMAP4rev1 used by mailbox.py: LOGIN, LIST,
+SELECT (with CONDSTORE), UID SEARCH, UID FETCH (UID, FLAGS, MODSEQ,
+BODYSTRUCTURE, BODY[...] / BODY.PEEK[...] with partial fetch, RFC822),
+UID STORE, IDLE, NOOP, CLOSE and LOGOUT on a single in-memory INBOX.
+No TLS, so set mail_imap_ssl = False in settings to connect to it.
+
+    server = ImapStandin(('127.0.0.1', 0), latency=0.01)
+    server.start()
+    server.add_message(raw_email_bytes)
+    ...
+    server.stop()
+"""
+import re
+import time
+import email
+import threading
+import socketserver
+
+
+CAPABILITIES = "IMAP4rev1 IDLE UIDPLUS CONDSTORE"
+
+
+class Message:
+    def __init__(self, uid, raw, modseq):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set()
+        self.modseq = modseq
+        self.parsed = email.message_from_bytes(raw)
+
+
+def _quote(value):
+    if value is None:
+        return "NIL"
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _payload_bytes(part):
+    # raw payload as it was received, get_payload() would decode 8bit data
+    payload = part._payload
+    if isinstance(payload, list):
+        return b''
+    return payload.encode('utf-8', 'surrogateescape')
+
+
+def _bodystructure(part):
+    if part.is_multipart():
+        children = "".join(_bodystructure(p) for p in part.get_payload())
+        return "({} {})".format(children, _quote(part.get_content_subtype().upper()))
+    params = part.get_params()[1:] if part.get_params() else []
+    params_str = "NIL"
+    if params:
+        params_str = "(" + " ".join("{} {}".format(_quote(k.upper()), _quote(v)) for k, v in params) + ")"
+    payload = _payload_bytes(part)
+    fields = [
+        _quote(part.get_content_maintype().upper()),
+        _quote(part.get_content_subtype().upper()),
+        params_str,
+        "NIL",
+        "NIL",
+        _quote((part.get('Content-Transfer-Encoding') or '7BIT').upper()),
+        str(len(payload)),
+    ]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(payload.count(b'\n') + 1))
+    fields.append("NIL")
+    disposition = part.get('Content-Disposition')
+    if disposition:
+        fields.append("({} NIL)".format(_quote(disposition.split(';')[0].strip())))
+    else:
+        fields.append("NIL")
+    return "(" + " ".join(fields) + ")"
+
+
+def _section(message, section):
+    """
+    Get bytes of a message section: '', 'HEADER', 'TEXT',
+    'HEADER.FIELDS (...)' or part number like '1.2'
+    """
+    raw = message.raw
+    header_end = raw.find(b'\r\n\r\n')
+    separator = 4
+    if header_end < 0:
+        header_end = raw.find(b'\n\n')
+        separator = 2
+    if section == '':
+        return raw
+    if section == 'HEADER':
+        return raw[:header_end + separator]
+    if section == 'TEXT':
+        return raw[header_end + separator:]
+    if section.startswith('HEADER.FIELDS'):
+        names = section[section.find('(') + 1:section.rfind(')')].split()
+        lines = []
+        for name in names:
+            for value in message.parsed.get_all(name, []):
+                lines.append("{}: {}".format(name.capitalize(), value))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('utf-8', 'surrogateescape')
+    part = message.parsed
+    for number in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+        elif number != '1':
+            return b''
+    return _payload_bytes(part)
+
+
+class Mailbox:
+    def __init__(self):
+        self.uidvalidity = 1
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.messages = []
+        self.condition = threading.Condition()
+
+    def add(self, raw):
+        with self.condition:
+            self.highestmodseq += 1
+            self.messages.append(Message(self.uidnext, raw, self.highestmodseq))
+            self.uidnext += 1
+            self.condition.notify_all()
+
+    def uid_set(self, spec):
+        uids = [m.uid for m in self.messages]
+        result = []
+        max_uid = max(uids) if uids else 0
+        for item in spec.split(','):
+            if ':' in item:
+                a, b = item.split(':')
+                a = max_uid if a == '*' else int(a)
+                b = max_uid if b == '*' else int(b)
+                a, b = min(a, b), max(a, b)
+                result += [u for u in uids if a <= u <= b]
+            else:
+                u = max_uid if item == '*' else int(item)
+                result += [u] if u in uids else []
+        return sorted(set(result))
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        self.wfile.write(line)
+        self.wfile.flush()
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send("* OK IMAP stand-in ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode('utf-8').rstrip('\r\n')
+            tag, _, rest = line.partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            if command == 'UID':
+                command, _, args = args.partition(' ')
+                command = 'UID ' + command.upper()
+            handler = getattr(self, 'do_' + command.replace(' ', '_'), None)
+            if handler is None:
+                self.send("{} BAD unknown command\r\n".format(tag))
+                continue
+            with mailbox.condition:
+                self.server.commands.append(command)
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            if handler(tag, args) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args):
+        self.send("* CAPABILITY {}\r\n{} OK CAPABILITY completed\r\n".format(CAPABILITIES, tag))
+
+    def do_LOGIN(self, tag, args):
+        self.send("{} OK [CAPABILITY {}] LOGIN completed\r\n".format(tag, CAPABILITIES))
+
+    def do_LIST(self, tag, args):
+        self.send('* LIST (\\HasNoChildren) "/" INBOX\r\n{} OK LIST completed\r\n'.format(tag))
+
+    def do_NOOP(self, tag, args):
+        self.send("{} OK NOOP completed\r\n".format(tag))
+
+    def do_SELECT(self, tag, args):
+        mailbox = self.server.mailbox
+        with mailbox.condition:
+            self.send(
+                "* {} EXISTS\r\n* 0 RECENT\r\n"
+                "* OK [UIDVALIDITY {}] UIDs valid\r\n"
+                "* OK [UIDNEXT {}] Predicted next UID\r\n"
+                "* OK [HIGHESTMODSEQ {}] Highest\r\n"
+                "{} OK [READ-WRITE] SELECT completed\r\n".format(
+                    len(mailbox.messages), mailbox.uidvalidity, mailbox.uidnext,
+                    mailbox.highestmodseq, tag)
+            )
+
+    def do_CLOSE(self, tag, args):
+        self.send("{} OK CLOSE completed\r\n".format(tag))
+
+    def do_LOGOUT(self, tag, args):
+        self.send("* BYE\r\n{} OK LOGOUT completed\r\n".format(tag))
+        return False
+
+    def do_UID_SEARCH(self, tag, args):
+        mailbox = self.server.mailbox
+        criteria = args.upper().replace('(', ' ').replace(')', ' ').split()
+        if criteria and criteria[0] == 'NIL':
+            criteria = criteria[1:]
+        with mailbox.condition:
+            messages = list(mailbox.messages)
+            i = 0
+            while i < len(criteria):
+                criterion = criteria[i]
+                if criterion == 'UNSEEN':
+                    messages = [m for m in messages if '\\Seen' not in m.flags]
+                elif criterion == 'UID':
+                    uids = set(mailbox.uid_set(criteria[i + 1]))
+                    messages = [m for m in messages if m.uid in uids]
+                    i += 1
+                elif criterion == 'MODSEQ':
+                    messages = [m for m in messages if m.modseq >= int(criteria[i + 1])]
+                    i += 1
+                i += 1
+        self.send("* SEARCH {}\r\n{} OK SEARCH completed\r\n".format(
+            " ".join(str(m.uid) for m in messages), tag))
+
+    def do_UID_FETCH(self, tag, args):
+        mailbox = self.server.mailbox
+        uid_spec, _, items = args.partition(' ')
+        items = items.strip()
+        if items.startswith('(') and items.endswith(')'):
+            items = items[1:-1]
+        item_list = re.findall(r'BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[A-Z0-9.]+', items.upper())
+        with mailbox.condition:
+            by_uid = {m.uid: (i + 1, m) for i, m in enumerate(mailbox.messages)}
+            for uid in mailbox.uid_set(uid_spec):
+                number, message = by_uid[uid]
+                parts = [b"UID " + str(uid).encode()]
+                for item in item_list:
+                    if item == 'UID':
+                        continue
+                    if item == 'FLAGS':
+                        parts.append("FLAGS ({})".format(" ".join(sorted(message.flags))).encode())
+                    elif item == 'MODSEQ':
+                        parts.append("MODSEQ ({})".format(message.modseq).encode())
+                    elif item == 'BODYSTRUCTURE':
+                        parts.append(b"BODYSTRUCTURE " + _bodystructure(message.parsed).encode())
+                    elif item in ('RFC822', 'BODY[]') or item.startswith('BODY'):
+                        if item == 'RFC822':
+                            section, partial, name = '', None, 'RFC822'
+                        else:
+                            match = re.match(r'BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', item)
+                            section = match.group(2)
+                            partial = (int(match.group(3)), int(match.group(4))) if match.group(3) else None
+                            name = "BODY[{}]".format(section)
+                            if partial:
+                                name += "<{}>".format(partial[0])
+                            if not match.group(1):
+                                message.flags.add('\\Seen')
+                        if item == 'RFC822':
+                            message.flags.add('\\Seen')
+                        data = _section(message, section)
+                        if partial:
+                            data = data[partial[0]:partial[0] + partial[1]]
+                        parts.append(name.encode() + b" {" + str(len(data)).encode() + b"}\r\n" + data)
+                self.send(b"* " + str(number).encode() + b" FETCH (" + b" ".join(parts) + b")\r\n")
+        self.send("{} OK FETCH completed\r\n".format(tag))
+
+    def do_UID_STORE(self, tag, args):
+        mailbox = self.server.mailbox
+        uid_spec, operation, flags = args.split(' ', 2)
+        flags = flags.strip('()').split()
+        with mailbox.condition:
+            mailbox.highestmodseq += 1
+            for uid in mailbox.uid_set(uid_spec):
+                message = next(m for m in mailbox.messages if m.uid == uid)
+                if operation.upper().startswith('+'):
+                    message.flags.update(flags)
+                else:
+                    message.flags.difference_update(flags)
+                message.modseq = mailbox.highestmodseq
+            self.server.stores.append((uid_spec, operation, tuple(flags)))
+        self.send("{} OK STORE completed\r\n".format(tag))
+
+    def do_IDLE(self, tag, args):
+        mailbox = self.server.mailbox
+        self.send("+ idling\r\n")
+        with mailbox.condition:
+            known = len(mailbox.messages)
+        done = threading.Event()
+
+        def notify():
+            nonlocal known
+            with mailbox.condition:
+                while not done.is_set():
+                    if len(mailbox.messages) != known:
+                        known = len(mailbox.messages)
+                        self.send("* {} EXISTS\r\n".format(known))
+                    mailbox.condition.wait(0.1)
+        notifier = threading.Thread(target=notify, daemon=True)
+        notifier.start()
+        line = self.rfile.readline()
+        done.set()
+        notifier.join()
+        if not line:
+            return False
+        self.send("{} OK IDLE terminated\r\n".format(tag))
+
+
+class ImapStandin(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0):
+        """
+        :param latency: seconds every command is delayed by
+        """
+        super().__init__(address, ImapHandler)
+        self.mailbox = Mailbox()
+        self.latency = latency
+        # log of received commands and flag changes, useful in tests
+        self.commands = []
+        self.stores = []
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_message(self, raw):
+        self.mailbox.add(raw)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
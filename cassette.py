@@ -0,0 +1,401 @@
+"""
+Recording and replaying of external calls (--record, --replay).
+
+While recording, every HTTP request made with requests (GitHub, CI
+services, MOSS reports, ...), every Google Sheets API call and every MOSS
+upload of a run is passed through and saved to a cassette file together
+with its response and latency. While replaying, the calls are answered
+from the cassette without touching the network, optionally with the
+recorded latencies, so that a whole `--action update` or `--action moss`
+run can be repeated offline, e.g. to benchmark it.
+
+A cassette is a JSON lines file, one interaction per line. Tokens and
+passwords from settings, credentials in URLs and token fields of JSON
+responses are replaced with SCRUBBED before anything is written.
+
+Requests are matched by method, URL and body (after scrubbing), Sheets
+calls by method chain and arguments (request bodies excluded, they carry
+timestamps). Identical requests are answered in the order they were
+recorded, the last answer is repeated once they are used up. Mail
+(IMAP/SMTP) is not recorded: replay with --dry-run and a local mailbox,
+see benchmarks/imap_standin.py.
+"""
+import io
+import re
+import copy
+import json
+import time
+import base64
+import hashlib
+import threading
+import collections
+import urllib.parse
+
+import settings
+
+
+SCRUBBED = "SCRUBBED"
+# settings holding secrets, their values are never saved to a cassette
+SECRET_SETTINGS = ('github_token', 'appveyor_token', 'travis_token', 'mail_password', 'moss_userid',
+                   'worker_github_tokens')
+# URL query parameters and JSON fields holding secrets
+SECRET_FIELDS = re.compile(r'token|password|secret|^key$|^sig', re.IGNORECASE)
+# response headers not saved: connection specific or secret
+SKIPPED_HEADERS = ('transfer-encoding', 'connection', 'keep-alive', 'set-cookie')
+# response headers holding URLs, e.g. redirects to GitHub tarballs carry
+# a token in the query string
+URL_HEADERS = ('location', 'content-location', 'link')
+
+# cassette of the process, None if neither recording nor replaying
+_cassette = None
+# requests.adapters.HTTPAdapter.send replaced by _send while there is a cassette
+_original_send = None
+
+
+def _secrets():
+    """
+    Collect secret values of settings and of all courses
+    """
+    sources = [{name: getattr(settings, name, None) for name in SECRET_SETTINGS}]
+    sources += list(getattr(settings, 'courses', None) or [])
+    values = set()
+    for source in sources:
+        for name in SECRET_SETTINGS:
+            value = source.get(name)
+            for item in value if isinstance(value, (list, tuple)) else [value]:
+                if item is not None and len(str(item)) >= 4:
+                    values.add(str(item))
+    # longest first, a token may contain a shorter one
+    return sorted(values, key=len, reverse=True)
+
+
+def _scrub_document(value):
+    """
+    Replace values of secret fields in a JSON document
+    """
+    if isinstance(value, dict):
+        return {
+            key: SCRUBBED if SECRET_FIELDS.search(key) and isinstance(item, str) else _scrub_document(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_scrub_document(item) for item in value]
+    return value
+
+
+def _scrub_json(content_type, body):
+    """
+    Replace values of secret fields in a JSON response body
+    """
+    if 'json' not in content_type:
+        return body
+    try:
+        document = json.loads(body)
+    except ValueError:
+        return body
+    scrubbed = _scrub_document(document)
+    return body if scrubbed == document else json.dumps(scrubbed).encode('utf-8')
+
+
+class Cassette:
+    """
+    Recorded interactions of a run
+    """
+
+    def __init__(self, path, mode, latency_scale=1.0):
+        """
+        :param path: cassette file name
+        :param mode: 'record' or 'replay'
+        :param latency_scale: replay: recorded latencies are multiplied by
+        it, 0 answers at once
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError("Unknown cassette mode '{}'".format(mode))
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._secrets = _secrets()
+        self._lock = threading.Lock()
+        # replay: key -> deque of interactions, key -> last interaction
+        self._interactions = collections.defaultdict(collections.deque)
+        self._last = {}
+        self._file = None
+        if mode == 'record':
+            self._file = open(path, 'w', encoding='utf-8')
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        self._interactions[interaction['key']].append(interaction)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def scrub(self, text):
+        """
+        Replace secrets of settings in a str or bytes value
+        """
+        for secret in self._secrets:
+            if isinstance(text, bytes):
+                text = text.replace(secret.encode('utf-8'), SCRUBBED.encode('utf-8'))
+            else:
+                text = text.replace(secret, SCRUBBED)
+        return text
+
+    def scrub_url(self, url):
+        parts = urllib.parse.urlsplit(self.scrub(url))
+        query = [
+            (name, SCRUBBED if SECRET_FIELDS.search(name) else value)
+            for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        ]
+        netloc = parts.netloc
+        if '@' in netloc:
+            netloc = SCRUBBED + '@' + netloc.rsplit('@', 1)[1]
+        return urllib.parse.urlunsplit(parts._replace(netloc=netloc, query=urllib.parse.urlencode(query)))
+
+    def scrub_header_urls(self, value):
+        """
+        Scrub URLs of a header value, e.g. Location or a Link list of
+        '<url>; rel="next"' items
+        """
+        if '<' not in value:
+            return self.scrub_url(value.strip())
+        return re.sub(r'<([^>]*)>', lambda match: '<{}>'.format(self.scrub_url(match.group(1))), value)
+
+    def _save(self, interaction):
+        with self._lock:
+            self._file.write(json.dumps(interaction, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def _take(self, key):
+        """
+        Take the next recorded interaction with a key, sleeping for its
+        scaled latency
+
+        :returns: interaction dict or None if nothing has been recorded
+        """
+        with self._lock:
+            queue = self._interactions.get(key)
+            if queue:
+                interaction = self._last[key] = queue.popleft()
+            else:
+                interaction = self._last.get(key)
+        if interaction is not None and self.latency_scale:
+            time.sleep(interaction['elapsed'] * self.latency_scale)
+        return interaction
+
+    def http_key(self, request):
+        """
+        Identify a prepared request by its method, URL and body
+        """
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        elif not isinstance(body, bytes):
+            # a file or a generator, cannot be matched by content
+            body = b''
+        digest = hashlib.sha256(self.scrub(body)).hexdigest()[:16]
+        return "http {} {} {}".format(request.method, self.scrub_url(request.url), digest)
+
+    def record_http(self, key, request, status, reason, headers, body, elapsed):
+        """
+        Save an HTTP interaction
+
+        :param headers: response headers, see _response_headers
+        :param body: response body, decoded
+        """
+        headers = {
+            name: self.scrub_header_urls(value) if name in URL_HEADERS else self.scrub(value)
+            for name, value in headers.items()
+        }
+        body = _scrub_json(headers.get('content-type', ''), self.scrub(body))
+        headers['content-length'] = str(len(body))
+        self._save({
+            'key': key,
+            'method': request.method,
+            'url': self.scrub_url(request.url),
+            'status': status,
+            'reason': reason,
+            'headers': headers,
+            'body': base64.b64encode(body).decode('ascii'),
+            'elapsed': round(elapsed, 6),
+        })
+
+    def replay_http(self, key):
+        """
+        :returns: tuple (status, reason, headers, body) or None
+        """
+        interaction = self._take(key)
+        if interaction is None:
+            return None
+        return (interaction['status'], interaction['reason'], interaction['headers'],
+                base64.b64decode(interaction['body']))
+
+    def call(self, kind, key, function):
+        """
+        Make a call that is not an HTTP request of requests (a Sheets API
+        call, a MOSS upload), recording or replaying its JSON serializable
+        result
+
+        :param kind: call kind, e.g. 'sheets'
+        :param key: identity of the call among calls of the kind
+        :param function: function making the call
+        :returns: result of the call
+        """
+        key = "{} {}".format(kind, self.scrub(key))
+        if self.mode == 'replay':
+            interaction = self._take(key)
+            if interaction is None:
+                raise Exception("Call '{}' is not in cassette '{}'".format(key, self.path))
+            # callers may modify the result, e.g. spreadsheet data
+            return copy.deepcopy(interaction['result'])
+        start = time.perf_counter()
+        result = function()
+        self._save({
+            'key': key,
+            'result': _scrub_document(json.loads(self.scrub(json.dumps(result, ensure_ascii=False)))),
+            'elapsed': round(time.perf_counter() - start, 6),
+        })
+        return result
+
+
+def _response_headers(headers, body):
+    """
+    Make headers of a response rebuilt from its whole body
+
+    :returns: dict with lowercase header names
+    """
+    headers = {
+        name.lower(): value for name, value in headers.items()
+        # the body has been decoded already
+        if name.lower() not in SKIPPED_HEADERS and name.lower() != 'content-encoding'
+    }
+    headers['content-length'] = str(len(body))
+    return headers
+
+
+def _send(adapter, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+    """
+    requests.adapters.HTTPAdapter.send recording or replaying requests
+    """
+    from urllib3.response import HTTPResponse
+    key = _cassette.http_key(request)
+    if _cassette.mode == 'replay':
+        recorded = _cassette.replay_http(key)
+        if recorded is None:
+            import requests
+            raise requests.exceptions.ConnectionError(
+                "Request {} is not in cassette '{}'".format(key, _cassette.path), request=request)
+        status, reason, headers, body = recorded
+    else:
+        start = time.perf_counter()
+        response = _original_send(adapter, request, stream=True, timeout=timeout, verify=verify, cert=cert,
+                                  proxies=proxies)
+        try:
+            # the response is rebuilt from the whole body
+            body = response.raw.read(decode_content=True)
+        finally:
+            response.close()
+        elapsed = time.perf_counter() - start
+        status, reason = response.status_code, response.reason
+        headers = _response_headers(response.headers, body)
+        _cassette.record_http(key, request, status, reason, headers, body, elapsed)
+    raw = HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=status,
+        reason=reason,
+        preload_content=False,
+        decode_content=True,
+    )
+    # the body is read by the session unless stream is set
+    return adapter.build_response(request, raw)
+
+
+def start(path, mode, latency_scale=1.0):
+    """
+    Start recording or replaying external calls of the process
+
+    :param path: cassette file name
+    :param mode: 'record' or 'replay'
+    :param latency_scale: see Cassette
+    """
+    global _cassette, _original_send
+    import requests.adapters
+    _cassette = Cassette(path, mode, latency_scale)
+    if _original_send is None:
+        _original_send = requests.adapters.HTTPAdapter.send
+        requests.adapters.HTTPAdapter.send = _send
+    print("{} external calls {} '{}'".format(
+        "Recording" if mode == 'record' else "Replaying", "to" if mode == 'record' else "from", path))
+
+
+def stop():
+    """
+    Stop recording or replaying
+    """
+    global _cassette, _original_send
+    if _original_send is not None:
+        import requests.adapters
+        requests.adapters.HTTPAdapter.send = _original_send
+        _original_send = None
+    if _cassette is not None:
+        _cassette.close()
+        _cassette = None
+
+
+def replaying():
+    """
+    :returns: True if external calls are answered from a cassette
+    """
+    return _cassette is not None and _cassette.mode == 'replay'
+
+
+def call(kind, key, function):
+    """
+    Make a call through the cassette if there is one, see Cassette.call
+    """
+    if _cassette is None:
+        return function()
+    return _cassette.call(kind, key, function)
+
+
+class _SheetsCall:
+    """
+    Part of a chain of Sheets API calls, e.g. spreadsheet.values().batchGet(...),
+    whose execute() goes through the cassette
+    """
+
+    def __init__(self, target, chain=()):
+        # target is None while replaying
+        self._target = target
+        self._chain = chain
+
+    def __getattr__(self, name):
+        def method(**kwargs):
+            target = None if self._target is None else getattr(self._target, name)(**kwargs)
+            # bodies of updates contain timestamps, they are not matched
+            arguments = {key: value for key, value in kwargs.items() if key != 'body'}
+            return _SheetsCall(target, self._chain + ((name, arguments),))
+        return method
+
+    def execute(self):
+        key = json.dumps(self._chain, sort_keys=True, ensure_ascii=False)
+        return call('sheets', key, lambda: self._target.execute())
+
+
+def wrap_sheets(spreadsheet):
+    """
+    Make calls of a service.spreadsheets() instance go through the
+    cassette
+
+    :param spreadsheet: service.spreadsheets() instance, None while
+    replaying (no credentials are needed then)
+    :returns: spreadsheet itself if there is no cassette
+    """
+    if _cassette is None:
+        return spreadsheet
+    return _SheetsCall(spreadsheet)
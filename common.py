@@ -5,16 +5,50 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
 import json
+import time
+import urllib.parse
 import datetime
-from oauth2client.service_account import ServiceAccountCredentials
+import threading
+import collections
 # import gspread
 import settings
+import courses
+import metrics
 
 
 APPVEYOR_PROJECTS_API_URL = "https://ci.appveyor.com/api/account/{}/projects/paged?pageIndex={}&pageSize=100"
 APPVEYOR_LATEST_BUILD_API_URL = "https://ci.appveyor.com/api/projects/{}/{}"
 APPVEYOR_BUILD_LOG_API_URL = "https://ci.appveyor.com/api/buildjobs/{}/log"
 
+# API hosts by service, requests to them are counted, see request_counts
+API_SERVICES = {
+    'api.github.com': 'github',
+    'api.travis-ci.com': 'travis',
+    'api.travis-ci.org': 'travis',
+    'ci.appveyor.com': 'appveyor',
+}
+
+# max number of GitHub API responses kept for conditional requests
+ETAG_CACHE_SIZE = 4096
+
+# max number of concurrent GitHub API requests made with the same token
+DEFAULT_GITHUB_CONNECTIONS = 8
+# number of GitHub API requests left unused when the rate limit runs low
+DEFAULT_GITHUB_RATE_RESERVE = 50
+
+# requests session shared by all API calls, keeps connections alive
+_session = None
+_session_lock = threading.Lock()
+# (url, Accept, Authorization) -> (ETag, response)
+_etag_cache = collections.OrderedDict()
+_etag_lock = threading.Lock()
+# token -> RateBudget
+_rate_budgets = {}
+_rate_budgets_lock = threading.Lock()
+# (course, service) -> number of requests made, see request_counts
+_request_counts = collections.Counter()
+_request_counts_lock = threading.Lock()
+
 
 def requests_retry_session(
     retries=3,
@@ -36,9 +70,198 @@ def requests_retry_session(
     adapter = HTTPAdapter(max_retries=retry)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
+    session.hooks['response'].append(_record_response)
     return session
 
 
+def _record_response(response, *args, **kwargs):
+    """
+    Response hook recording metrics of a request
+    """
+    host = urllib.parse.urlsplit(response.url).hostname
+    method = response.request.method
+    metrics.observe('http_request_duration_seconds', response.elapsed.total_seconds(), host=host, method=method)
+    metrics.inc('http_requests_total', host=host, method=method, code=response.status_code)
+    service = API_SERVICES.get(host)
+    if service is not None:
+        with _request_counts_lock:
+            _request_counts[(courses.current(), service)] += 1
+    if kwargs.get('stream'):
+        length = response.headers.get('Content-Length')
+    else:
+        # the body is about to be read anyway
+        length = len(response.content)
+    if length is not None:
+        metrics.inc('http_response_bytes_total', int(length), host=host)
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    if remaining is not None:
+        metrics.set_gauge('http_rate_limit_remaining', int(remaining), host=host)
+
+
+def request_counts(course=None):
+    """
+    Count API requests made by the process for a course
+
+    :param course: course name, None outside of a course
+    :returns: collections.Counter with service ('github', 'travis' or
+    'appveyor') as key
+    """
+    with _request_counts_lock:
+        return collections.Counter({
+            service: count for (request_course, service), count in _request_counts.items()
+            if request_course == course
+        })
+
+
+def get_session():
+    """
+    Get a retry session shared by all API calls, so that connections to
+    API servers are reused
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests_retry_session()
+        return _session
+
+
+class RateBudget:
+    """
+    Budget of GitHub API requests made with a single token, shared by all
+    threads and courses of the process
+
+    At most 'connections' requests are in flight at a time. When the rate
+    limit reported by GitHub drops to 'reserve' requests, new requests wait
+    for the limit to be reset. Waiting requests are served round robin by
+    course, so a course with many repositories does not starve the others.
+    """
+
+    def __init__(self, connections=DEFAULT_GITHUB_CONNECTIONS, reserve=DEFAULT_GITHUB_RATE_RESERVE):
+        self.connections = connections
+        self.reserve = reserve
+        # as reported by the last response, None if unknown
+        self.remaining = None
+        self.reset = None
+        self._in_flight = 0
+        # course -> deque of waiting requests, in the order courses are served
+        self._waiting = collections.OrderedDict()
+        self._condition = threading.Condition()
+
+    def _exhausted(self):
+        if self.remaining is None or self.remaining > self.reserve:
+            return False
+        if self.reset is None or time.time() >= self.reset:
+            # a new rate limit window has started
+            self.remaining = None
+            return False
+        return True
+
+    def acquire(self, course=None):
+        """
+        Wait for a permission to make a request
+
+        :param course: name of the course the request is made for
+        """
+        ticket = object()
+        with self._condition:
+            queue = self._waiting.setdefault(course, collections.deque())
+            queue.append(ticket)
+            announced = False
+            while True:
+                first_queue = next(iter(self._waiting.values()))
+                if first_queue[0] is ticket and self._in_flight < self.connections:
+                    if not self._exhausted():
+                        break
+                    if not announced:
+                        print("GitHub API rate limit is almost exhausted, waiting {:.0f} seconds for reset".format(
+                            max(0, self.reset - time.time())))
+                        announced = True
+                    self._condition.wait(max(0.1, self.reset - time.time()))
+                else:
+                    self._condition.wait()
+            queue.popleft()
+            if queue:
+                # the course has more requests, others go first
+                self._waiting.move_to_end(course)
+            else:
+                del self._waiting[course]
+            self._in_flight += 1
+            if self.remaining is not None:
+                self.remaining -= 1
+            self._condition.notify_all()
+
+    def release(self, response=None):
+        """
+        Finish a request and update the budget from rate limit headers of
+        its response
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if response is not None and "X-RateLimit-Remaining" in response.headers:
+                remaining = int(response.headers["X-RateLimit-Remaining"])
+                reset = int(response.headers.get("X-RateLimit-Reset", 0)) or None
+                if reset != self.reset or self.remaining is None:
+                    self.remaining, self.reset = remaining, reset
+                else:
+                    # responses of concurrent requests may come out of order
+                    self.remaining = min(self.remaining, remaining)
+            self._condition.notify_all()
+
+
+def get_rate_budget(token):
+    """
+    Get the budget of GitHub API requests of a token, see RateBudget
+    """
+    with _rate_budgets_lock:
+        if token not in _rate_budgets:
+            _rate_budgets[token] = RateBudget(
+                getattr(settings, 'github_connections', DEFAULT_GITHUB_CONNECTIONS),
+                getattr(settings, 'github_rate_reserve', DEFAULT_GITHUB_RATE_RESERVE),
+            )
+        return _rate_budgets[token]
+
+
+def cached_get(url, headers=None, **kwargs):
+    """
+    GET request over the shared session. GitHub API requests are made
+    conditional: responses are cached with their ETags, and if a resource
+    has not changed since, GitHub replies with 304 Not Modified (which does
+    not count against the rate limit) and the cached response is returned.
+    GitHub API requests are limited by the rate budget of their token, see
+    RateBudget.
+
+    :returns: requests.Response
+    """
+    headers = dict(headers or {})
+    if "api.github.com" not in url:
+        return get_session().get(url, headers=headers, **kwargs)
+    key = (url, headers.get("Accept"), headers.get("Authorization"))
+    with _etag_lock:
+        cached = _etag_cache.get(key)
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
+    budget = get_rate_budget(headers.get("Authorization"))
+    budget.acquire(courses.current())
+    res = None
+    try:
+        res = get_session().get(url, headers=headers, **kwargs)
+    finally:
+        budget.release(res)
+    if res.status_code == 304 and cached is not None:
+        metrics.inc('github_cache_requests_total', result='hit')
+        return cached[1]
+    metrics.inc('github_cache_requests_total', result='miss')
+    if res.status_code == 200 and res.headers.get("ETag"):
+        # read the body now, the response may be returned many times
+        res.content
+        with _etag_lock:
+            _etag_cache[key] = (res.headers["ETag"], res)
+            _etag_cache.move_to_end(key)
+            while len(_etag_cache) > ETAG_CACHE_SIZE:
+                _etag_cache.popitem(last=False)
+    return res
+
+
 # get repository list from github
 def get_github_repos(org, prefix=None, private=None, verbose=False):
     all_repos_list = []
@@ -51,7 +274,7 @@ def get_github_repos(org, prefix=None, private=None, verbose=False):
         if verbose:
             sys.stdout.write('.')
             sys.stdout.flush()
-        repos_page = requests_retry_session().get(
+        repos_page = cached_get(
             "https://api.github.com/orgs/{}/repos?page={}".format(
                 org, page_number
             ),
@@ -81,6 +304,24 @@ def get_github_repos(org, prefix=None, private=None, verbose=False):
     # print( "%d of %d repos start with %s" % (len(filteredRepoList), len(allReposList), githubPrefix))
 
 
+def get_github_rate_limit():
+    """
+    Get the GitHub API rate limit of the token, the request itself does
+    not count against the limit
+
+    :returns: dict with 'limit', 'remaining' and 'reset' (POSIX timestamp) keys
+    """
+    res = cached_get(
+        "https://api.github.com/rate_limit",
+        headers={"Authorization": "token " + settings.github_token},
+        timeout=settings.requests_timeout
+    )
+    if res.status_code != 200:
+        raise Exception("GitHub API reported an error while trying to get rate limit! Message is '{}' ({}).".format(
+            res.reason, res.status_code))
+    return json.loads(res.content)['resources']['core']
+
+
 # get a set of github repository names with a given prefix
 def get_github_repo_names(org, prefix=None, private=None):
     repos = get_github_repos(org, prefix, private)
@@ -95,7 +336,7 @@ def github_user_exists(username):
     :returns: True if user exists, False otherwise
     """
     # https://api.github.com/search/users?q=user:username
-    res = requests_retry_session().get(
+    res = cached_get(
         'https://api.github.com/search/users?q=user:{}'.format(username),
         timeout=settings.requests_timeout
     )
@@ -119,7 +360,7 @@ def get_appveyor_project_repo_names():
     page_index = 0;
     has_next_page = True
     while has_next_page:
-        res = requests_retry_session().get(
+        res = cached_get(
             APPVEYOR_PROJECTS_API_URL.format(
                 settings.appveyor_account,
                 page_index
@@ -155,7 +396,7 @@ def add_appveyor_project(repo):
         "repositoryProvider": "gitHub",
         "repositoryName": repo,
     }
-    res = requests.post('https://ci.appveyor.com/api/account/{}/projects'.format(settings.appveyor_account), data=add_project_request, headers=headers)
+    res = get_session().post('https://ci.appveyor.com/api/account/{}/projects'.format(settings.appveyor_account), data=add_project_request, headers=headers)
     if res.status_code != 200:
         raise Exception("AppVeyor API reported an error while trying to add a new project '{}'! Message is '{}' ({}).".format(repo, res.reason, res.status_code))
         # raise Exception("Appveyor API error!")
@@ -174,7 +415,7 @@ def trigger_appveyor_build(slug, branch="master"):
         "projectSlug": slug,
         "branch": branch,
     }
-    res = requests.post('https://ci.appveyor.com/api/account/{}/builds'.format(settings.appveyor_account), data=build_project_request, headers=headers)
+    res = get_session().post('https://ci.appveyor.com/api/account/{}/builds'.format(settings.appveyor_account), data=build_project_request, headers=headers)
     if res.status_code != 200:
         raise Exception("AppVeyor API reported an error while trying to build branch '{}' of project '{}'! Message is '{}' ({}).".format(branch, slug, res.reason, res.status_code))
         # exit(1)
@@ -182,8 +423,9 @@ def trigger_appveyor_build(slug, branch="master"):
 
 
 # add repositories to appveyor if they are not already added
-def add_appveyor_projects_safely(repo_list, trigger_build=False, dry_run=True):
-    existing_projects_repos = get_appveyor_project_repo_names()
+def add_appveyor_projects_safely(repo_list, trigger_build=False, dry_run=True, existing_projects_repos=None):
+    if existing_projects_repos is None:
+        existing_projects_repos = get_appveyor_project_repo_names()
     new_projects = {}
     for repo in repo_list:
         if repo not in existing_projects_repos:
@@ -204,7 +446,7 @@ def get_travis_token(private=True):
     travis_token_request = {
         "github_token": settings.github_token
     }
-    res = requests.post(
+    res = get_session().post(
         api_url.format("com" if private else "org"),
         data=travis_token_request
     )
@@ -220,7 +462,7 @@ def get_github_check_runs(repo):
         "Authorization": "token " + settings.github_token,
         "Accept": "application/vnd.github.antiope-preview+json",
     }
-    res = requests_retry_session().get(
+    res = cached_get(
         "https://api.github.com/repos/{}/commits/master/check-runs".format(
             repo
         ),
@@ -246,7 +488,7 @@ def get_github_commits_by_branch(repo: str, branch: str = "master"):
         "Authorization": "token " + settings.github_token,
         "Accept": "application/vnd.github.v3+json",
     }
-    res = requests_retry_session().get(
+    res = cached_get(
         "https://api.github.com/repos/{}/commits?sha={}".format(repo, branch),
         headers=commits_headers,
         timeout=settings.requests_timeout
@@ -272,7 +514,7 @@ def get_github_commit_by_sha(repo: str, sha: str):
         "Authorization": "token " + settings.github_token,
         "Accept": "application/vnd.github.v3+json",
     }
-    res = requests_retry_session().get(
+    res = cached_get(
         "https://api.github.com/repos/{}/commits/{}".format(repo, sha),
         headers=commit_headers,
         timeout=settings.requests_timeout
@@ -297,7 +539,7 @@ def get_github_issues(repo: str):
         "Authorization": "token " + settings.github_token,
         "Accept": "application/vnd.github.v3+json",
     }
-    res = requests_retry_session().get(
+    res = cached_get(
         "https://api.github.com/repos/{}/issues?state=all".format(repo),
         headers=issues_headers,
         timeout=settings.requests_timeout
@@ -324,7 +566,7 @@ def get_github_issue_events(repo: str, issue_number: str):
         "Authorization": "token " + settings.github_token,
         "Accept": "application/vnd.github.v3+json",
     }
-    res = requests_retry_session().get(
+    res = cached_get(
         "https://api.github.com/repos/{}/issues/{}/events".format(repo, issue_number),
         headers=issue_events_headers,
         timeout=settings.requests_timeout
@@ -369,7 +611,15 @@ def get_successfull_build_info(repo):
 
 
 #
-def get_travis_log(repo):
+def get_travis_log(repo, build_info=None):
+    """
+    Retrieve Travis CI log of the latest successful build of a repository
+
+    :param repo: github repository
+    :param build_info: check run returned by get_successfull_build_info,
+    requested if None
+    :returns: build log or None if there is no successful build
+    """
     # check_runs_headers = {
     #     "User-Agent": "GitHubCheckRuns/1.0",
     #     "Authorization": "token " + settings.github_token,
@@ -392,7 +642,9 @@ def get_travis_log(repo):
     #         travis_build = check_run.get("external_id")
     #         completion_time = check_run.get("completed_at")
     #         break
-    travis_build = get_successfull_build_info(repo).get("external_id")
+    if build_info is None:
+        build_info = get_successfull_build_info(repo)
+    travis_build = build_info.get("external_id")
     if not travis_build:
         return None
     # 
@@ -403,7 +655,7 @@ def get_travis_log(repo):
         "User-Agent": "API Explorer",
         "Authorization": "token " + settings.travis_token,
     }
-    res = requests.get(
+    res = get_session().get(
         "https://api.travis-ci.com/build/{}".format(travis_build), 
         headers=travis_headers
     )
@@ -412,7 +664,7 @@ def get_travis_log(repo):
     job_id = json.loads(res.content).get("jobs", [{}])[-1].get("id")
     if job_id is None:
         raise Exception("No valid job ID found for build {} (repository '{}').".format(travis_build, repo))
-    res = requests.get(
+    res = get_session().get(
         "https://api.travis-ci.com/job/{}/log".format(job_id), 
         headers=travis_headers
     )
@@ -433,7 +685,7 @@ def get_successfull_status_info(repo):
         "Authorization": "token " + settings.github_token,
         "Accept": "application/vnd.github.antiope-preview+json",
     }
-    res = requests_retry_session().get(
+    res = cached_get(
         "https://api.github.com/repos/{}/commits/master/status".format(repo),
         headers=status_headers,
         timeout=settings.requests_timeout
@@ -469,7 +721,7 @@ def get_appveyor_log(repo):
         "User-Agent": "AppVeyorBuildRepo/1.0",
         "Authorization": "Bearer " + settings.appveyor_token,
     }
-    res = requests.get(
+    res = get_session().get(
         APPVEYOR_LATEST_BUILD_API_URL.format(settings.appveyor_account, slug), 
         headers=headers
     )
@@ -494,7 +746,7 @@ def get_appveyor_log(repo):
                 build.get("buildId"), repo
             )
         )
-    res = requests.get(
+    res = get_session().get(
         APPVEYOR_BUILD_LOG_API_URL.format(job_id), 
         headers=headers
     )
@@ -690,7 +942,7 @@ def github_get_file(repo, filepath):
         "Authorization": "token " + settings.github_token,
         "Accept": "application/vnd.github.v3.raw",
     }
-    res = requests_retry_session().get(
+    res = cached_get(
         "https://api.github.com/repos/{}/contents/{}".format(repo, filepath),
         headers=status_headers,
         timeout=settings.requests_timeout
@@ -712,7 +964,7 @@ def github_get_latest_commit_date(repo):
         "Authorization": "token " + settings.github_token,
         "Accept": "application/vnd.github.v3.raw",
     }
-    res = requests_retry_session().get(
+    res = cached_get(
         "https://api.github.com/repos/{}".format(repo),
         headers=status_headers,
         timeout=settings.requests_timeout
@@ -0,0 +1,95 @@
+"""
+Several courses graded by one process.
+
+A course is a dict in settings.courses with a 'name' key, all other keys
+override settings of the same name while the course is processed, e.g.
+
+    courses = [
+        {'name': 'os-2020', 'github_organization': 'suai-os-2020',
+         'google_spreadsheet_id': '...', 'os_labs': {...},
+         'journal_file': 'os-2020.journal', ...},
+        {'name': 'os-2021', ...},
+    ]
+
+Modules keep reading ``settings.<name>`` as usual: the settings module is
+given a class that looks the name up in the course of the current context
+first. The current course is a context variable, so every thread (and
+every stage of a pipeline, see stages.py) sees the settings of the course
+it works for. Settings missing from a course are shared by all courses.
+"""
+import types
+import contextlib
+import contextvars
+
+import settings
+
+
+# files keeping state between runs, every course needs its own copy
+STATE_FILE_SETTINGS = ('journal_file', 'completions_file', 'mail_sync_state_file')
+
+# (course name, overridden settings) of the current context
+_current = contextvars.ContextVar('course', default=None)
+
+
+class _CourseSettings(types.ModuleType):
+    """
+    Settings module with values overridden by the current course
+    """
+
+    def __getattribute__(self, name):
+        course = _current.get()
+        if course is not None and name in course[1]:
+            return course[1][name]
+        return super().__getattribute__(name)
+
+
+def get_courses():
+    """
+    Get courses defined in settings
+
+    :returns: list of course dicts, empty if settings.courses is not set
+    :raises ValueError: if a course has no name or courses share a state file
+    """
+    courses = list(getattr(settings, 'courses', None) or [])
+    names = set()
+    state_files = {}
+    for course in courses:
+        if not course.get('name'):
+            raise ValueError("Course name is missing: {}".format(course))
+        if course['name'] in names:
+            raise ValueError("Course '{}' is defined more than once".format(course['name']))
+        names.add(course['name'])
+        for key in STATE_FILE_SETTINGS:
+            path = course.get(key, getattr(settings, key, None))
+            other = state_files.setdefault((key, path), course['name'])
+            if other != course['name']:
+                raise ValueError("Courses '{}' and '{}' share the same {}. "
+                                 "Set a separate '{}' for every course.".format(other, course['name'], key, key))
+    return courses
+
+
+def current():
+    """
+    Get name of the course of the current context
+
+    :returns: course name or None outside of a course
+    """
+    course = _current.get()
+    return None if course is None else course[0]
+
+
+@contextlib.contextmanager
+def use(course):
+    """
+    Context manager making settings of a course current
+
+    :param course: course dict, see get_courses
+    """
+    if not isinstance(settings, _CourseSettings):
+        settings.__class__ = _CourseSettings
+    overrides = {key: value for key, value in course.items() if key != 'name'}
+    token = _current.set((course['name'], overrides))
+    try:
+        yield
+    finally:
+        _current.reset(token)
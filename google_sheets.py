@@ -1,15 +1,23 @@
 import settings
+import metrics
+import cassette
 
 import pickle
 import os.path
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import time
+import queue
+import threading
+import contextvars
 
 # If modifying these scopes, delete the file token.pickle.
 # We need write access to the spreadsheet: https://developers.google.com/sheets/api/guides/authorizing
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
+# Sheets API discovery document is cached locally, so that it is not
+# downloaded on every run. Delete the file to refresh it.
+DISCOVERY_CACHE_FILE = 'sheets_v4_discovery.json'
+DISCOVERY_URL = "https://sheets.googleapis.com/$discovery/rest?version=v4"
+
 
 # some predefined constants that describe data structure
 # need to move it out to settings
@@ -27,12 +35,31 @@ def colnum_string(n, zero_based=False):
     return string
 
 
+def string_colnum(string, zero_based=False):
+    """
+    Convert a column name (e.g. 'A', 'AB') to its number, reverse of colnum_string
+    """
+    n = 0
+    for c in string:
+        n = n * 26 + ord(c) - 64
+    if zero_based:
+        n -= 1
+    return n
+
+
 def get_spreadsheet_instance():
     """
     Performs authentication and creates a service.spreadsheets() instance
     
     :returns: service.spreadsheets() instance
     """
+    if cassette.replaying():
+        # calls are answered from the cassette, no credentials are needed
+        return cassette.wrap_sheets(None)
+    # Google API client libraries are slow to import, load them on demand
+    from googleapiclient.discovery import build_from_document
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
     creds = None
     # The file token.pickle stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -52,39 +79,62 @@ def get_spreadsheet_instance():
         with open('token.pickle', 'wb') as token:
             pickle.dump(creds, token)
 
-    service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
+    discovery_file = getattr(settings, 'google_discovery_cache_file', DISCOVERY_CACHE_FILE)
+    service = None
+    if os.path.exists(discovery_file):
+        try:
+            with open(discovery_file, 'r') as f:
+                service = build_from_document(f.read(), credentials=creds)
+        except Exception as e:
+            # truncated or corrupt cache, it is downloaded again
+            print("Discovery document cache '{}' is broken ({}), downloading it again".format(discovery_file, e))
+    if service is None:
+        import requests
+        res = requests.get(DISCOVERY_URL, timeout=settings.requests_timeout)
+        res.raise_for_status()
+        service = build_from_document(res.text, credentials=creds)
+        # written to a temporary file first, so that an interrupted write
+        # does not leave a truncated cache
+        tmp_file = discovery_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(res.text)
+        os.replace(tmp_file, discovery_file)
 
     # Call the Sheets API
     spreadsheet = service.spreadsheets()
-    return spreadsheet
+    return cassette.wrap_sheets(spreadsheet)
 
 
-def get_sheet_names(spreadsheet):
+def get_sheet_names(spreadsheet, spreadsheet_id=None):
     """
     Get all sheet names that are present on the spreadsheet
     
     :param spreadsheet: a service.spreadsheets() instance
+    :param spreadsheet_id: spreadsheet to be used instead of settings.google_spreadsheet_id
     :returns: list with sheet names
     """
     sheets = []
-    result = spreadsheet.get(spreadsheetId=settings.google_spreadsheet_id).execute()
+    with metrics.timer('sheets_request_duration_seconds', operation='get'):
+        result = spreadsheet.get(spreadsheetId=spreadsheet_id or settings.google_spreadsheet_id).execute()
     for s in result['sheets']:
         sheets.append(s.get('properties', {}).get('title'))
     return sheets
 
 
-def get_multiple_sheets_data(spreadsheet, sheets, dimension='COLUMNS'):
+def get_multiple_sheets_data(spreadsheet, sheets, dimension='COLUMNS', spreadsheet_id=None):
     """
     Get data from multiple sheets at once with a batchGet request
     
     :param spreadsheet: a service.spreadsheets() instance
     :param sheets: a list of sheet names for which the data is to be retrieved
     :param dimension: passed to spreadsheet.values().batchGet as a value of majorDimension param. Possible values are 'COLUMNS' or 'ROWS'
+    :param spreadsheet_id: spreadsheet to be used instead of settings.google_spreadsheet_id
     :returns: dict with sheet name as key and data as value
     """
     data = {}
-    request = spreadsheet.values().batchGet(spreadsheetId=settings.google_spreadsheet_id, ranges=sheets, majorDimension=dimension)
-    response = request.execute()
+    request = spreadsheet.values().batchGet(spreadsheetId=spreadsheet_id or settings.google_spreadsheet_id, ranges=sheets, majorDimension=dimension)
+    with metrics.timer('sheets_request_duration_seconds', operation='batchGet'):
+        response = request.execute()
     for i in range(0, len(response.get('valueRanges'))):
         data[sheets[i]] = response.get('valueRanges')[i].get('values')
     return data
@@ -159,20 +209,55 @@ def find_student_by_github(data, github, dimension='COLUMNS'):
     'github' and 'position' keys
     :raises ValueError: if student with such github account is not found in data
     """
-    position = None
-    student = {'group': None, 'github': github}
+    if dimension != 'COLUMNS':
+        raise ValueError("Not implemented! Only 'COLUMNS' dimension value is supported at the moment.")
+    found = _get_roster_index(data).get(github.lower())
+    if found is None:
+        raise ValueError("Student with GitHub account {} not found in any of the groups!".format(github))
+    group, position = found
+    return {
+        'group': group,
+        'github': github,
+        'name': data[group][STUDENT_NAME_COLUMN][position],
+        'position': position,
+    }
+
+
+# roster index of the last searched data: (data, {github: (group, position)})
+_roster_index = (None, None)
+
+
+def _get_roster_index(data):
+    """
+    Get an index of GitHub accounts of all students, so that a student can
+    be found without scanning all groups. The index is built once per data
+    object and rebuilt after GitHub accounts are changed.
+
+    :param data: dict with sheet name as key and data as value
+    :returns: dict with lowercase github account as key and tuple (group,
+    position) as value
+    """
+    global _roster_index
+    indexed_data, index = _roster_index
+    if indexed_data is data:
+        return index
+    index = {}
     for group in data:
-        student['group'] = group
         try:
-            position = find_student(data, student, searchby='github')
-        except ValueError as e:
-            position = None
-            pass
-        if position:
-            student['name'] = data[student['group']][STUDENT_NAME_COLUMN][position]
-            student['position'] = position
-            return student
-    raise ValueError("Student with GitHub account {} not found in any of the groups!".format(github))
+            github_column = _find_github_column(data, {'group': group})
+        except ValueError:
+            continue
+        for position, account in enumerate(data[group][github_column]):
+            # position 0 is the column header
+            if position > 0:
+                index.setdefault(account.lower(), (group, position))
+    _roster_index = (data, index)
+    return index
+
+
+def _invalidate_roster_index():
+    global _roster_index
+    _roster_index = (None, None)
 
 
 def get_student_task_id(data, student, dimension='COLUMNS'):
@@ -314,6 +399,7 @@ def set_student_github(data, student, dimension='COLUMNS', data_update=[]):
                 data[student['group']][github_column][i] if i < values_count else "" for i in range(0, student_position+1)
             ]
         data[student['group']][github_column][student_position] = student['github']
+        _invalidate_roster_index()
         data_update.append({
             'range': "{}!{}{}".format(student['group'], colnum_string(github_column, True), student_position+1),
             # 'majorDimension': dimension,
@@ -360,6 +446,36 @@ def set_student_lab_status(data, student, lab_id, value, dimension='COLUMNS', da
     return data_update
 
 
+def apply_update(data, update, dimension='COLUMNS'):
+    """
+    Apply a single pending update (as prepared for batchUpdate request) to
+    already loaded data, e.g. to replay updates from a journal
+
+    :param data: dict with sheet name as key and data as value
+    :param update: dict with 'range' and 'values' keys, range must point
+    to a single cell, e.g. "'4931'!C5"
+    :param dimension: how the data is stored, see spreadsheet.values().batchGet
+    :raises ValueError: if range is not a single cell on a known sheet
+    """
+    if dimension != 'COLUMNS':
+        raise ValueError("Not implemented! Only 'COLUMNS' dimension value is supported at the moment.")
+    sheet, _, cell = update['range'].rpartition('!')
+    column_name = cell.rstrip('0123456789')
+    row = cell[len(column_name):]
+    if sheet not in data or not column_name.isalpha() or not row.isdigit():
+        raise ValueError("Unable to apply update to range '{}'".format(update['range']))
+    column = string_colnum(column_name, True)
+    position = int(row) - 1
+    sheet_data = data[sheet]
+    while len(sheet_data) < column + 1:
+        sheet_data.append([])
+    values_count = len(sheet_data[column])
+    if values_count < position + 1:
+        sheet_data[column] = sheet_data[column] + [""] * (position + 1 - values_count)
+    sheet_data[column][position] = update['values'][0][0]
+    _invalidate_roster_index()
+
+
 def batch_update(spreadsheet, data_update):
     """
     Performs a batchUpdate query on a spreadsheet
@@ -370,13 +486,124 @@ def batch_update(spreadsheet, data_update):
         'valueInputOption': "RAW",
         'data': data_update
     }
-    result = spreadsheet.values().batchUpdate(
-        spreadsheetId=settings.google_spreadsheet_id, body=body).execute()
+    with metrics.timer('sheets_request_duration_seconds', operation='batchUpdate'):
+        result = spreadsheet.values().batchUpdate(
+            spreadsheetId=settings.google_spreadsheet_id, body=body).execute()
+    metrics.inc('sheets_updated_cells_total', result.get('totalUpdatedCells') or 0)
     print('{0} cells updated.'.format(result.get('totalUpdatedCells')))
     return result.get('totalUpdatedCells')
     # raise ValueError("Not implemented!")
 
 
+class BackgroundWriter:
+    """
+    Pushes pending data updates to the spreadsheet in a background thread
+    while grading continues
+
+    Accumulated updates are flushed every 'flush_every' updates or every
+    'flush_interval' seconds, whichever comes first. Batches are written by
+    a single thread strictly in submission order, so the last value
+    submitted for a cell is the one that ends up in the spreadsheet.
+    The spreadsheet instance must not be used by other threads until
+    the writer is closed.
+    """
+
+    def __init__(self, spreadsheet, flush_every=None, flush_interval=None):
+        """
+        :param spreadsheet: a service.spreadsheets() instance
+        :param flush_every: number of pending updates that triggers a flush
+        (None - not limited)
+        :param flush_interval: max number of seconds an update can stay pending
+        (None - not limited)
+        """
+        self.spreadsheet = spreadsheet
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.updated_cells = 0
+        self.expected_cells = 0
+        self._error = None
+        self._unflushed = []
+        self._queue = queue.Queue()
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run,), name="sheet-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, data_update):
+        """
+        Queue data updates for writing, does not block
+
+        :param data_update: a list of pending data updates prepared for
+        spreadsheets.values.batchUpdate request
+        """
+        if len(data_update) > 0:
+            self._queue.put(list(data_update))
+
+    def _flush(self, pending):
+        # several updates of the same cell within a batch are merged,
+        # the latest one wins
+        merged = {}
+        for update in pending:
+            merged.pop(update['range'], None)
+            merged[update['range']] = update
+        data_update = list(merged.values())
+        updated_cells = batch_update(self.spreadsheet, data_update)
+        self.updated_cells += updated_cells or 0
+        self.expected_cells += len(data_update)
+
+    def _run(self):
+        pending = []
+        last_flush = time.monotonic()
+        closing = False
+        while not closing:
+            timeout = None
+            if len(pending) > 0 and self.flush_interval is not None:
+                timeout = max(0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = []
+            if item is None:
+                closing = True
+            else:
+                pending.extend(item)
+            if len(pending) == 0:
+                continue
+            if (
+                closing
+                or (self.flush_every is not None and len(pending) >= self.flush_every)
+                or (self.flush_interval is not None and time.monotonic() - last_flush >= self.flush_interval)
+            ):
+                try:
+                    self._flush(pending)
+                except Exception as e:
+                    # keep pending updates, they are retried on the next flush
+                    print("Failed to write {} pending updates to the spreadsheet: {}".format(len(pending), e))
+                    self._error = e
+                else:
+                    pending = []
+                    self._error = None
+                last_flush = time.monotonic()
+        self._unflushed = pending
+
+    def close(self):
+        """
+        Flush all remaining updates and stop the writer thread
+
+        :returns: total number of updated cells
+        :raises ValueError: if some updates could not be written or the
+        number of updated cells differs from expected
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if len(self._unflushed) > 0:
+            raise ValueError("{} pending updates were not written to the spreadsheet! Last error: {}. Data update: {}".format(
+                len(self._unflushed), self._error, self._unflushed))
+        if self.updated_cells != self.expected_cells:
+            raise ValueError("Number of updated cells ({}) differs from expected ({})! Check the data manually.".format(
+                self.updated_cells, self.expected_cells))
+        return self.updated_cells
+
+
 # def stuff():
 #     values = result.get('values', [])
 #     if not values:
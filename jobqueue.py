@@ -0,0 +1,274 @@
+"""
+Durable queue of jobs shared by a coordinator and worker processes.
+
+The coordinator puts jobs (a kind and a JSON payload) into a SQLite
+database, workers claim them one at a time, run them and store results
+back, the coordinator waits for the results. A claimed job is leased to
+its worker for a limited time: if the worker dies, the lease expires and
+the job is claimed by another worker. Failed jobs (and jobs whose lease
+has expired) are retried a few times. Only the worker holding a job can
+store its result.
+
+SQLite locking makes the queue safe for any number of processes on one
+host. Workers on other hosts need the database on a shared file system
+that supports POSIX locks.
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+
+import settings
+
+
+DEFAULT_QUEUE_DB = "jobs.sqlite"
+# seconds a claimed job stays with its worker
+DEFAULT_LEASE = 600
+DEFAULT_MAX_ATTEMPTS = 3
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def default_worker_name(worker_id=0):
+    """
+    Make a worker name unique among hosts and processes
+    """
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), worker_id)
+
+
+class JobQueue:
+    """
+    SQLite backed job queue
+    """
+
+    def __init__(self, path=None, lease=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param path: database file name, defaults to settings.job_queue_db
+        :param lease: seconds a claimed job stays with its worker, defaults
+        to settings.job_lease
+        :param max_attempts: a job failed that many times is not retried
+        """
+        self.path = path or getattr(settings, 'job_queue_db', DEFAULT_QUEUE_DB)
+        self.lease = lease or getattr(settings, 'job_lease', DEFAULT_LEASE)
+        self.max_attempts = max_attempts
+        with self._connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    key TEXT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_until REAL,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+                CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+            """)
+
+    def _connect(self):
+        # a connection per call, so that the queue can be used from any
+        # thread; isolation_level=None: transactions are explicit
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return _Connection(db)
+
+    def put(self, kind, payload, key=None):
+        """
+        Add a job
+
+        :param kind: job kind, workers choose a function by it
+        :param payload: JSON serializable job arguments
+        :param key: job identity, if a pending or running job with the same
+        key exists, it is reused instead of adding a new one
+        :returns: job id
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            if key is not None:
+                row = db.execute(
+                    "SELECT id FROM jobs WHERE key = ? AND status IN (?, ?)",
+                    (key, PENDING, RUNNING)
+                ).fetchone()
+                if row is not None:
+                    db.execute("COMMIT")
+                    return row[0]
+            cursor = db.execute(
+                "INSERT INTO jobs (kind, key, payload, status, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(payload, ensure_ascii=False), PENDING, now, now)
+            )
+            db.execute("COMMIT")
+            return cursor.lastrowid
+
+    def claim(self, worker):
+        """
+        Take the oldest pending job (or a running job whose lease has
+        expired). Jobs whose lease has expired max_attempts times are
+        marked as failed, e.g. if they crash or hang every worker.
+
+        :param worker: worker name
+        :returns: tuple (job id, kind, payload) or None if there are no jobs
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            self._fail_expired(db, now)
+            row = db.execute(
+                "SELECT id, kind, payload FROM jobs "
+                "WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY id LIMIT 1",
+                (PENDING, RUNNING, now)
+            ).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute(
+                "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, lease_until = ?, updated = ? "
+                "WHERE id = ?",
+                (RUNNING, worker, now + self.lease, now, row[0])
+            )
+            db.execute("COMMIT")
+        return row[0], row[1], json.loads(row[2])
+
+    def _fail_expired(self, db, now):
+        """
+        Mark running jobs whose lease has expired max_attempts times as failed
+        """
+        db.execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated = ? "
+            "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+            (FAILED, "lease expired {} times".format(self.max_attempts), now, RUNNING, now, self.max_attempts)
+        )
+
+    def complete(self, job_id, result, worker):
+        """
+        Store result of a job
+
+        :param worker: name of the worker that has claimed the job
+        :returns: False if the job is not held by the worker any more (its
+        lease has expired and the job has been claimed by another worker
+        or has failed), the result is dropped then
+        """
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = ?, result = ?, lease_until = NULL, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (DONE, json.dumps(result, ensure_ascii=False), time.time(), job_id, worker, RUNNING)
+            )
+            return cursor.rowcount > 0
+
+    def fail(self, job_id, error, worker):
+        """
+        Mark a job as failed, it is retried unless it has failed too many
+        times already
+
+        :param worker: name of the worker that has claimed the job
+        :returns: False if the job is not held by the worker any more
+        """
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "error = ?, lease_until = NULL, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                (self.max_attempts, FAILED, PENDING, str(error), time.time(), job_id, worker, RUNNING)
+            )
+            return cursor.rowcount > 0
+
+    def release(self, job_id, worker):
+        """
+        Give a claimed job back to the queue without running it, e.g. if
+        the worker is interrupted
+
+        :param worker: name of the worker that has claimed the job
+        """
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, attempts = attempts - 1, lease_until = NULL, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (PENDING, time.time(), job_id, worker, RUNNING)
+            )
+
+    def wait(self, job_ids, poll_interval=0.5, progress_interval=60, timeout=None):
+        """
+        Wait for jobs to finish. Jobs whose lease has expired max_attempts
+        times are failed here as well, since no worker may be left to claim
+        them.
+
+        :param job_ids: ids of the jobs
+        :param poll_interval: seconds between checks
+        :param progress_interval: seconds between messages about jobs
+        still being waited for
+        :param timeout: if none of the jobs finishes for that many seconds
+        (e.g. no worker is running), the remaining jobs are failed. None -
+        wait forever
+        :returns: generator of tuples (job id, status, result or error
+        message) in the order jobs finish, status is DONE or FAILED
+        """
+        waiting = set(job_ids)
+        reported = finished = time.time()
+        while waiting:
+            ids = sorted(waiting)
+            rows = []
+            now = time.time()
+            with self._connect() as db:
+                db.execute("BEGIN IMMEDIATE")
+                self._fail_expired(db, now)
+                if timeout is not None and now - finished >= timeout:
+                    for i in range(0, len(ids), 500):
+                        chunk = ids[i:i + 500]
+                        db.execute(
+                            "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated = ? "
+                            "WHERE id IN ({}) AND status IN (?, ?)".format(",".join("?" * len(chunk))),
+                            [FAILED, "not finished within {} s".format(timeout), now] + chunk + [PENDING, RUNNING]
+                        )
+                db.execute("COMMIT")
+                # number of query parameters is limited
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    rows += db.execute(
+                        "SELECT id, status, result, error FROM jobs WHERE id IN ({}) AND status IN (?, ?)".format(
+                            ",".join("?" * len(chunk))),
+                        chunk + [DONE, FAILED]
+                    ).fetchall()
+            if rows:
+                finished = time.time()
+            for job_id, status, result, error in rows:
+                waiting.discard(job_id)
+                yield job_id, status, json.loads(result) if status == DONE else error
+            if waiting and not rows:
+                if time.time() - reported >= progress_interval:
+                    print("Waiting for {} jobs to be processed by workers...".format(len(waiting)))
+                    reported = time.time()
+                time.sleep(poll_interval)
+
+    def counts(self):
+        """
+        :returns: dict with job status as key and number of jobs as value
+        """
+        with self._connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class _Connection:
+    """
+    sqlite3 connection closed on exit from a with block
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        return self._db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._db.in_transaction:
+            self._db.execute("ROLLBACK")
+        self._db.close()
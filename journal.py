@@ -0,0 +1,137 @@
+"""
+Write-ahead journal of pending Google Sheets updates.
+
+Every pending write (an entry of ``data_update``) is appended to a local
+journal file as soon as it is produced, together with the inputs that
+produced it (lab, repository, head commit SHA and CI build ID). The
+journal is flushed and fsync'ed after every record, so if the process dies
+midway through a long sweep the already graded repositories can be
+replayed with ``main.py --resume`` instead of being fetched and graded
+again. The journal is removed once the batch update has been applied.
+"""
+import os
+import json
+import datetime
+import threading
+
+import settings
+
+
+DEFAULT_JOURNAL_FILE = "data_update.journal"
+
+
+class Journal:
+    """
+    Append-only journal of pending spreadsheet updates
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: journal file name, defaults to settings.journal_file
+        or 'data_update.journal'
+        """
+        self.path = path or getattr(settings, 'journal_file', DEFAULT_JOURNAL_FILE)
+        self._file = None
+        # (lab_id, repo) pairs that have been graded already
+        self._done = set()
+        # labs may be graded concurrently
+        self._lock = threading.Lock()
+
+    def exists(self):
+        """
+        Check if there is a journal left by a previous (unfinished) run
+        """
+        return os.path.exists(self.path)
+
+    def open(self, resume=False):
+        """
+        Open journal for writing
+
+        :param resume: keep records of a previous run if True,
+        start a new journal otherwise
+        :returns: list of journal entries to be replayed (empty unless resuming)
+        """
+        entries = self.read() if resume else []
+        for entry in entries:
+            if entry.get('repo') is not None:
+                self._done.add((entry.get('lab_id'), entry['repo']))
+        self._file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+        return entries
+
+    def read(self):
+        """
+        Read all complete records from the journal file
+
+        A partially written last record (the process was killed while
+        writing it) is ignored.
+
+        :returns: list of journal entries
+        """
+        entries = []
+        if not self.exists():
+            return entries
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.endswith('\n'):
+                    print("Journal record {} is incomplete and will be ignored".format(line_number))
+                    break
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    print("Journal record {} is corrupted and will be ignored".format(line_number))
+        return entries
+
+    def record(self, updates, lab_id=None, repo=None, head_sha=None, build_id=None, completion=None):
+        """
+        Durably append a record to the journal
+
+        :param updates: list of pending data updates (may be empty if a
+        repository was graded, but nothing has to be written)
+        :param lab_id: lab identifier the updates belong to (None for
+        updates produced by mailbox processing)
+        :param repo: repository name (with organization/owner prefix)
+        :param head_sha: SHA of the commit that has been graded
+        :param build_id: CI build identifier that has been graded
+        :param completion: completion info of an accepted lab, see
+        penalty.load_completions
+        """
+        if self._file is None:
+            raise ValueError("Internal error! Journal '{}' is not open.".format(self.path))
+        entry = {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'lab_id': lab_id,
+            'repo': repo,
+            'head_sha': head_sha,
+            'build_id': build_id,
+            'completion': completion,
+            'updates': updates,
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if repo is not None:
+                self._done.add((lab_id, repo))
+
+    def is_done(self, lab_id, repo):
+        """
+        Check if a repository has already been graded according to the journal
+
+        :param lab_id: lab identifier
+        :param repo: repository name (with organization/owner prefix)
+        :returns: True if there is a journal record for that repository
+        """
+        return (lab_id, repo) in self._done
+
+    def close(self, remove=False):
+        """
+        Close the journal
+
+        :param remove: delete journal file, i.e. all journaled updates have
+        been applied to the spreadsheet
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if remove and self.exists():
+            os.remove(self.path)
@@ -22,12 +22,19 @@ from email.message import EmailMessage
 
 import unicodedata
 
+import os
+import re
+import json
+import base64
+import quopri
 import datetime
+import collections
+from html.parser import HTMLParser
 
 # import html2text
-from bs4 import BeautifulSoup
 
 import settings
+import metrics
 
 
 
@@ -49,15 +56,55 @@ import settings
 #         return email_message_instance.get_payload()
 
 
-def get_imap_connection():
+def _instrument_imap(connection):
+    """
+    Record metrics of IMAP commands and received bytes of a connection
+    """
+    simple_command = connection._simple_command
+    read = connection.read
+    readline = connection.readline
+
+    def timed_command(name, *args):
+        # UID commands are told apart by their subcommand
+        command = "{} {}".format(name, args[0]).lower() if name == 'UID' and args else name.lower()
+        with metrics.timer('imap_command_duration_seconds', command=command) as status:
+            typ, data = simple_command(name, *args)
+            status['status'] = typ.lower()
+        return typ, data
+
+    def counted_read(size):
+        data = read(size)
+        metrics.inc('imap_received_bytes_total', len(data))
+        return data
+
+    def counted_readline():
+        line = readline()
+        metrics.inc('imap_received_bytes_total', len(line))
+        return line
+
+    connection._simple_command = timed_command
+    connection.read = counted_read
+    connection.readline = counted_readline
+
+
+def get_imap_connection(exit_on_failure=True):
     """
     Establish an IMAP connection
+
+    :param exit_on_failure: exit if login fails, raise imaplib.IMAP4.error otherwise
     """
-    connection = imaplib.IMAP4_SSL(settings.mail_imap_server, str(settings.mail_imap_port))
+    if getattr(settings, 'mail_imap_ssl', True):
+        connection = imaplib.IMAP4_SSL(settings.mail_imap_server, str(settings.mail_imap_port))
+    else:
+        # e.g. a local IMAP server for testing
+        connection = imaplib.IMAP4(settings.mail_imap_server, str(settings.mail_imap_port))
+    _instrument_imap(connection)
     try:
         rv, data = connection.login(settings.mail_login, settings.mail_password)
     except imaplib.IMAP4.error:
         print ("LOGIN FAILED!!! ")
+        if not exit_on_failure:
+            raise
         sys.exit(1)
     print(rv, data)
     rv, mailboxes = connection.list()
@@ -67,74 +114,496 @@ def get_imap_connection():
     return connection
 
 
-def process_students(imap_conn):
+DEFAULT_SYNC_STATE_FILE = "mailbox_state.json"
+
+# number of messages fetched with a single UID FETCH command
+FETCH_BATCH_SIZE = 50
+# only the beginning of a text part is fetched, registration emails are short
+TEXT_PART_MAX_SIZE = 65536
+HEADER_FIELDS = 'HEADER.FIELDS (FROM SUBJECT DATE)'
+# some mail clients send HTML as text/plain
+_HTML_IN_PLAIN_RE = re.compile(r'<(?:html|body|div|p|br|span|table)\b', re.IGNORECASE)
+
+_IMAP_TOKEN_RE = re.compile(
+    rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[]+(?:\[[^\]]*\])?(?:<\d+>)?))'
+)
+
+
+def _split_fetch_response(data):
+    """
+    Split data returned by imaplib for a FETCH command into per-message
+    chunks. A chunk is a tuple of response text and a literal that follows
+    it (None if there is no literal).
+    """
+    messages = []
+    continuation = False
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            text = re.sub(rb'\{\d+\}$', b'', item[0])
+            chunk = (text, item[1])
+        else:
+            chunk = (item, None)
+        if continuation:
+            messages[-1].append(chunk)
+        else:
+            messages.append([chunk])
+        # after a literal imaplib returns the rest of the response line
+        # as a separate item
+        continuation = isinstance(item, tuple)
+    return messages
+
+
+def _parse_imap_response(chunks):
+    """
+    Parse an IMAP response into nested lists. Atoms, strings and literals
+    are returned as bytes, NIL as None.
+    """
+    stack = [[]]
+    for text, literal in chunks:
+        position = 0
+        while position < len(text):
+            match = _IMAP_TOKEN_RE.match(text, position)
+            if match is None or match.end() == position:
+                break
+            position = match.end()
+            opening, closing, quoted, atom = match.groups()
+            if opening:
+                stack.append([])
+            elif closing:
+                if len(stack) > 1:
+                    nested = stack.pop()
+                    stack[-1].append(nested)
+            elif quoted is not None:
+                stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted))
+            elif atom is not None:
+                stack[-1].append(None if atom.upper() == b'NIL' else atom)
+        if literal is not None:
+            stack[-1].append(literal)
+    while len(stack) > 1:
+        nested = stack.pop()
+        stack[-1].append(nested)
+    return stack[0]
+
+
+def _parse_fetch_response(data):
+    """
+    Parse data returned by imaplib for a UID FETCH command
+
+    :returns: dict with uid (bytes) as key and dict of fetched data items
+    (upper case item name as key) as value
+    """
+    result = {}
+    for chunks in _split_fetch_response(data):
+        response = _parse_imap_response(chunks)
+        if len(response) < 2 or not isinstance(response[1], list):
+            continue
+        items = response[1]
+        values = {}
+        for i in range(0, len(items) - 1, 2):
+            if isinstance(items[i], bytes):
+                values[items[i].decode('ascii', 'replace').upper()] = items[i + 1]
+        if 'UID' in values:
+            result[values['UID']] = values
+    return result
+
+
+def _find_text_parts(structure, section=''):
+    """
+    Find all inline text parts of a message described by BODYSTRUCTURE
+
+    :returns: list of (section, subtype, encoding, charset) tuples
+    """
+    if len(structure) > 0 and isinstance(structure[0], list):
+        # multipart: child parts followed by the multipart subtype
+        parts = []
+        for i, child in enumerate(structure):
+            if not isinstance(child, list):
+                break
+            parts += _find_text_parts(child, "{}{}.".format(section, i + 1) if section else "{}.".format(i + 1))
+        return parts
+    if len(structure) < 6 or not isinstance(structure[0], bytes) or structure[0].lower() != b'text':
+        return []
+    # text part: type, subtype, params, id, description, encoding, size,
+    # lines, md5, disposition, ...
+    if len(structure) > 9 and isinstance(structure[9], list) and structure[9] \
+            and isinstance(structure[9][0], bytes) and structure[9][0].lower() == b'attachment':
+        return []
+    params = structure[2] if isinstance(structure[2], list) else []
+    charset = None
+    for i in range(0, len(params) - 1, 2):
+        if isinstance(params[i], bytes) and params[i].lower() == b'charset' and params[i + 1]:
+            charset = params[i + 1].decode('ascii', 'replace')
+    return [(
+        (section or '1.').rstrip('.'),
+        (structure[1] or b'plain').decode('ascii', 'replace').lower(),
+        (structure[5] or b'7bit').decode('ascii', 'replace').lower(),
+        charset,
+    )]
+
+
+def _decode_part(payload, encoding, charset):
+    """
+    Decode (possibly truncated) payload of a message part to text
+    """
+    if encoding == 'base64':
+        payload = re.sub(rb'[^A-Za-z0-9+/=]', b'', payload)
+        payload = base64.b64decode(payload[:len(payload) - len(payload) % 4])
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+def _fetch_item(values, name, prefix=False):
     """
-    Do something with emails messages in the folder.  
-    For the sake of this example, print some headers.
+    Get a fetched data item by name ignoring case and the partial fetch
+    suffix
+
+    :param prefix: match any item whose name starts with name, e.g.
+    'BODY[HEADER.FIELDS' for header fields echoed in any order
+    """
+    name = name.upper()
+    for key, value in values.items():
+        key = key.upper()
+        if key == name or key.startswith(name + '<') or prefix and key.startswith(name):
+            return value
+    return None
+
+
+class _EnoughChunks(Exception):
+    pass
+
+
+def _append_chunks(chunks, text, limit=None):
+    """
+    Split text into lines and phrases (separated by double spaces) and append
+    non-empty ones to chunks
+
+    :raises _EnoughChunks: if the number of chunks has reached the limit
     """
-    rv, data = imap_conn.select("INBOX")
+    for line in text.splitlines():
+        for phrase in line.split("  "):
+            phrase = phrase.strip()
+            if phrase:
+                chunks.append(phrase)
+                if limit is not None and len(chunks) >= limit:
+                    raise _EnoughChunks()
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """
+    Streaming HTML tag stripper, collects text chunks outside of
+    script and style elements
+    """
+
+    def __init__(self, limit=None):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.limit = limit
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self._skip_depth > 0:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if self._skip_depth == 0:
+            _append_chunks(self.chunks, data, self.limit)
+
+
+def _extract_plain_chunks(text, limit=None):
+    """
+    Extract text chunks from a text/plain body in a single pass
+    """
+    chunks = []
+    try:
+        _append_chunks(chunks, text, limit)
+    except _EnoughChunks:
+        pass
+    return chunks
+
+
+def _extract_html_chunks(text, limit=None):
+    """
+    Extract text chunks from a text/html body with a streaming tag stripper
+    """
+    parser = _HTMLTextExtractor(limit)
+    try:
+        parser.feed(text)
+        parser.close()
+    except _EnoughChunks:
+        pass
+    return parser.chunks
+
+
+def _extract_soup_chunks(text, limit=None):
+    """
+    Extract text chunks from an email body with BeautifulSoup
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(text, features="lxml")
+    # kill all script and style elements
+    for script in soup(["script", "style"]):
+        script.extract()    # rip it out
+    # get text
+    text = soup.get_text(separator='\n')
+    # break into lines and remove leading and trailing space on each
+    lines = (line.strip() for line in text.splitlines())
+    # break multi-headlines into a line each
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    # drop blank lines
+    text_chunks = [chunk for chunk in chunks if chunk]
+    return text_chunks[:limit] if limit is not None else text_chunks
+
+
+def _extract_text_chunks(text, subtype='plain', limit=None):
+    """
+    Extract non-empty text chunks (lines and phrases) from an email body.
+    Plain text is split directly, HTML goes through a lightweight tag
+    stripper, BeautifulSoup is only used if the latter fails.
+
+    :param text: email body
+    :param subtype: body content subtype, 'plain' or 'html'
+    :param limit: stop after this many chunks have been extracted
+    :returns: list of text chunks
+    """
+    if subtype == 'plain' and not _HTML_IN_PLAIN_RE.search(text):
+        return _extract_plain_chunks(text, limit)
+    try:
+        return _extract_html_chunks(text, limit)
+    except Exception as e:
+        print("Unable to strip HTML tags ({}), falling back to BeautifulSoup".format(e))
+    return _extract_soup_chunks(text, limit)
+
+
+def _fetch_messages(imap_conn, uids):
+    """
+    Fetch headers and the first text part of a batch of messages without
+    setting the \\Seen flag
+
+    :param imap_conn: connection object with a selected mailbox
+    :param uids: list of message uids
+    :returns: dict with uid as key and tuple (headers message, body text,
+    body subtype) as value
+    """
+    uid_set = b','.join(uids)
+    rv, data = imap_conn.uid('fetch', uid_set, '(UID BODYSTRUCTURE BODY.PEEK[{}])'.format(HEADER_FIELDS))
     if rv != 'OK':
-        print("ERROR: Unable to open mailbox ", rv)
+        print("ERROR getting messages {}".format(uid_set))
+        return {}
+    headers = {}
+    text_parts = {}
+    for uid, values in _parse_fetch_response(data).items():
+        # servers may echo the field list in another case or order
+        header_bytes = _fetch_item(values, 'BODY[HEADER.FIELDS', prefix=True) or b''
+        headers[uid] = BytesParser(policy=policy.default).parsebytes(header_bytes, headersonly=True)
+        structure = values.get('BODYSTRUCTURE')
+        parts = _find_text_parts(structure) if isinstance(structure, list) else []
+        plain = [p for p in parts if p[1] == 'plain']
+        text_parts[uid] = plain[0] if plain else (parts[0] if parts else None)
+    # fetch text parts, messages with the same part section are fetched at once
+    bodies = {}
+    sections = collections.defaultdict(list)
+    for uid, part in text_parts.items():
+        if part is not None:
+            sections[part[0]].append(uid)
+    for section, section_uids in sections.items():
+        rv, data = imap_conn.uid(
+            'fetch', b','.join(section_uids),
+            '(UID BODY.PEEK[{}]<0.{}>)'.format(section, TEXT_PART_MAX_SIZE)
+        )
+        if rv != 'OK':
+            print("ERROR getting part {} of messages {}".format(section, b','.join(section_uids)))
+            continue
+        for uid, values in _parse_fetch_response(data).items():
+            payload = _fetch_item(values, 'BODY[{}]'.format(section))
+            if uid in text_parts and payload is not None:
+                _, subtype, encoding, charset = text_parts[uid]
+                bodies[uid] = (_decode_part(payload, encoding, charset), subtype)
+    # messages with an unusual structure are fetched completely
+    for uid in headers:
+        if uid in bodies:
+            continue
+        rv, data = imap_conn.uid('fetch', uid, '(UID BODY.PEEK[])')
+        values = _parse_fetch_response(data).get(uid, {}) if rv == 'OK' else {}
+        raw_message = _fetch_item(values, 'BODY[]')
+        if raw_message is None:
+            print("ERROR getting message {}".format(uid))
+            continue
+        msg = BytesParser(policy=policy.default).parsebytes(raw_message)
+        simplest = msg.get_body(preferencelist=('plain', 'html'))
+        if simplest is not None:
+            bodies[uid] = (simplest.get_content(), simplest.get_content_subtype())
+    return {uid: (headers[uid],) + bodies[uid] for uid in uids if uid in headers and uid in bodies}
+
+
+def load_sync_state(path=None):
+    """
+    Load mailbox synchronization state (UIDVALIDITY, last processed UID,
+    HIGHESTMODSEQ, UIDs of messages to retry and of messages already
+    answered per folder)
+
+    :param path: state file name, defaults to settings.mail_sync_state_file
+    :returns: dict with folder name as key and folder state as value
+    """
+    path = path or getattr(settings, 'mail_sync_state_file', DEFAULT_SYNC_STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
 
-    # rv, data = M.search(None, "ALL")
-    # rv, data = M.uid('search', None, "ALL")
-    rv, data = imap_conn.uid('search', None, "(UNSEEN)")
+def save_sync_state(state, path=None):
+    """
+    Save mailbox synchronization state, see load_sync_state
+    """
+    path = path or getattr(settings, 'mail_sync_state_file', DEFAULT_SYNC_STATE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _response_number(imap_conn, name):
+    """
+    Get a numeric response code (e.g. UIDVALIDITY) returned by the server
+    """
+    _, data = imap_conn.response(name)
+    if data and data[-1] is not None:
+        try:
+            return int(data[-1])
+        except ValueError:
+            return None
+    return None
+
+
+def _search_new_messages(imap_conn, sync_state, folder="INBOX"):
+    """
+    Select a folder and find uids of new messages
+
+    Without sync_state new messages are the unseen ones. With sync_state
+    only messages with UID above the last processed one are new, and if
+    UIDNEXT (or HIGHESTMODSEQ when the server supports CONDSTORE) shows
+    that nothing has arrived since the last run, the folder is not
+    searched at all. Messages that could not be fetched last time (see
+    process_students) are returned again while they exist. Messages
+    answered by a run that failed afterwards (see save_answered_uids) stay
+    in the state until the last processed UID passes them. sync_state is
+    updated in place.
+
+    :returns: list of uids or None on error
+    """
+    condstore = sync_state is not None and 'CONDSTORE' in imap_conn.capabilities
+    rv, data = imap_conn.select(folder + " (CONDSTORE)" if condstore else folder)
     if rv != 'OK':
+        print("ERROR: Unable to open mailbox ", rv)
+    if sync_state is None:
+        # rv, data = M.search(None, "ALL")
+        # rv, data = M.uid('search', None, "ALL")
+        rv, data = imap_conn.uid('search', None, "(UNSEEN)")
+        return data[0].split() if rv == 'OK' else None
+    uidvalidity = _response_number(imap_conn, 'UIDVALIDITY')
+    uidnext = _response_number(imap_conn, 'UIDNEXT')
+    highestmodseq = _response_number(imap_conn, 'HIGHESTMODSEQ') if condstore else None
+    folder_state = sync_state.get(folder)
+    if folder_state is None or folder_state.get('uidvalidity') != uidvalidity:
+        # first run or the folder was recreated: fall back to unseen messages
+        print("No valid synchronization state for folder {}, processing unseen messages".format(folder))
+        rv, data = imap_conn.uid('search', None, "(UNSEEN)")
+        if rv != 'OK':
+            return None
+        uids = data[0].split()
+        last_uid = uidnext - 1 if uidnext else 0
+        retry_uids = []
+        answered_uids = []
+    elif (uidnext is not None and uidnext <= folder_state['last_uid'] + 1) or \
+            (highestmodseq is not None and folder_state.get('highestmodseq') == highestmodseq):
+        # no messages have arrived since the last run
+        uids = []
+        last_uid = folder_state['last_uid']
+        retry_uids = folder_state.get('retry_uids', [])
+        answered_uids = [uid for uid in folder_state.get('answered_uids', []) if uid > last_uid]
+    else:
+        last_uid = folder_state['last_uid']
+        rv, data = imap_conn.uid('search', None, "UID {}:*".format(last_uid + 1))
+        if rv != 'OK':
+            return None
+        # n:* always matches the last message, even if its uid is below n
+        uids = [uid for uid in data[0].split() if int(uid) > last_uid]
+        retry_uids = folder_state.get('retry_uids', [])
+        answered_uids = [uid for uid in folder_state.get('answered_uids', []) if uid > last_uid]
+    if len(retry_uids) > 0:
+        # messages deleted in the meantime are not found
+        rv, data = imap_conn.uid('search', None, "UID {}".format(_uid_set(retry_uids).decode()))
+        if rv != 'OK':
+            return None
+        uids = [uid for uid in data[0].split() if int(uid) in retry_uids] + uids
+    if len(uids) > 0:
+        last_uid = max(last_uid, max(int(uid) for uid in uids))
+    sync_state[folder] = {
+        'uidvalidity': uidvalidity,
+        'last_uid': last_uid,
+        'highestmodseq': highestmodseq,
+        'retry_uids': retry_uids,
+        'answered_uids': answered_uids,
+    }
+    return uids
+
+
+def process_students(imap_conn, sync_state=None, mark_seen=True):
+    """
+    Extract student info from new email messages in INBOX.
+
+    Messages are fetched in batches, only the headers and the first text
+    part of every message are downloaded. Successfully parsed messages
+    are marked as seen.
+
+    :param imap_conn: connection object
+    :param sync_state: mailbox synchronization state (see load_sync_state),
+    updated in place. If None, unseen messages are processed. Messages
+    that could not be fetched are kept in the state and retried next time
+    :param mark_seen: mark successfully parsed messages as seen
+    :returns: list of dicts with student info
+    """
+    uids = _search_new_messages(imap_conn, sync_state)
+    if uids is None:
         print("No messages found!")
-        return
+        return []
     
     # list of students
     students = []
+    parsed_uids = []
+    # messages that could not be fetched
+    failed_uids = []
     
-    for uid in data[0].split():
-        # rv, data = M.fetch(num, '(RFC822)')
-        rv, data = imap_conn.uid('fetch', uid, '(RFC822)')
-        if rv != 'OK':
-            print("ERROR getting message {}".format(uid))
-            return
-        
-        # see https://docs.python.org/3/library/email.examples.html for an email processing example
-        msg = BytesParser(policy=policy.default).parsebytes(data[0][1])
-        # msg = email.message_from_bytes(data[0][1], policy=policy.default)
-        # hdr = email.header.make_header(email.header.decode_header(msg['Subject']))
-        # subject = str(hdr)
-        subject = msg['subject']
-        print('Message {}: {}'.format(uid, subject))
-        print('Raw Date: {}'.format(msg['Date']))
-        # Now convert to local date-time
-        date_tuple = email.utils.parsedate_tz(msg['Date'])
-        if date_tuple:
-            local_date = datetime.datetime.fromtimestamp(
-                email.utils.mktime_tz(date_tuple))
-            print ("Local Date:", \
-                local_date.strftime("%a, %d %b %Y %H:%M:%S"))
-        # print(get_first_text_block(msg))
-        # bodytext = msg.get_content()
-        # print(bodytext)
-        # If we want to print a preview of the message content, we can extract whatever
-        # the least formatted payload is and print the first three lines.  Of course,
-        # if the message has no plain text part printing the first three lines of html
-        # is probably useless, but this is just a conceptual example.
-        simplest = msg.get_body(preferencelist=('plain', 'html'))
-        simplest_text = ''.join(simplest.get_content().splitlines(keepends=True))
-        # print(simplest_text)
-        
-        # print(html2text.html2text(simplest_text))
-        if True:
-            soup = BeautifulSoup(simplest_text, features="lxml")
-            # kill all script and style elements
-            for script in soup(["script", "style"]):
-                script.extract()    # rip it out
-            # get text
-            text = soup.get_text(separator='\n')
-            # break into lines and remove leading and trailing space on each
-            lines = (line.strip() for line in text.splitlines())
-            # break multi-headlines into a line each
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            # drop blank lines
-            text_chunks = [chunk for chunk in chunks if chunk]
-            text = '\n'.join(text_chunks)
-            # print(text)
+    for batch_start in range(0, len(uids), FETCH_BATCH_SIZE):
+        batch = uids[batch_start:batch_start + FETCH_BATCH_SIZE]
+        messages = _fetch_messages(imap_conn, batch)
+        for uid in batch:
+            if uid not in messages:
+                failed_uids.append(uid)
+                continue
+            msg, body, subtype = messages[uid]
+            subject = msg['subject']
+            print('Message {}: {}'.format(uid, subject))
+            print('Raw Date: {}'.format(msg['Date']))
+            # Now convert to local date-time
+            date_tuple = email.utils.parsedate_tz(msg['Date'])
+            if date_tuple:
+                local_date = datetime.datetime.fromtimestamp(
+                    email.utils.mktime_tz(date_tuple))
+                print ("Local Date:", \
+                    local_date.strftime("%a, %d %b %Y %H:%M:%S"))
+            # only the first 3 chunks are used
+            text_chunks = _extract_text_chunks(body, subtype, limit=3)
             if len(text_chunks) >= 3:
                 print("Group: {}".format(text_chunks[0]))
                 print("Name: {}".format(text_chunks[1]))
@@ -155,28 +624,95 @@ def process_students(imap_conn):
                     'email': msg['from'],
                     'uid': uid
                 })
+                parsed_uids.append(uid)
             else:
                 print("Error! Unable to parse email body. There should be at least 3 lines of text in the email.")
-        # print(msg.keys())
-        print("")
+            print("")
+    # messages are fetched with BODY.PEEK, mark the parsed ones as seen
+    if mark_seen and len(parsed_uids) > 0:
+        imap_conn.uid('STORE', b','.join(parsed_uids), '+FLAGS', '(\\Seen)')
+    if sync_state is not None:
+        sync_state["INBOX"]['retry_uids'] = [int(uid) for uid in failed_uids]
     return students
 
 
+def answered_uids(sync_state, folder="INBOX"):
+    """
+    :returns: set of uids of messages that were answered with an error
+    report by an earlier run, see save_answered_uids
+    """
+    return set(sync_state.get(folder, {}).get('answered_uids', []))
+
+
+def save_answered_uids(sync_state, uids, path=None, folder="INBOX"):
+    """
+    Record messages answered with an error report in the saved state
+    without moving its last processed UID. A run that fails after the
+    reports are sent processes the messages again next time, the reports
+    are not sent twice.
+
+    :param sync_state: synchronization state of the run, updated in place
+    :param uids: uids of the answered messages
+    :param path: state file name, defaults to settings.mail_sync_state_file
+    """
+    if not uids:
+        return
+    folder_state = sync_state[folder]
+    folder_state['answered_uids'] = sorted(set(folder_state.get('answered_uids', [])) | {int(uid) for uid in uids})
+    saved_state = load_sync_state(path)
+    saved_folder_state = saved_state.get(folder)
+    # without a saved state the answered messages are not processed again,
+    # they are marked as seen
+    if saved_folder_state is None or saved_folder_state.get('uidvalidity') != folder_state['uidvalidity']:
+        return
+    saved_folder_state['answered_uids'] = folder_state['answered_uids']
+    save_sync_state(saved_state, path)
+
+
+def _uid_set(uids):
+    """
+    Convert a list of uids to an IMAP uid set, e.g. b'3,5,8'
+    """
+    if isinstance(uids, (list, tuple, set)):
+        return b','.join(u if isinstance(u, bytes) else str(u).encode() for u in uids)
+    return uids
+
+
 def mark_unread(imap_connection, uid):
     """
     mark an email as unread
     
     :param imap_connection: connection object
-    :param uid: uid of an email
+    :param uid: uid of an email or a list of uids, all emails from
+    the list are updated with a single command
     """
-    imap_connection.uid('STORE', uid, '-FLAGS', '(\Seen)')
+    if not uid:
+        return
+    imap_connection.uid('STORE', _uid_set(uid), '-FLAGS', '(\Seen)')
+
+
+def mark_seen(imap_connection, uid):
+    """
+    mark an email as seen
+
+    :param imap_connection: connection object
+    :param uid: uid of an email or a list of uids
+    """
+    if not uid:
+        return
+    imap_connection.uid('STORE', _uid_set(uid), '+FLAGS', '(\Seen)')
 
 
 def mark_flagged(imap_connection, uid):
     """
     mark an email as flagged
+
+    :param imap_connection: connection object
+    :param uid: uid of an email or a list of uids
     """
-    imap_connection.uid('STORE', uid, '+FLAGS', '(\Flagged)')
+    if not uid:
+        return
+    imap_connection.uid('STORE', _uid_set(uid), '+FLAGS', '(\Flagged)')
 
 
 # M = imaplib.IMAP4_SSL(settings.mail_imap_server, str(settings.mail_imap_port))
@@ -210,29 +746,127 @@ def mark_flagged(imap_connection, uid):
 # M.logout()
 
 
-def send_email(toaddrs, subject, message):
+def _get_smtp_connection():
     """
-    send an email
-    
-    :param toaddrs: list of recepients
-    :param subject: email subject
-    :param message: email body text
+    Establish an authenticated SMTP connection
+    """
+    with metrics.timer('smtp_command_duration_seconds', command='connect'):
+        server = smtplib.SMTP_SSL(settings.mail_smtp_server, settings.mail_smtp_port)
+        server.ehlo()
+        server.login(settings.mail_login, settings.mail_password)
+    return server
+
+
+def _build_email(toaddrs, subject, message):
+    """
+    Build an email message from the return address
     """
-    server = smtplib.SMTP_SSL(settings.mail_smtp_server, settings.mail_smtp_port)
-    server.ehlo()
-    server.login(settings.mail_login, settings.mail_password)
-    # server.sendmail('k43guap@ya.ru', 'k43guap@ya.ru', 'From: k43guap@ya.ru\nTo:k43guap@ya.ru\nSubject: test\n\nHello, world!')
     msg = EmailMessage()
     msg['From'] = settings.mail_return_address
     msg['To'] = ','.join(toaddrs)
     msg['Subject'] = subject
     msg.set_content(message)
+    return msg
+
+
+def _send_message(server, msg):
     # server.send_message(msg)
     # server.send_message(msg, from_addr=settings.mail_return_address, to_addrs=toaddrs)
-    server.send_message(msg, from_addr=msg['from'], to_addrs=[a.addr_spec for a in msg['to'].addresses])
+    with metrics.timer('smtp_command_duration_seconds', command='send'):
+        server.send_message(msg, from_addr=msg['from'], to_addrs=[a.addr_spec for a in msg['to'].addresses])
+    metrics.inc('smtp_sent_bytes_total', len(msg.as_bytes()))
+
+
+def send_email(toaddrs, subject, message):
+    """
+    send an email
+    
+    :param toaddrs: list of recepients
+    :param subject: email subject
+    :param message: email body text
+    """
+    server = _get_smtp_connection()
+    # server.sendmail('k43guap@ya.ru', 'k43guap@ya.ru', 'From: k43guap@ya.ru\nTo:k43guap@ya.ru\nSubject: test\n\nHello, world!')
+    _send_message(server, _build_email(toaddrs, subject, message))
     server.quit()
 
 
+class MailQueue:
+    """
+    Outgoing email queue. Queued emails are sent at once over a single
+    authenticated SMTP connection, which is re-established if it fails.
+    """
+
+    def __init__(self, dry_run=False, keep_connection=False):
+        """
+        :param dry_run: do not send anything, just print emails to console
+        :param keep_connection: keep SMTP connection open after the queue
+        has been sent, so that it can be reused by the next send_all call
+        """
+        self.dry_run = dry_run
+        self.keep_connection = keep_connection
+        self.messages = []
+        self._server = None
+
+    def add(self, toaddrs, subject, message):
+        """
+        queue an email, see send_email
+        """
+        self.messages.append((toaddrs, subject, message))
+
+    def _send(self, msg, retries):
+        for attempt in range(retries + 1):
+            try:
+                if self._server is None:
+                    self._server = _get_smtp_connection()
+                _send_message(self._server, msg)
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, OSError) as e:
+                print("SMTP error while sending email to {}: {}".format(msg['to'], e))
+                self._close()
+                if attempt == retries:
+                    raise
+
+    def _close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+    def send_all(self, retries=2):
+        """
+        send all queued emails
+
+        :param retries: how many times to reconnect and retry sending an
+        email after an SMTP failure
+        :returns: number of emails sent
+        """
+        sent = 0
+        try:
+            while len(self.messages) > 0:
+                toaddrs, subject, message = self.messages[0]
+                if self.dry_run:
+                    print("An email would have been sent to {}. Subject: {}. Text: {}".format(toaddrs, subject, message))
+                else:
+                    self._send(_build_email(toaddrs, subject, message), retries)
+                    sent += 1
+                self.messages.pop(0)
+        except BaseException:
+            self._close()
+            raise
+        if not self.keep_connection:
+            self._close()
+        return sent
+
+    def close(self):
+        """
+        close SMTP connection kept open by send_all
+        """
+        self._close()
+
+
 def main():
     # connection = get_imap_connection()
     # rv, data = connection.select("INBOX")
@@ -1,23 +1,82 @@
 #!/usr/bin/env python3
 
+import time
+# process start time, used by --profile-startup
+_STARTUP_TIME = time.perf_counter()
+
 import mailbox
 import google_sheets
 import common
+import journal
+import submissions
+import winnow
+import minhash
+import moss_report
+import stages
+import courses
+import jobqueue
+import metrics
+import profiling
+import cassette
+import report
+import penalty
+import planner
+import watcher
 import settings
 import datetime
-from dateutil.parser import isoparse, parse
-import math
 import logging
 import logging.config
 import yaml
 import sys
 import os
 import argparse
+import subprocess
+import copy
+import imaplib
+import signal
+import importlib
+import contextlib
+import threading
+import concurrent.futures
 
 import collections
+import collections.abc
+
+# heavy dependencies (mosspy, mossum, dateutil, Google API client,
+# BeautifulSoup) are imported by the functions that need them, so that
+# an action only pays for the subsystems it actually uses
+
+# startup stages timings, see --profile-startup
+_startup_timings = []
+
+DEFAULT_DAEMON_INTERVAL = 300
+# seconds between job queue checks of an idle worker
+WORKER_POLL_INTERVAL = 1.0
+# repositories graded (and journaled) at once, their penalties are
+# evaluated in one call
+GRADE_CHUNK_SIZE = 8
+
 
-import mosspy
-from mossum import mossum
+@contextlib.contextmanager
+def _startup_stage(name):
+    """
+    Measure time spent on a startup stage (imports, connections, etc.)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _startup_timings.append((name, time.perf_counter() - start))
+
+
+def _print_startup_profile():
+    """
+    Print a report of time spent on startup stages
+    """
+    print("Startup profile:")
+    for name, seconds in _startup_timings:
+        print("  {:<40} {:8.3f} s".format(name, seconds))
+    print("  {:<40} {:8.3f} s".format("total", sum(seconds for _, seconds in _startup_timings)))
 
 
 # setup logging
@@ -50,9 +109,13 @@ def _parse_args():
     parser.add_argument(
         '-a', '--action', dest='action',
         action='store', default='update',
-        choices=['update', 'moss'],
+        choices=['update', 'moss', 'report', 'recompute', 'watch', 'worker'],
         help="action to be taken: "
-        "check for UPDATEs, run MOSS plagiarism check",
+        "check for UPDATEs, run MOSS plagiarism check, "
+        "print grade statistics REPORT, RECOMPUTE penalties "
+        "after a deadline has been moved, WATCH mailbox and register "
+        "students as soon as their emails arrive, run a WORKER "
+        "evaluating repositories queued by update runs",
     )
     parser.add_argument(
         '-l', '--labs', dest='labs',
@@ -70,6 +133,145 @@ def _parse_args():
         help="do not update any real data, do not send any emails "
         "or save any results, just print to console",
     )
+    parser.add_argument(
+        '--resume', dest='resume',
+        action='store_true',
+        help="replay pending updates from the journal of an unfinished "
+        "run and continue grading from the last graded repository",
+    )
+    parser.add_argument(
+        '--offline', dest='offline',
+        action='store_true',
+        help="--action moss: compare submissions locally instead of "
+        "sending them to MOSS server",
+    )
+    parser.add_argument(
+        '--history', dest='history',
+        action='store_true',
+        help="--action moss: also compare submissions with similar "
+        "submissions of previous runs",
+    )
+    parser.add_argument(
+        '--daemon', dest='daemon',
+        action='store_true',
+        help="--action update: keep running and check for updates every "
+        "--interval seconds, connections and caches are kept between "
+        "runs, send SIGHUP to reload settings",
+    )
+    parser.add_argument(
+        '--interval', dest='interval',
+        action='store', type=int,
+        default=getattr(settings, 'daemon_interval', DEFAULT_DAEMON_INTERVAL),
+        help="--daemon: seconds between the starts of two runs",
+    )
+    parser.add_argument(
+        '--queue', dest='queue',
+        action='store_true',
+        help="--action update: put repositories to the job queue to be "
+        "evaluated by workers (--action worker) instead of evaluating "
+        "them in this process",
+    )
+    parser.add_argument(
+        '--workers', dest='workers',
+        action='store', type=int, default=0,
+        help="--action update: start N local workers for the run, "
+        "implies --queue",
+    )
+    parser.add_argument(
+        '--worker-id', dest='worker_id',
+        action='store', type=int, default=0,
+        help="--action worker: worker number, chooses a token from "
+        "settings.worker_github_tokens",
+    )
+    parser.add_argument(
+        '--plan', dest='plan',
+        action='store_true',
+        help="--action update: print GitHub, Travis and AppVeyor requests "
+        "the run would make (and the GitHub rate limit) without grading",
+    )
+    parser.add_argument(
+        '--max-requests', dest='max_requests',
+        action='store', type=int,
+        default=getattr(settings, 'max_requests', None),
+        help="--action update: make at most N API requests per course "
+        "run, repositories not graded yet and pushed recently go first, "
+        "the rest are deferred to the next run",
+    )
+    parser.add_argument(
+        '--metrics-file', dest='metrics_file',
+        action='store', default=getattr(settings, 'metrics_file', None),
+        help="save metrics in Prometheus text format to this file "
+        "at the end of every update run",
+    )
+    parser.add_argument(
+        '--metrics-port', dest='metrics_port',
+        action='store', type=int, default=getattr(settings, 'metrics_port', None),
+        help="serve metrics in Prometheus text format at "
+        "http://127.0.0.1:PORT/metrics while running",
+    )
+    parser.add_argument(
+        '--flush-every', dest='flush_every',
+        action='store', type=int,
+        default=getattr(settings, 'sheet_flush_every', None),
+        help="write pending updates to the spreadsheet in background "
+        "every N updates instead of a single batch at the end of the run",
+    )
+    parser.add_argument(
+        '--flush-interval', dest='flush_interval',
+        action='store', type=float,
+        default=getattr(settings, 'sheet_flush_interval', None),
+        help="write pending updates to the spreadsheet in background "
+        "at least every T seconds",
+    )
+    parser.add_argument(
+        '--spreadsheets', dest='spreadsheets',
+        action='store', nargs='+', default=None,
+        help="spreadsheets (e.g. of other courses or semesters) to be "
+        "included in the report, default is the one from settings",
+    )
+    parser.add_argument(
+        '--profile', dest='profile',
+        action='store_true',
+        help="profile every stage of the run (stages run one at a "
+        "time): cProfile stats and sampled stacks for flame graphs "
+        "are saved to --profile-dir",
+    )
+    parser.add_argument(
+        '--profile-dir', dest='profile_dir',
+        action='store', default=getattr(settings, 'profile_dir', profiling.DEFAULT_PROFILE_DIR),
+        help="directory for --profile output",
+    )
+    parser.add_argument(
+        '--profile-memory', dest='profile_memory',
+        action='store_true',
+        help="--profile: also find peak memory of every stage with "
+        "tracemalloc (slow)",
+    )
+    parser.add_argument(
+        '--record', dest='record',
+        action='store', default=None, metavar='CASSETTE',
+        help="save all HTTP requests, Google Sheets calls and MOSS "
+        "uploads of the run with their responses (secrets scrubbed) "
+        "to a cassette file",
+    )
+    parser.add_argument(
+        '--replay', dest='replay',
+        action='store', default=None, metavar='CASSETTE',
+        help="answer HTTP requests, Google Sheets calls and MOSS uploads "
+        "from a cassette saved by --record instead of the network",
+    )
+    parser.add_argument(
+        '--latency-scale', dest='latency_scale',
+        action='store', type=float, default=1.0,
+        help="--replay: multiply recorded latencies by this factor, "
+        "0 answers at once",
+    )
+    parser.add_argument(
+        '--profile-startup', dest='profile_startup',
+        action='store_true',
+        help="print time spent on imports, authentication and "
+        "other initialization stages",
+    )
     parser.add_argument(
         '--logging-config', dest='logging_config', action='store',
         default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -79,13 +281,48 @@ def _parse_args():
     return parser.parse_args()
 
 
-def update_students(imap_conn, data, data_update=[], dry_run=False):
+def _record_updates(data_update, start, journal=None, writer=None, lab_id=None, repo=None, build_info=None,
+                    completion=None):
+    """
+    Journal pending updates produced since position 'start' of data_update
+    and pass them to the background writer
+    """
+    if writer is not None:
+        writer.submit(data_update[start:])
+    if journal is None:
+        return
+    build_info = build_info or {}
+    journal.record(
+        data_update[start:],
+        lab_id=lab_id,
+        repo=repo,
+        head_sha=build_info.get("head_sha"),
+        build_id=build_info.get("external_id") or build_info.get("target_url"),
+        completion=completion,
+    )
+
+
+def update_students(imap_conn, data, data_update=[], dry_run=False, journal=None, writer=None, mail_queue=None, sync_state=None, students=None, answered_uids=None):
     """
+    :param students: student info extracted from the mailbox beforehand
+    (see mailbox.process_students), the mailbox is processed if None
+    :param answered_uids: list to append uids of messages answered with an
+    error report to. Messages answered by an earlier run (see
+    mailbox.save_answered_uids) are not answered again
     """
-    # read all new letters in mailbox and extract student info
-    print("Processing mailbox...\n")
-    students = mailbox.process_students(imap_conn)
-    print(students)
+    # emails are sent at the end of the run if a queue is provided
+    own_mail_queue = mail_queue is None
+    if own_mail_queue:
+        mail_queue = mailbox.MailQueue(dry_run=dry_run)
+    # flags are changed with a single command per flag
+    flagged_uids = []
+    answered_before = mailbox.answered_uids(sync_state) if sync_state is not None else set()
+    # read all new letters in mailbox and extract student info, messages
+    # are left unseen in dry-run mode
+    if students is None:
+        print("Processing mailbox...\n")
+        students = mailbox.process_students(imap_conn, sync_state=sync_state, mark_seen=not dry_run)
+        print(students)
     # validate student info and add to data
     for student in students:
         try:
@@ -98,7 +335,9 @@ def update_students(imap_conn, data, data_update=[], dry_run=False):
             # account is done by course staff only to prohibit cheating)
             # - this github account is already used by another student (most
             # likely a cheating attempt)
+            updates_start = len(data_update)
             data_update = google_sheets.set_student_github(data, student, data_update=data_update)
+            _record_updates(data_update, updates_start, journal, writer)
         except ValueError as e:
             errmsg = "Unable to process request from student '{}'".format(student['name'])
             print(errmsg)
@@ -115,223 +354,535 @@ def update_students(imap_conn, data, data_update=[], dry_run=False):
             # set a message as unseen (unread)
             # mailbox.mark_unread(imap_conn, student['uid'])
             recepients = [student['email'], settings.mail_return_address]
+            # send a report
+            if int(student['uid']) in answered_before:
+                print("Error report has already been sent")
+            else:
+                mail_queue.add(recepients, errmsg, email_text)
+                if answered_uids is not None:
+                    answered_uids.append(student['uid'])
             if not dry_run:
-                # send a report
-                mailbox.send_email(recepients, errmsg, email_text)
                 # flag the message, but leave it as read since we don't want
                 # another report to be sent when the script is run next time
-                mailbox.mark_flagged(imap_conn, student['uid'])
-            else:
-                print("An email would have been sent to {}. Subject: {}. Text: {}".format(recepients, errmsg, email_text))
-                # set a message as unseen (unread)
-                mailbox.mark_unread(imap_conn, student['uid'])
-        else:
-            if dry_run:
-                # set a message as unseen (unread)
-                mailbox.mark_unread(imap_conn, student['uid'])
+                flagged_uids.append(student['uid'])
+    mailbox.mark_flagged(imap_conn, flagged_uids)
+    if own_mail_queue:
+        mail_queue.send_all()
     return data_update
 
 
-def create_appveyor_projects(dry_run):
+def watch_students(gs, sheets, dry_run=False, batch_size=20):
+    """
+    Process registration emails as soon as they arrive and write GitHub
+    accounts to the spreadsheet in small batches. Runs until interrupted.
+    """
+    sync_state = mailbox.load_sync_state()
+
+    def process(imap_conn):
+        # the state is applied and messages are marked as seen only after
+        # the spreadsheet is updated, so that a failed cycle is repeated
+        cycle_state = copy.deepcopy(sync_state)
+        mail_queue = mailbox.MailQueue(dry_run=dry_run)
+        try:
+            # spreadsheet may have been changed by course staff in the meantime
+            data = google_sheets.get_multiple_sheets_data(gs, sheets)
+            print("Processing mailbox...\n")
+            students = mailbox.process_students(imap_conn, sync_state=cycle_state, mark_seen=False)
+            print(students)
+            data_update = update_students(imap_conn, data, data_update=[], dry_run=dry_run,
+                                          mail_queue=mail_queue, students=students)
+            for batch_start in range(0, len(data_update), batch_size):
+                batch = data_update[batch_start:batch_start + batch_size]
+                batch.append({
+                    'range': "'План'!B1",
+                    'values': [[datetime.datetime.now().isoformat()]]
+                })
+                print(batch)
+                if not dry_run:
+                    updated_cells = google_sheets.batch_update(gs, batch)
+                    if updated_cells != len(batch):
+                        raise ValueError("Number of updated cells ({}) differs from expected ({})! Check the data manually. Data update: {}".format(updated_cells, len(batch), batch))
+            if not dry_run:
+                mailbox.mark_seen(imap_conn, [student['uid'] for student in students])
+                mailbox.save_sync_state(cycle_state)
+        except Exception:
+            # the saved state is the last one that was fully applied
+            sync_state.clear()
+            sync_state.update(mailbox.load_sync_state())
+            raise
+        sync_state.clear()
+        sync_state.update(cycle_state)
+        mail_queue.send_all()
+    watcher.watch(process)
+
+
+def create_appveyor_projects(dry_run, org_repos=None, existing_projects=None):
     """
+    :param org_repos: repositories of the organization as returned by
+    common.get_github_repos, requested if None
+    :param existing_projects: repository names of AppVeyor projects,
+    requested if None
     """
-    task3_repos = common.get_github_repo_names(settings.github_organization, prefix='os-task3', private=False)
+    if org_repos is None:
+        task3_repos = common.get_github_repo_names(settings.github_organization, prefix='os-task3', private=False)
+    else:
+        task3_repos = set(x['full_name'] for x in org_repos if x['name'].startswith('os-task3') and not x['private'])
     # print(task3_repos)
     # zz = common.get_appveyor_project_repo_names()
-    new_projects = common.add_appveyor_projects_safely(list(task3_repos), trigger_build=True, dry_run=dry_run)
+    new_projects = common.add_appveyor_projects_safely(list(task3_repos), trigger_build=True, dry_run=dry_run,
+                                                       existing_projects_repos=existing_projects)
     return new_projects
 
 
-def check_lab(lab_id, groups, data, data_update=[]):
+def evaluate_repo(lab_id, repo):
     """
+    Collect everything needed to grade a lab repository from GitHub and CI
+    services. No spreadsheet data is needed, so repositories can be
+    evaluated by worker processes (see run_worker).
+
+    :param lab_id: lab identifier (a key of settings.os_labs)
+    :param repo: repository name (with organization prefix)
+    :returns: dict with keys 'grade_coefficient' (None if the lab has no
+    repo_requirements), 'build_info', 'completion_date', 'task_id' (found
+    in the build log) and 'reduction' (grade reduction coefficient found in
+    the build log or None)
+    """
+    evaluation = {
+        'grade_coefficient': None,
+        'build_info': None,
+        'completion_date': None,
+        'task_id': None,
+        'reduction': None,
+    }
+    # check existence of repo_requirements node for lab_id
+    if "repo_requirements" in settings.os_labs[lab_id]:
+        grade_coefficient: float = 0.0
+
+        # computing grade coefficient by commits
+        commit_grade_coefficient = common.get_repo_commit_grade_coefficient(repo, lab_id)
+        if commit_grade_coefficient is not None:
+            grade_coefficient += commit_grade_coefficient
+
+        # computing grade coefficient by issues
+        issues_grade_coefficient = common.get_repo_issues_grade_coefficient(repo, lab_id)
+        if issues_grade_coefficient is not None:
+            grade_coefficient += issues_grade_coefficient
+
+        evaluation['grade_coefficient'] = grade_coefficient
+        if grade_coefficient <= 0.0:
+            # calculated coefficient for this lab is zero, no need to check tests
+            return evaluation
+
+    # check if tests have passed successfully
+    log = None
+    if int(lab_id) == 3:
+        build_info = common.get_successfull_status_info(repo)
+        completion_date = build_info.get("updated_at")
+        if completion_date:
+            log = common.get_appveyor_log(repo)
+    else:
+        build_info = common.get_successfull_build_info(repo)
+        completion_date = build_info.get("completed_at")
+        if completion_date:
+            log = common.get_travis_log(repo, build_info)
+    evaluation['build_info'] = build_info
+    evaluation['completion_date'] = completion_date
+    if completion_date:
+        evaluation['task_id'] = common.get_task_id(log)
+        evaluation['reduction'] = common.get_grade_reduction_coefficient(log)
+    return evaluation
+
+
+def grade_repo(lab_id, student, evaluation, data, penalty_table, data_update=[], lab_penalty=None):
+    """
+    Set lab status of a student from evaluation of his/her repository
+
+    :param evaluation: dict returned by evaluate_repo
+    :param penalty_table: penalty table of the lab, see penalty.compile_lab
+    :param lab_penalty: deadline penalty computed beforehand (see
+    check_lab), evaluated by penalty_table if None
+    :returns: completion info to be stored to recompute penalty if deadline
+    is moved, or None if the lab is not completed
+    """
+    lab_id_int = int(lab_id)
+    grade_coefficient = evaluation['grade_coefficient']
+    if grade_coefficient is not None:
+        if grade_coefficient > 0.0:
+            google_sheets.set_student_lab_status(data, student, lab_id_int, "?v*{0:g}".format(grade_coefficient),
+                                                 data_update=data_update)
+        else:
+            # calculated coefficient for this lab is zero, skip it
+            return None
+    completion_date = evaluation['completion_date']
+    if not completion_date:
+        return None
+    # calculate correct TASKID
+    student_task_id = int(google_sheets.get_student_task_id(data, student))
+    student_task_id += settings.os_labs[lab_id].get('taskid_shift', 0)
+    student_task_id = student_task_id % settings.os_labs[lab_id]['taskid_max']
+    if student_task_id == 0:
+        student_task_id = settings.os_labs[lab_id]['taskid_max']
+    # check TASKID from logs
+    if evaluation['task_id'] != student_task_id:
+        google_sheets.set_student_lab_status(data, student, lab_id_int, "?! Wrong TASKID!", data_update=data_update)
+        return None
+    # everything looks good, go on and update lab status
+    # calculate grade reduction coefficient
+    reduction_coefficient_str = evaluation['reduction']
+    if reduction_coefficient_str is not None:
+        grade_reduction_suffix = "*{}".format(reduction_coefficient_str)
+    else:
+        grade_reduction_suffix = ""
+    # calculate deadline penalty
+    # TODO: check that penalty does not exceed maximum grade points for that lab
+    base_status = "v{}".format(grade_reduction_suffix)
+    if lab_penalty is None:
+        lab_penalty = penalty_table.penalty(student['group'], completion_date)
+    status = penalty.format_status(base_status, lab_penalty)
+    # update status
+    google_sheets.set_student_lab_status(data, student, lab_id_int, status,
+                                         data_update=data_update)
+    # completion is stored to recompute penalty if deadline is moved
+    return {
+        'group': student['group'],
+        'name': student['name'],
+        'completion_date': completion_date,
+        'base_status': base_status,
+        'status': status,
+    }
+
+
+def _evaluate_queued(queue, lab_id, pending):
+    """
+    Evaluate repositories by worker processes
+
+    :param queue: jobqueue.JobQueue instance
+    :param pending: list of tuples (repo, student)
+    :returns: generator of tuples (repo, student, evaluation) in the order
+    evaluations are finished, repositories that failed are skipped
+    """
+    course = courses.current()
+    jobs = {}
+    for repo, student in pending:
+        job_id = queue.put(
+            'evaluate_repo',
+            {'course': course, 'lab_id': lab_id, 'repo': repo},
+            key="{}:{}:{}".format(course, lab_id, repo)
+        )
+        jobs[job_id] = (repo, student)
+    if jobs:
+        print("Lab {}: {} repositories queued for evaluation".format(lab_id, len(jobs)))
+    # jobs are failed if no worker finishes any of them for a while
+    for job_id, status, result in queue.wait(jobs, timeout=queue.lease * queue.max_attempts):
+        repo, student = jobs[job_id]
+        if status != jobqueue.DONE:
+            print("Evaluation of repository '{}' failed: {}".format(repo, result))
+            continue
+        yield repo, student, result
+
+
+def find_pending_repos(lab_id, data, journal=None, org_repos=None, verbose=True):
+    """
+    Find repositories of a lab that have to be graded: the lab status of
+    the student is empty or marked with '?'
+
+    :param journal: journal.Journal instance, repositories graded by a
+    previous run are skipped
+    :param org_repos: repositories of the organization as returned by
+    common.get_github_repos, requested if None
+    :param verbose: print repositories whose students are not found
+    :returns: list of tuples (repo, student, current status)
     """
     prefix = settings.os_labs[lab_id]['github_prefix']
-    repos = common.get_github_repo_names(settings.github_organization, prefix)
-    deadlines = {}
+    if org_repos is None:
+        repos = common.get_github_repo_names(settings.github_organization, prefix)
+    else:
+        repos = set(x['full_name'] for x in org_repos if x['name'].startswith(prefix))
     lab_id_int = int(lab_id)
-    for group in groups:
-        deadline_str = google_sheets.get_lab_deadline(data, group, lab_id_int)
-        if len(deadline_str.split('.')) == 2:
-            deadline_str += '.{} 23:59:59 MSK'.format(datetime.datetime.now().year)
-        # print(deadline_str)
-        deadlines[group] = parse(deadline_str, dayfirst=True)
+    pending = []
     for repo in repos:
+        if journal is not None and journal.is_done(lab_id, repo):
+            # this repo was graded by a previous run, its updates are replayed
+            continue
         github_account = repo.split('/')[1][len(prefix)+1:]
         try:
             student = google_sheets.find_student_by_github(data, github_account)
         except ValueError as e:
             # student not found, probably he/she forgot to send a letter with GitHub account info
-            print(e)
+            if verbose:
+                print(e)
             continue
         # check if this lab is already accounted for
         current_status = google_sheets.get_student_lab_status(data, student, lab_id_int)
         if current_status is not None and not current_status.startswith('?'):
             # this lab is already accounted for, skip it
             continue
+        pending.append((repo, student, current_status))
+    return pending
 
-        # check existence of repo_requirements node for lab_id
-        if "repo_requirements" in settings.os_labs[lab_id]:
-            grade_coefficient: float = 0.0
 
-            # computing grade coefficient by commits
-            commit_grade_coefficient = common.get_repo_commit_grade_coefficient(repo, lab_id)
-            if commit_grade_coefficient is not None:
-                grade_coefficient += commit_grade_coefficient
+def _grade_chunk(lab_id, chunk, data, penalty_table, data_update, journal, writer, completions):
+    """
+    Grade evaluated repositories and journal their updates
 
-            # computing grade coefficient by issues
-            issues_grade_coefficient = common.get_repo_issues_grade_coefficient(repo, lab_id)
-            if issues_grade_coefficient is not None:
-                grade_coefficient += issues_grade_coefficient
+    :param chunk: list of tuples (repo, student, evaluation, seconds spent
+    on the evaluation)
+    """
+    completed = [(student, evaluation) for _, student, evaluation, _ in chunk if evaluation['completion_date']]
+    chunk_penalties = iter(penalty_table.evaluate(
+        [student['group'] for student, _ in completed],
+        [evaluation['completion_date'] for _, evaluation in completed],
+    ))
+    for repo, student, evaluation, seconds in chunk:
+        grade_start = time.perf_counter()
+        lab_penalty = next(chunk_penalties) if evaluation['completion_date'] else None
+        updates_start = len(data_update)
+        completion = grade_repo(lab_id, student, evaluation, data, penalty_table, data_update=data_update,
+                                lab_penalty=lab_penalty)
+        if completion is not None and completions is not None:
+            completions.setdefault(lab_id, {})[repo] = completion
+        _record_updates(data_update, updates_start, journal, writer, lab_id, repo, evaluation['build_info'],
+                        completion)
+        # evaluation and grading
+        seconds += time.perf_counter() - grade_start
+        metrics.observe('repo_duration_seconds', seconds, lab=lab_id)
+        metrics.record_timing('repo', "lab {} {}".format(lab_id, repo), seconds)
 
-            if grade_coefficient > 0.0:
-                google_sheets.set_student_lab_status(data, student, lab_id_int, "?v*{0:g}".format(grade_coefficient),
-                                                     data_update=data_update)
-            else:
-                # calculated coefficient for this lab is zero, skip it
-                continue
 
-        # check if tests have passed successfully
-        completion_date = None
-        log = None
-        if lab_id_int == 3:
-            completion_date = common.get_successfull_status_info(repo).get("updated_at")
-            if completion_date:
-                log = common.get_appveyor_log(repo)
-        else:
-            completion_date = common.get_successfull_build_info(repo).get("completed_at")
-            if completion_date:
-                log = common.get_travis_log(repo)
-        # check if 
-        if completion_date:
-            # log = common.get_travis_log(repo)
-            # calculate correct TASKID
-            student_task_id = int(google_sheets.get_student_task_id(data, student))
-            student_task_id += settings.os_labs[lab_id].get('taskid_shift', 0)
-            student_task_id = student_task_id % settings.os_labs[lab_id]['taskid_max']
-            if student_task_id == 0:
-                student_task_id = settings.os_labs[lab_id]['taskid_max']
-            # check TASKID from logs
-            if common.get_task_id(log) != student_task_id:
-                google_sheets.set_student_lab_status(data, student, lab_id_int, "?! Wrong TASKID!", data_update=data_update)
-            else:
-                # everything looks good, go on and update lab status
-                # calculate grade reduction coefficient
-                reduction_coefficient_str = common.get_grade_reduction_coefficient(log)
-                if reduction_coefficient_str is not None:
-                    grade_reduction_suffix = "*{}".format(reduction_coefficient_str)
-                else:
-                    grade_reduction_suffix = ""
-                # calculate deadline penalty
-                student_dt = isoparse(completion_date)
-                if student_dt > deadlines[student['group']]:
-                    overdue = student_dt - deadlines[student['group']]
-                    penalty = math.ceil((overdue.days + overdue.seconds / 86400) / 7)
-                    # TODO: check that penalty does not exceed maximum grade points for that lab
-                    penalty = min(penalty, settings.os_labs[lab_id].get('penalty_max', 0))
-                    penalty_suffix = "-{}".format(penalty)
-                else:
-                    penalty_suffix = ""
-                # update status
-                google_sheets.set_student_lab_status(data, student, lab_id_int,
-                                                     "v{}{}".format(grade_reduction_suffix, penalty_suffix),
-                                                     data_update=data_update)
+def check_lab(lab_id, groups, data, data_update=[], journal=None, writer=None, completions=None, org_repos=None,
+              queue=None, plan=None):
+    """
+    :param org_repos: repositories of the organization as returned by
+    common.get_github_repos, requested if None
+    :param queue: jobqueue.JobQueue instance, repositories are evaluated by
+    worker processes if set, otherwise they are evaluated one by one
+    :param plan: planner.Plan instance, only repositories selected by the
+    plan are graded, the rest are deferred to the next run
+    """
+    # deadlines and penalty policy are compiled once for all repos
+    penalty_table = penalty.compile_lab(lab_id, groups, data)
+    pending = [(repo, student) for repo, student, _ in find_pending_repos(lab_id, data, journal, org_repos)]
+    if plan is not None:
+        pending = plan.select(lab_id, pending)
+    if queue is None:
+        evaluations = (
+            (repo, student, evaluate_repo(lab_id, repo)) for repo, student in pending
+            # requests actually made are checked right before every evaluation
+            if plan is None or plan.acquire(lab_id, repo)
+        )
+    else:
+        if plan is not None:
+            pending = [(repo, student) for repo, student in pending if plan.acquire(lab_id, repo)]
+        evaluations = _evaluate_queued(queue, lab_id, pending)
+    lab_start = repo_start = time.perf_counter()
+    graded = 0
+    # repositories are graded and journaled in small chunks as they are
+    # evaluated, deadline penalties of a chunk are evaluated in one call
+    chunk = []
+    for repo, student, evaluation in evaluations:
+        # time since the previous repository was evaluated, or waiting for
+        # a worker if a queue is used
+        chunk.append((repo, student, evaluation, time.perf_counter() - repo_start))
+        repo_start = time.perf_counter()
+        if len(chunk) >= GRADE_CHUNK_SIZE:
+            _grade_chunk(lab_id, chunk, data, penalty_table, data_update, journal, writer, completions)
+            graded += len(chunk)
+            chunk = []
+            repo_start = time.perf_counter()
+    if chunk:
+        _grade_chunk(lab_id, chunk, data, penalty_table, data_update, journal, writer, completions)
+        graded += len(chunk)
+    metrics.inc('repos_graded_total', graded, lab=lab_id)
+    metrics.set_gauge('lab_duration_seconds', time.perf_counter() - lab_start, lab=lab_id)
     return data_update
 
 
-def check_plagiarism(lab_id, local_path):
+def stage_submissions(lab_id, local_path, history=False):
     """
+    Download submissions of a lab and prepare a list of files to be compared
+
+    :param lab_id: lab identifier (a key of settings.os_labs)
+    :param local_path: lab directory
+    :param history: also compare submissions with similar submissions of
+    previous runs found in the MinHash index
+    :returns: tuple (list of basefile names, list of tuples (file name,
+    display name))
     """
-    # TODO: this is unfinished function
     prefix = settings.os_labs[lab_id]['github_prefix']
-    # get a list of repositories
-    repos = common.get_github_repo_names(settings.github_organization, prefix)
-    # initialize MOSS
+    # get a list of repositories, 'pushed_at' of the listing is used as
+    # submission date
+    repos = common.get_github_repos(settings.github_organization, prefix)
     moss_settings = settings.os_labs[lab_id].get('moss', {})
-    moss = mosspy.Moss(
-        settings.moss_userid,
-        moss_settings.get('language')
-    )
-    if moss_settings.get('max-matches'):
-        moss.setIgnoreLimit(moss_settings['max-matches'])
-    if moss_settings.get('directory'):
-        moss.setDirectoryMode(moss_settings['directory'])
+    connections = moss_settings.get('connections', submissions.DEFAULT_CONNECTIONS)
+    # files are kept in a content-addressed store, repositories that have
+    # not changed since the previous run are not downloaded again
+    store = submissions.SubmissionStore(local_path)
+    previous_manifest = store.load_manifest()
+    # download basefiles, one request per repository
+    basefile_repos = collections.OrderedDict()
     for basefile in moss_settings.get('basefiles', []):
-        if isinstance(basefile, collections.Mapping):
-            repo = basefile['repo']
-            filename = basefile['filename']
-            file_contents = common.github_get_file(repo, filename)
-            local_dir = os.path.join(
-                local_path,
-                *repo.split('/'),
-                *filename.split('/')[:-1] if '/' in filename else ""
-            )
-            os.makedirs(local_dir, exist_ok=True)
-            local_filename = os.path.join(local_dir, filename.split('/')[-1])
-            with open(local_filename, "wb") as f:
-                f.write(file_contents)
-        elif isinstance(basefile, str):
-            local_filename = basefile
-        else:
+        if isinstance(basefile, collections.abc.Mapping):
+            basefile_repos.setdefault(basefile['repo'], []).append(basefile['filename'])
+        elif not isinstance(basefile, str):
             raise ValueError("Unknown basefile value type. "
                 "Value '{}' of type '{}' is not supported.".format(
                     str(basefile), 
                     type(basefile)
                 )
             )
-        moss.addBaseFile(local_filename)
+    basefile_results = submissions.download_repos(
+        [{'full_name': repo} for repo in basefile_repos],
+        basefile_repos,
+        local_path,
+        connections=connections,
+        store=store,
+        previous=previous_manifest
+    )
+    basefile_names = {}
+    for result in basefile_results:
+        if len(result['missing']) > 0:
+            raise Exception("Basefiles {} not found in GitHub repo '{}'".format(result['missing'], result['repo']))
+        for filename, local_filename in result['files'].items():
+            basefile_names[(result['repo'], filename)] = local_filename
+    basefiles = []
+    for basefile in moss_settings.get('basefiles', []):
+        if isinstance(basefile, str):
+            basefiles.append(basefile)
+        else:
+            basefiles.append(basefile_names[(basefile['repo'], basefile['filename'])])
     # download specific files from repositories
-    file_count = 0
-    for repo in repos:
-        github_account = repo.split('/')[1][len(prefix)+1:]
-        for filename in settings.os_labs[lab_id].get('files', []):
-            file_contents = common.github_get_file(repo, filename)
-            local_dir = os.path.join(
-                local_path,
-                # repo,
-                # "{}-{}".format(prefix, github_account),
-                *repo.split('/'),
-            )
-            # print(local_dir)
-            # print(*repo.split('/'))
-            print(
-                "Downloading file '{}' from GitHub repo '{}' "
-                "to directory '{}'...".format(
-                    filename,
-                    repo,
-                    local_dir
-                )
-            )
-            os.makedirs(local_dir, exist_ok=True)
-            local_filename = os.path.join(local_dir, filename)
-            with open(local_filename, "wb") as f:
-                f.write(file_contents)
-            dt = common.github_get_latest_commit_date(repo)
-            display_name = f"{lab_id}_{github_account}_{dt:%Y-%m-%d}"
-            moss.addFile(local_filename, display_name)
-            file_count += 1
-    print(f"Total {file_count} files were downloaded. Sending them to MOSS...")
+    print("Downloading files {} from {} GitHub repos to directory '{}'...".format(
+        settings.os_labs[lab_id].get('files', []), len(repos), local_path))
+    results = submissions.download_repos(
+        repos,
+        settings.os_labs[lab_id].get('files', []),
+        local_path,
+        connections=connections,
+        store=store,
+        previous=previous_manifest
+    )
+    reused_count = sum(1 for result in results if result['reused'])
+    print(f"{len(results) - reused_count} repos were downloaded, {reused_count} unchanged repos were taken from the local store.")
+    manifest = submissions.make_manifest(basefile_results + results)
+    # copies (same source modulo formatting and comments) are sent to
+    # MOSS only once, copies of basefiles are not sent at all
+    language = moss_settings.get('language')
+    normalize_names = moss_settings.get('canonicalize-identifiers', False)
+    normalized = {}
+    shas = {(r['repo'], filename): sha for r in results for filename, sha in r['shas'].items()}
+
+    def normalized_key(repo, filename):
+        sha = shas[(repo, filename)]
+        if sha not in normalized:
+            with open(store.object_path(sha), 'r', encoding='utf-8', errors='replace') as f:
+                normalized[sha] = winnow.normalized_hash(
+                    f.read(), winnow.detect_language(filename, language), normalize_names)
+        return normalized[sha]
+
+    base_keys = set()
+    for basefile in basefiles:
+        with open(basefile, 'r', encoding='utf-8', errors='replace') as f:
+            base_keys.add(winnow.normalized_hash(f.read(), winnow.detect_language(basefile, language), normalize_names))
+    duplicates = submissions.find_duplicates(results, normalized_key)
+    submitted = []
+    basefile_copies = []
+    uploaded_keys = set(base_keys)
+    for result in results:
+        github_account = result['repo'].split('/')[1][len(prefix)+1:]
+        dt = result['pushed_at']
+        display_name = f"{lab_id}_{github_account}_{dt:%Y-%m-%d}"
+        manifest[result['repo']]['display_name'] = display_name
+        for filename, local_filename in result['files'].items():
+            key = normalized_key(result['repo'], filename)
+            if key in base_keys:
+                basefile_copies.append(f"{result['repo']}/{filename}")
+            if key in uploaded_keys:
+                continue
+            uploaded_keys.add(key)
+            submitted.append((result['repo'], result['shas'][filename], local_filename, display_name))
+    skipped_count = sum(len(r['files']) for r in results) - len(submitted)
+    # local duplicates report
+    run_dt = datetime.datetime.now()
+    submission_path = os.path.join(local_path, "submission")
+    os.makedirs(submission_path, exist_ok=True)
+    duplicates_filename = os.path.join(submission_path, f"duplicates_{run_dt:%Y-%m-%d_%H%M%S}.txt")
+    with open(duplicates_filename, 'w', encoding='utf-8') as f:
+        for key, copies in duplicates.items():
+            print("Files with identical source ({}): {}".format(
+                key[:10], ", ".join(f"{repo}/{filename}" for repo, filename in copies)), file=f)
+        for basefile_copy in basefile_copies:
+            print("File is identical to a basefile: {}".format(basefile_copy), file=f)
+    print(f"{skipped_count} duplicate files are not sent, see '{duplicates_filename}'")
+    store.save_manifest(manifest)
+    lab_files = [(local_filename, display_name) for _, _, local_filename, display_name in submitted]
+    if history:
+        lab_files += find_history_candidates(lab_id, store, submitted, basefiles)
+    return basefiles, lab_files
+
+
+def send_to_moss(lab_id, basefiles, lab_files):
+    """
+    Send files to MOSS server
+
+    :returns: report URL
+    """
+    import mosspy
+    moss_settings = settings.os_labs[lab_id].get('moss', {})
+    # initialize MOSS
+    moss = mosspy.Moss(
+        settings.moss_userid,
+        moss_settings.get('language')
+    )
+    if moss_settings.get('max-matches'):
+        moss.setIgnoreLimit(moss_settings['max-matches'])
+    if moss_settings.get('directory'):
+        moss.setDirectoryMode(moss_settings['directory'])
+    for basefile in basefiles:
+        moss.addBaseFile(basefile)
+    for local_filename, display_name in lab_files:
+        moss.addFile(local_filename, display_name)
     # send data to MOSS server
-    url = moss.send() 
-    print ("Report URL: " + url)
-    # Save report file
+    url = cassette.call('moss', "lab{}".format(lab_id), moss.send)
+    print ("Lab {} report URL: {}".format(lab_id, url))
+    return url
+
+
+def fetch_moss_report(lab_id, local_path, url):
+    """
+    Download MOSS report of a lab, unfinished downloads of previous runs
+    are completed as well
+    """
+    connections = settings.os_labs[lab_id].get('moss', {}).get('connections', moss_report.DEFAULT_CONNECTIONS)
     submission_path = os.path.join(local_path, "submission")
     os.makedirs(submission_path, exist_ok=True)
+    for unfinished_url, report_dir in moss_report.unfinished_reports(submission_path):
+        print("Resuming download of report '{}' to '{}'...".format(unfinished_url, report_dir))
+        try:
+            moss_report.download_report(unfinished_url, report_dir, connections=connections)
+        except Exception as e:
+            # MOSS keeps reports for a limited time only, the report is
+            # not resumed again
+            print("Download of report '{}' failed ({}), it is abandoned".format(unfinished_url, e))
+            moss_report.abandon_report(report_dir)
+    # Save report file
     dt = datetime.datetime.now()
-    moss.saveWebPage(
-        url, 
-        os.path.join(submission_path, f"report_{dt:%Y-%m-%d_%H%M%S}.html")
-    )
     report_dir = os.path.join(submission_path, f"report_{dt:%Y-%m-%d_%H%M%S}")
-    mosspy.download_report(
+    pages = moss_report.download_report(
         url,
         report_dir,
-        connections=8,
-        log_level=logging.DEBUG
+        connections=connections,
+        page_filename=os.path.join(submission_path, f"report_{dt:%Y-%m-%d_%H%M%S}.html")
     )
-    with open(os.path.join(report_dir, "_link.txt"), 'w') as f:
-        # f.write(f"{url}\n")
-        print(url, file=f)
-    # mossum
+    print("Lab {} report ({} pages) saved to '{}'".format(lab_id, pages, report_dir))
+    return report_dir
+
+
+def render_moss_graph(lab_id, local_path, url):
+    """
+    Draw a graph of matches of a MOSS report with mossum
+    """
+    from mossum import mossum
+    dt = datetime.datetime.now()
     # cli: mossum -m -p 10 -l 10 -a -o lab1/moss_$(date +%Y-%m-%d_%H%M%S) http://moss.stanford.edu/results/3/4482533404111
     mossum.args = mossum.parser.parse_args([
         '-m', '-p', '10', '-l', '10', 
@@ -345,53 +896,317 @@ def check_plagiarism(lab_id, local_path):
     all_res.append(mossum.get_results(url))
     merged = mossum.merge_results(all_res)
     mossum.image(merged)
-    # raise NotImplementedError("This function is not implemented yet!")
 
 
-def main():
-    # parse command line parameters
-    params = _parse_args()
-    # enable logging
-    setup_logging(params.logging_config)
-    logger = logging.getLogger(__name__)
-    # check arguments
-    if params.labs == 'all' or params.labs == '*':
-        params.labs = settings.os_labs.keys()
-    # perform action
-    if params.action == "update":
-        # initialization
+def check_plagiarism(lab_ids, offline=False, history=False):
+    """
+    Check submissions of several labs for plagiarism
+
+    Labs are processed concurrently as a pipeline: while submissions of a
+    lab are uploaded to MOSS, other labs may be staged or have their
+    reports downloaded. The number of labs in every stage at a time is
+    limited, graphs are drawn one at a time since mossum keeps its options
+    in a global variable.
+
+    :param lab_ids: list of lab identifiers (keys of settings.os_labs)
+    :param offline: compare submissions with the local winnowing engine
+    instead of sending them to MOSS server
+    :param history: also compare submissions with similar submissions of
+    previous runs found in the MinHash index
+    """
+    stage_limits = {
+        'staging': threading.BoundedSemaphore(getattr(settings, 'moss_parallel_staging', 2)),
+        'upload': threading.BoundedSemaphore(getattr(settings, 'moss_parallel_uploads', 2)),
+        'report': threading.BoundedSemaphore(getattr(settings, 'moss_parallel_reports', 2)),
+        'render': threading.BoundedSemaphore(1),
+    }
+
+    def process_lab(lab_id):
+        local_path = "lab{}".format(lab_id)
+        with stage_limits['staging'], profiling.stage("moss_lab{}_staging".format(lab_id)):
+            basefiles, lab_files = stage_submissions(lab_id, local_path, history=history)
+        if offline:
+            print(f"Lab {lab_id}: {len(lab_files)} unique files are ready. Comparing them locally...")
+            with profiling.stage("moss_lab{}_compare".format(lab_id)):
+                compare_locally(lab_id, local_path, basefiles, lab_files)
+            return
+        print(f"Lab {lab_id}: {len(lab_files)} unique files are ready. Sending them to MOSS...")
+        with stage_limits['upload'], profiling.stage("moss_lab{}_upload".format(lab_id)):
+            url = send_to_moss(lab_id, basefiles, lab_files)
+        with stage_limits['report'], profiling.stage("moss_lab{}_report".format(lab_id)):
+            fetch_moss_report(lab_id, local_path, url)
+        with stage_limits['render'], profiling.stage("moss_lab{}_render".format(lab_id)):
+            render_moss_graph(lab_id, local_path, url)
+
+    failed = []
+    # labs are processed one at a time while profiling
+    max_workers = 1 if profiling.active() else max(len(lab_ids), 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_lab, lab_id): lab_id for lab_id in lab_ids}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Lab {}: plagiarism check failed: {}".format(futures[future], e))
+                failed.append(futures[future])
+    if len(failed) > 0:
+        raise Exception("Plagiarism check failed for labs {}".format(failed))
+
+
+def find_history_candidates(lab_id, store, submitted, basefiles):
+    """
+    Find submissions of previous runs similar to the current ones with the
+    MinHash index and add the current submissions to the index
+
+    :param lab_id: lab identifier (a key of settings.os_labs)
+    :param store: submissions.SubmissionStore instance of the lab
+    :param submitted: list of tuples (repo, blob SHA, file name, display name)
+    :param basefiles: list of basefile names
+    :returns: list of tuples (file name, display name) of the previous
+    submissions to be compared with the current ones
+    """
+    moss_settings = settings.os_labs[lab_id].get('moss', {})
+    language = moss_settings.get('language')
+    threshold = moss_settings.get('history-threshold', minhash.DEFAULT_THRESHOLD)
+    base_hashes = set()
+    for filename in basefiles:
+        base_hashes.update(winnow.Fingerprint.from_file(filename, filename, language).hashes)
+    index = minhash.MinHashIndex()
+    current_shas = set(sha for _, sha, _, _ in submitted)
+    fingerprints = []
+    candidates = collections.OrderedDict()
+    for repo, sha, local_filename, display_name in submitted:
+        fingerprint = winnow.Fingerprint.from_file(display_name, local_filename, language)
+        fingerprint.subtract(base_hashes)
+        fingerprints.append(fingerprint)
+        for candidate in index.query(lab_id, fingerprint.hashes, threshold, exclude_repo=repo):
+            if candidate['sha'] in current_shas or candidate['path'] is None or not os.path.exists(candidate['path']):
+                continue
+            if candidate['sha'] not in candidates:
+                candidates[candidate['sha']] = candidate
+                print("Previous submission {} is similar to {} ({:.0%})".format(
+                    candidate['name'], display_name, candidate['similarity']))
+    # current submissions are queried first, so that they are only
+    # matched against the previous ones here
+    for (repo, sha, local_filename, display_name), fingerprint in zip(submitted, fingerprints):
+        index.add(lab_id, repo, display_name, sha, fingerprint.hashes,
+                  path=os.path.abspath(store.object_path(sha)))
+    index.close()
+    print("{} previous submissions will be compared with the current ones".format(len(candidates)))
+    return [(candidate['path'], candidate['name']) for candidate in candidates.values()]
+
+
+def compare_locally(lab_id, local_path, basefiles, lab_files):
+    """
+    Offline plagiarism check with the local winnowing engine
+
+    Prints the most similar pairs, saves similarity matrix as CSV and, if
+    mossum is installed, draws a graph of matches the same way as for
+    MOSS reports.
+
+    :param lab_id: lab identifier (a key of settings.os_labs)
+    :param local_path: lab directory
+    :param basefiles: list of basefile names
+    :param lab_files: list of tuples (file name, display name)
+    """
+    moss_settings = settings.os_labs[lab_id].get('moss', {})
+    language = moss_settings.get('language')
+    start = time.perf_counter()
+    fingerprints = [winnow.Fingerprint.from_file(name, filename, language) for filename, name in lab_files]
+    base_fingerprints = [winnow.Fingerprint.from_file(filename, filename, language) for filename in basefiles]
+    matches = winnow.compare(fingerprints, base_fingerprints, max_matches=moss_settings.get('max-matches'))
+    print("{} files compared in {:.1f} s, {} similar pairs found".format(
+        len(fingerprints), time.perf_counter() - start, len(matches)))
+    for match in matches[:20]:
+        print("{:>4}% {:>4}% {:>5} lines  {} - {}".format(
+            match.first_percent, match.second_percent, match.lines, match.first, match.second))
+    submission_path = os.path.join(local_path, "submission")
+    os.makedirs(submission_path, exist_ok=True)
+    dt = datetime.datetime.now()
+    matrix_filename = os.path.join(submission_path, f"similarity_{dt:%Y-%m-%d_%H%M%S}.csv")
+    winnow.save_matrix(matrix_filename, *winnow.similarity_matrix(fingerprints, matches))
+    print("Similarity matrix saved to '{}'".format(matrix_filename))
+    try:
+        from mossum import mossum
+    except ImportError:
+        print("mossum is not installed, graph of matches is not drawn")
+        return
+    mossum.args = mossum.parser.parse_args([
+        '-m', '-p', '10', '-l', '10',
+        '-o', os.path.join(local_path, f'winnow_{dt:%Y-%m-%d_%H%M%S}'),
+        matrix_filename
+    ])
+    mossum.image(winnow.to_mossum_results(f"lab{lab_id}", matches, matrix_filename))
+
+
+def run_update(params, clients=None):
+    """
+    Process mailbox, grade labs and update the spreadsheet
+
+    :param params: command line parameters
+    :param clients: dict of clients (IMAP, Google Sheets, SMTP) to be kept
+    between runs in daemon mode. Clients are created if missing and added
+    to the dict. If None, all connections are closed at the end of the run
+    """
+    # initialization
+    completions = penalty.load_completions()
+    # pending updates are journaled, so that an unfinished run can be resumed
+    journal_instance = None
+    if not params.dry_run:
+        journal_instance = journal.Journal()
+        if journal_instance.exists() and not params.resume:
+            print("Journal '{}' of an unfinished run found. It will be discarded. "
+                  "Use --resume to continue that run instead.".format(journal_instance.path))
+    elif params.resume:
+        print("Journal is not used in dry-run mode, --resume is ignored")
+    # the run is a DAG of stages, independent stages (e.g. organization
+    # repo listing, mailbox processing and spreadsheet load) overlap
+    # stages are profiled one at a time
+    pipeline = stages.Pipeline(max_workers=1 if profiling.active() else None, around_stage=profiling.stage)
+    # repositories are evaluated by worker processes if a queue is used
+    queue = jobqueue.JobQueue() if params.queue or params.workers > 0 else None
+    keep_clients = clients is not None
+    clients = {} if clients is None else clients
+    sync_state = mailbox.load_sync_state()
+    # messages answered with an error report by this run
+    answered_uids = []
+    if 'mail_queue' not in clients:
+        clients['mail_queue'] = mailbox.MailQueue(dry_run=params.dry_run, keep_connection=keep_clients)
+    mail_queue = clients['mail_queue']
+    # requests of the run are counted from here, see planner.py
+    request_baseline = common.request_counts(courses.current())
+
+    def connect_imap():
+        if 'imap' in clients:
+            try:
+                clients['imap'].noop()
+                return clients['imap']
+            except (imaplib.IMAP4.error, OSError) as e:
+                print("IMAP connection lost ({}), reconnecting...".format(e))
+                del clients['imap']
+        with _startup_stage("IMAP connection"):
+            clients['imap'] = mailbox.get_imap_connection()
+        return clients['imap']
+
+    def connect_sheets():
+        if 'gs' not in clients:
+            with _startup_stage("Google Sheets client"):
+                clients['gs'] = google_sheets.get_spreadsheet_instance()
+        return clients['gs']
+
+    def load_data(gs):
+        with _startup_stage("Google Sheets data load"):
+            sheets = google_sheets.get_sheet_names(gs)
+            # print(sheets)
+            sheets = ["'{}'".format(s) for s in sheets]
+            return sheets, google_sheets.get_multiple_sheets_data(gs, sheets)
+
+    def replay_journal(gs, data):
+        sheets, data = data
+        # pending updates are pushed to the spreadsheet while grading
+        # continues if a flush policy is set
+        writer = None
+        if not params.dry_run and (params.flush_every or params.flush_interval):
+            writer = google_sheets.BackgroundWriter(
+                gs,
+                flush_every=params.flush_every,
+                flush_interval=params.flush_interval,
+            )
+        # replay updates of an unfinished run
         data_update = []
-        # connect to IMAP
-        imap_conn = mailbox.get_imap_connection()
-        # connect to Google Sheets API
-        gs = google_sheets.get_spreadsheet_instance()
-        # load data from Google Sheets
-        sheets = google_sheets.get_sheet_names(gs)
-        # print(sheets)
-        sheets = ["'{}'".format(s) for s in sheets]
-        data = google_sheets.get_multiple_sheets_data(gs, sheets)
-        # process INBOX and update spreadsheet
-        data_update = update_students(imap_conn, data, data_update=data_update, dry_run=params.dry_run)
-        # check labs
+        if journal_instance is not None:
+            for entry in journal_instance.open(resume=params.resume):
+                if entry.get('completion') is not None:
+                    completions.setdefault(entry['lab_id'], {})[entry['repo']] = entry['completion']
+                for update in entry['updates']:
+                    google_sheets.apply_update(data, update)
+                    data_update.append(update)
+            if len(data_update) > 0:
+                print("{} pending updates were replayed from journal '{}'".format(
+                    len(data_update), journal_instance.path))
+                if writer is not None:
+                    writer.submit(data_update)
+        return writer, data_update
+
+    def read_mailbox(imap):
+        # read all new letters in mailbox and extract student info,
+        # messages are left unseen in dry-run mode
+        print("Processing mailbox...\n")
+        students = mailbox.process_students(imap, sync_state=sync_state, mark_seen=not params.dry_run)
+        print(students)
+        return students
+
+    def register_students(imap, mailbox_students, data, replay):
+        # update spreadsheet, error reports are sent at the end of the run
+        writer, _ = replay
+        return update_students(imap, data[1], data_update=[], dry_run=params.dry_run,
+                               journal=journal_instance, writer=writer, mail_queue=mail_queue,
+                               sync_state=sync_state, students=mailbox_students, answered_uids=answered_uids)
+
+    def make_plan(data, replay, registrations, org_repos, appveyor_projects):
+        # repositories within the request cap are selected before grading
+        sheets, data = data
+        labs_pending = {
+            lab_id: find_pending_repos(lab_id, data, journal_instance, org_repos, verbose=False)
+            for lab_id in params.labs
+        }
+        rate_limit = None
+        if queue is None:
+            # workers use their own tokens
+            rate_limit = _get_rate_limit()
+        plan = planner.make_plan(
+            labs_pending, org_repos, appveyor_projects,
+            max_requests=params.max_requests,
+            rate_limit=rate_limit,
+            baseline=request_baseline,
+            reserved=planner.appveyor_stage_requests(org_repos, appveyor_projects, dry_run=params.dry_run),
+        )
+        plan.print_summary(rate_limit)
+        return plan
+
+    def make_lab_stage(lab_id):
+        def grade_lab(data, replay, registrations, org_repos, plan=None):
+            sheets, data = data
+            writer, _ = replay
+            return check_lab(lab_id, sheets[:-1], data, data_update=[], journal=journal_instance,
+                             writer=writer, completions=completions, org_repos=org_repos, queue=queue,
+                             plan=plan)
+        return grade_lab
+
+    def update_spreadsheet(gs, replay, registrations, **lab_updates):
+        writer, data_update = replay
+        data_update = data_update + registrations
         for lab_id in params.labs:
-            data_update = check_lab(lab_id, sheets[:-1], data, data_update=data_update)
+            data_update += lab_updates["lab_{}".format(lab_id)]
         # update Google SpreadSheet
+        if writer is not None:
+            # wait for the last flush, the timestamp is written after it
+            updated_cells = writer.close()
+            print("{} cells updated in background.".format(updated_cells))
         if len(data_update) > 0:
-            data_update.append({
+            timestamp_update = {
                 'range': "'План'!B1",
                 # 'majorDimension': dimension,
                 'values': [[datetime.datetime.now().isoformat()]]
-            })
+            }
+            if writer is not None:
+                data_update = [timestamp_update]
+            else:
+                data_update.append(timestamp_update)
             print(data_update)
             if not params.dry_run:
                 updated_cells = google_sheets.batch_update(gs, data_update)
                 if updated_cells != len(data_update):
                     raise ValueError("Number of updated cells ({}) differs from expected ({})! Check the data manually. Data update: {}".format(updated_cells, len(data_update), data_update))
+        # all pending updates are applied, journal is not needed any more
+        if journal_instance is not None:
+            penalty.save_completions(completions)
+            mailbox.save_sync_state(sync_state)
+            journal_instance.close(remove=True)
+
+    def add_appveyor_projects(org_repos, appveyor_projects):
         # add all new os-task3 repos to AppVeyor
-        # if not params.dry_run:
-        #     new_projects = create_appveyor_projects()
-        #     print("{} new AppVeyour projects were added".format(len(new_projects)))
-        new_projects = create_appveyor_projects(params.dry_run)
+        new_projects = create_appveyor_projects(params.dry_run, org_repos, appveyor_projects)
         projects_count = len(new_projects)
         if params.dry_run:
             projects_msg_part = "" if projects_count == 1 else "s"
@@ -405,32 +1220,407 @@ def main():
                 ";".join(new_projects)
             )
         )
-        # if params.dry_run:
-        #     print(
-        #         "{} new AppVeyour projects would have been added: {}.".format(
-        #             len(new_projects),
-        #             ";".join(new_projects)
-        #         )
-        #     )
-        # else:
-        #     print(
-        #         "{} new AppVeyour project{} added: {}".format(
-        #             projects_count,
-        #             " was" if projects_count == 1 else "s were",
-        #             ";".join(new_projects)
-        #         )
-        #     )
-        
-        # close IMAP connections
+
+    def send_emails(registrations):
+        # send error reports to students as soon as they are known, they
+        # do not depend on grading, so a failed lab does not hold them back
+        emails_count = mail_queue.send_all()
+        if emails_count > 0:
+            print("{} emails were sent".format(emails_count))
+        # the messages may be processed again if a later stage fails
+        if not params.dry_run:
+            mailbox.save_answered_uids(sync_state, answered_uids)
+
+    lab_stages = ["lab_{}".format(lab_id) for lab_id in params.labs]
+    pipeline.add('org_repos', lambda: common.get_github_repos(settings.github_organization))
+    pipeline.add('appveyor_projects', common.get_appveyor_project_repo_names)
+    pipeline.add('imap', connect_imap)
+    pipeline.add('gs', connect_sheets)
+    pipeline.add('data', load_data, requires=['gs'])
+    pipeline.add('replay', replay_journal, requires=['gs', 'data'])
+    pipeline.add('mailbox_students', read_mailbox, requires=['imap'])
+    pipeline.add('registrations', register_students, requires=['imap', 'mailbox_students', 'data', 'replay'])
+    lab_requires = ['data', 'replay', 'registrations', 'org_repos']
+    if params.max_requests is not None:
+        pipeline.add('plan', make_plan, requires=lab_requires + ['appveyor_projects'])
+        lab_requires = lab_requires + ['plan']
+    for lab_id, lab_stage in zip(params.labs, lab_stages):
+        pipeline.add(lab_stage, make_lab_stage(lab_id), requires=lab_requires)
+    pipeline.add('spreadsheet_update', update_spreadsheet, requires=['gs', 'replay', 'registrations'] + lab_stages)
+    pipeline.add('appveyor', add_appveyor_projects, requires=['org_repos', 'appveyor_projects'])
+    pipeline.add('emails', send_emails, requires=['registrations'])
+    failed = True
+    try:
+        pipeline.run()
+        failed = False
+    finally:
+        # close IMAP connections, a connection kept between runs is closed
+        # only if something went wrong, it is re-established next time
+        if 'imap' in clients and (failed or not keep_clients):
+            try:
+                clients['imap'].close()
+                clients['imap'].logout()
+            except:
+                pass
+            del clients['imap']
+    pipeline.print_timings()
+    if params.profile_startup:
+        _print_startup_profile()
+
+
+def _get_rate_limit():
+    """
+    Get the GitHub API rate limit, see common.get_github_rate_limit
+
+    :returns: dict or None if it cannot be requested
+    """
+    try:
+        return common.get_github_rate_limit()
+    except Exception as e:
+        print("GitHub rate limit is unknown: {}".format(e))
+        return None
+
+
+def plan_update(params):
+    """
+    Print requests an update run would make for every course without
+    grading anything (--plan). Students registered by the run itself are
+    not known yet and are not counted.
+    """
+    course_list = courses.get_courses()
+    if not course_list:
+        return _plan_course(params, params.labs)
+    for course in course_list:
+        with courses.use(course):
+            labs = [lab_id for lab_id in params.labs if lab_id in settings.os_labs]
+            if params.all_labs:
+                labs = list(settings.os_labs.keys())
+            _plan_course(params, labs)
+
+
+def _plan_course(params, labs):
+    baseline = common.request_counts(courses.current())
+    org_repos = common.get_github_repos(settings.github_organization)
+    appveyor_projects = common.get_appveyor_project_repo_names()
+    gs = google_sheets.get_spreadsheet_instance()
+    sheets = google_sheets.get_sheet_names(gs)
+    sheets = ["'{}'".format(s) for s in sheets]
+    data = google_sheets.get_multiple_sheets_data(gs, sheets)
+    labs_pending = {
+        lab_id: find_pending_repos(lab_id, data, org_repos=org_repos, verbose=False)
+        for lab_id in labs
+    }
+    rate_limit = _get_rate_limit()
+    plan = planner.make_plan(
+        labs_pending, org_repos, appveyor_projects,
+        max_requests=params.max_requests,
+        rate_limit=rate_limit if params.max_requests is not None else None,
+        baseline=baseline,
+        reserved=planner.appveyor_stage_requests(org_repos, appveyor_projects, dry_run=params.dry_run),
+    )
+    plan.print_summary(rate_limit)
+
+
+def run_courses(params, clients=None):
+    """
+    Run updates of all courses from settings.courses concurrently, see
+    courses.py. If no courses are defined, a single update is run with
+    the settings as they are.
+
+    HTTP connections and the GitHub API rate budget are shared by all
+    courses, requests of different courses are served in turn.
+
+    :param params: command line parameters, selected labs that a course
+    does not have are skipped for that course
+    :param clients: dict of clients to be kept between runs, see
+    run_update. Clients of every course are kept under the course name
+    """
+    snapshot = metrics.registry.snapshot()
+    try:
+        _run_courses(params, clients)
+    finally:
+        # metrics of the run
+        if params.metrics_file:
+            metrics.write_prometheus(params.metrics_file)
+        print("Metrics summary saved to '{}'".format(
+            metrics.write_summary(metrics.registry.summary(since=snapshot))))
+        metrics.registry.clear_timings()
+
+
+def _run_courses(params, clients=None):
+    course_list = courses.get_courses()
+    if not course_list:
+        return run_update(params, clients)
+
+    def run_course(course):
+        with courses.use(course):
+            course_params = copy.copy(params)
+            course_params.labs = [lab_id for lab_id in params.labs if lab_id in settings.os_labs]
+            if params.all_labs:
+                course_params.labs = list(settings.os_labs.keys())
+            print("Updating course '{}'...".format(course['name']))
+            course_clients = None if clients is None else clients.setdefault(course['name'], {})
+            run_update(course_params, course_clients)
+            print("Course '{}' updated".format(course['name']))
+
+    errors = []
+    # courses are updated one at a time while profiling
+    max_workers = 1 if profiling.active() else len(course_list)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_course, course): course['name'] for course in course_list}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Update of course '{}' failed: {}".format(futures[future], e))
+                errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+@contextlib.contextmanager
+def _local_workers(count):
+    """
+    Run worker processes on this host while the block is executed
+    """
+    processes = [
+        subprocess.Popen([sys.executable, os.path.realpath(__file__), '--action', 'worker',
+                          '--worker-id', str(worker_id)])
+        for worker_id in range(count)
+    ]
+    try:
+        yield
+    finally:
+        # workers finish their current jobs and exit
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def run_worker(params):
+    """
+    Evaluate repositories queued by update runs (see check_lab) until
+    interrupted or terminated
+
+    Workers may run on several hosts, every worker can use its own GitHub
+    token from settings.worker_github_tokens. Settings (courses, labs) of
+    the workers must be the same as the settings of the update run.
+
+    :param params: command line parameters
+    """
+    tokens = getattr(settings, 'worker_github_tokens', None)
+    if tokens:
+        settings.github_token = tokens[params.worker_id % len(tokens)]
+    queue = jobqueue.JobQueue()
+    worker = jobqueue.default_worker_name(params.worker_id)
+    course_list = {course['name']: course for course in courses.get_courses()}
+    stop = threading.Event()
+    # on SIGTERM the current job is finished first
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    print("Worker {} started, queue '{}'".format(worker, queue.path))
+    evaluated = 0
+    while not stop.is_set():
+        try:
+            job = queue.claim(worker)
+        except KeyboardInterrupt:
+            break
+        if job is None:
+            try:
+                stop.wait(WORKER_POLL_INTERVAL)
+            except KeyboardInterrupt:
+                break
+            continue
+        job_id, kind, payload = job
+        try:
+            if kind != 'evaluate_repo':
+                raise ValueError("Unknown job kind '{}'".format(kind))
+            if payload['course'] is None:
+                result = evaluate_repo(payload['lab_id'], payload['repo'])
+            elif payload['course'] not in course_list:
+                raise ValueError("Course '{}' is not defined in settings".format(payload['course']))
+            else:
+                with courses.use(course_list[payload['course']]):
+                    result = evaluate_repo(payload['lab_id'], payload['repo'])
+        except KeyboardInterrupt:
+            queue.release(job_id, worker)
+            break
+        except Exception as e:
+            print("Job {} ({}) failed: {}".format(job_id, payload, e))
+            queue.fail(job_id, e, worker)
+            continue
+        if not queue.complete(job_id, result, worker):
+            print("Job {} ({}) was taken over after its lease expired, result dropped".format(job_id, payload))
+            continue
+        evaluated += 1
+    print("Worker {} stopped, {} repositories evaluated".format(worker, evaluated))
+
+
+def _close_clients(clients):
+    """
+    Close connections kept between runs in daemon mode
+    """
+    for course_clients in clients.values():
+        if isinstance(course_clients, dict):
+            _close_clients(course_clients)
+    if 'imap' in clients:
         try:
-            imap_conn.close()
-            imap_conn.logout()
+            clients['imap'].close()
+            clients['imap'].logout()
         except:
             pass
+    if 'mail_queue' in clients:
+        clients['mail_queue'].close()
+    clients.clear()
+
+
+def run_daemon(params):
+    """
+    Run updates every params.interval seconds until interrupted
+
+    IMAP, SMTP and Google Sheets clients, the HTTP session and cached
+    GitHub API responses are kept warm between runs. Spreadsheet data is
+    loaded anew every run. On SIGHUP settings are reloaded and all clients
+    are reconnected before the next run.
+
+    :param params: command line parameters
+    """
+    clients = {}
+    reload_requested = threading.Event()
+    wakeup = threading.Event()
+
+    def request_reload(signum, frame):
+        reload_requested.set()
+        wakeup.set()
+
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, request_reload)
+    print("Running in daemon mode, checking for updates every {} seconds".format(params.interval))
+    try:
+        while True:
+            wakeup.clear()
+            if reload_requested.is_set():
+                reload_requested.clear()
+                print("Reloading settings...")
+                _close_clients(clients)
+                importlib.reload(settings)
+                if params.all_labs:
+                    params.labs = getattr(settings, 'os_labs', {}).keys()
+            start = time.perf_counter()
+            print("Update started at {}".format(datetime.datetime.now().isoformat()))
+            try:
+                run_courses(params, clients)
+            except Exception as e:
+                print("Update failed: {}".format(e))
+            # an update interrupted by an error is resumed by the next one
+            params.resume = not params.dry_run
+            wakeup.wait(max(0, params.interval - (time.perf_counter() - start)))
+    except KeyboardInterrupt:
+        print("Interrupted, exiting...")
+    finally:
+        _close_clients(clients)
+
+
+def main():
+    _startup_timings.append(("module imports", time.perf_counter() - _STARTUP_TIME))
+    # parse command line parameters
+    with _startup_stage("argument parsing"):
+        params = _parse_args()
+    # enable logging
+    with _startup_stage("logging setup"):
+        setup_logging(params.logging_config)
+    logger = logging.getLogger(__name__)
+    # check arguments
+    params.all_labs = params.labs == 'all' or params.labs == '*'
+    if params.all_labs:
+        params.labs = getattr(settings, 'os_labs', {}).keys()
+    if params.max_requests is not None and params.max_requests <= 0:
+        raise ValueError("--max-requests must be positive")
+    if params.metrics_port:
+        metrics.start_http_server(params.metrics_port)
+    if params.profile:
+        profiling.start(params.profile_dir, memory=params.profile_memory)
+    if params.record or params.replay:
+        if params.record and params.replay:
+            raise ValueError("--record and --replay cannot be used together")
+        if params.queue or params.workers:
+            # workers are separate processes making their own requests
+            raise ValueError("--record and --replay cannot be used with --queue or --workers")
+        if params.record:
+            cassette.start(params.record, 'record')
+        else:
+            cassette.start(params.replay, 'replay', latency_scale=params.latency_scale)
+    try:
+        if params.action in ("update", "moss"):
+            # stages of these actions are profiled separately
+            _perform_action(params)
+        else:
+            with profiling.stage(params.action):
+                _perform_action(params)
+    finally:
+        cassette.stop()
+        profiling.print_summary()
+
+
+def _perform_action(params):
+    """
+    Perform the action chosen by command line parameters
+    """
+    if params.action == "update" and params.plan:
+        plan_update(params)
+    elif params.action == "update":
+        with _local_workers(params.workers):
+            if params.daemon:
+                run_daemon(params)
+            else:
+                run_courses(params)
+    elif params.action == "worker":
+        run_worker(params)
+    elif params.action == "report":
+        gs = google_sheets.get_spreadsheet_instance()
+        datasets = []
+        spreadsheet_ids = params.spreadsheets or [settings.google_spreadsheet_id]
+        for spreadsheet_id in spreadsheet_ids:
+            sheets = google_sheets.get_sheet_names(gs, spreadsheet_id=spreadsheet_id)
+            sheets = ["'{}'".format(s) for s in sheets]
+            data = google_sheets.get_multiple_sheets_data(gs, sheets, spreadsheet_id=spreadsheet_id)
+            label = spreadsheet_id if len(spreadsheet_ids) > 1 else None
+            datasets.append((label, data, sheets[:-1]))
+        lab_ids = [int(lab_id) for lab_id in params.labs]
+        group_names, group_index, statuses = report.build_matrix(datasets, lab_ids)
+        report.print_report(group_names, lab_ids, report.compute_report(group_names, group_index, statuses))
+    elif params.action == "watch":
+        gs = google_sheets.get_spreadsheet_instance()
+        sheets = google_sheets.get_sheet_names(gs)
+        sheets = ["'{}'".format(s) for s in sheets]
+        watch_students(gs, sheets, dry_run=params.dry_run)
+    elif params.action == "recompute":
+        # recompute penalties from stored completion dates, no CI results
+        # are fetched
+        data_update = []
+        completions = penalty.load_completions()
+        gs = google_sheets.get_spreadsheet_instance()
+        sheets = google_sheets.get_sheet_names(gs)
+        sheets = ["'{}'".format(s) for s in sheets]
+        data = google_sheets.get_multiple_sheets_data(gs, sheets)
+        for lab_id in params.labs:
+            data_update = penalty.recompute_lab(lab_id, sheets[:-1], data, completions, data_update=data_update)
+        if len(data_update) > 0:
+            data_update.append({
+                'range': "'План'!B1",
+                'values': [[datetime.datetime.now().isoformat()]]
+            })
+            print(data_update)
+            if not params.dry_run:
+                updated_cells = google_sheets.batch_update(gs, data_update)
+                if updated_cells != len(data_update):
+                    raise ValueError("Number of updated cells ({}) differs from expected ({})! Check the data manually. Data update: {}".format(updated_cells, len(data_update), data_update))
+                penalty.save_completions(completions)
     elif params.action == "moss":
+        if params.profile_startup:
+            _print_startup_profile()
         # check labs
-        for lab_id in params.labs:
-            check_plagiarism(lab_id, "lab{}".format(lab_id))
+        check_plagiarism(list(params.labs), offline=params.offline, history=params.history)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,321 @@
+"""
+Counters, gauges and latency histograms of external calls.
+
+Modules record metrics with the functions of this module (HTTP requests
+are recorded by a response hook of every session made by
+common.requests_retry_session). Metrics are exported in Prometheus text
+format, to a file (e.g. for the node_exporter textfile collector) or by a
+local HTTP endpoint, and as a JSON summary of a run.
+
+    with metrics.timer('sheets_request_duration_seconds', operation='batchGet'):
+        request.execute()
+    metrics.inc('emails_sent_total')
+"""
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+import settings
+
+
+# prefix of exported metric names
+NAMESPACE = "labgrader"
+
+DEFAULT_SUMMARY_FILE = "metrics_summary.json"
+
+# upper bounds of histogram buckets, seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Registry:
+    """
+    Thread safe storage of metrics
+
+    A metric is identified by its name and a set of labels. Besides the
+    metrics, durations of individual items (e.g. repositories) are kept
+    for the JSON summary only, they would make too many Prometheus series.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> value
+        self._counters = {}
+        self._gauges = {}
+        # (name, labels) -> [bucket bounds, bucket counts, sum, count]
+        self._histograms = {}
+        # list of (kind, item, seconds)
+        self._timings = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [tuple(buckets), [0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(histogram[0], value)
+            if index < len(histogram[1]):
+                histogram[1][index] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def record_timing(self, kind, item, seconds):
+        with self._lock:
+            self._timings.append((kind, item, seconds))
+
+    def clear_timings(self):
+        """
+        Forget recorded item durations, e.g. after a run has been summarized
+        """
+        with self._lock:
+            self._timings = []
+
+    def snapshot(self):
+        """
+        Take a copy of current values, see summary
+        """
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'histograms': {key: (h[0], list(h[1]), h[2], h[3]) for key, h in self._histograms.items()},
+                'timings': len(self._timings),
+            }
+
+    def summary(self, since=None, slowest=20):
+        """
+        Summarize metrics
+
+        :param since: snapshot taken at the start of a run, only changes
+        made after it are summarized (gauges are reported as they are)
+        :param slowest: number of slowest items of every kind to include
+        :returns: JSON serializable dict
+        """
+        since = since or {'counters': {}, 'histograms': {}, 'timings': 0}
+        with self._lock:
+            counters = []
+            for (name, labels), value in sorted(self._counters.items()):
+                value -= since['counters'].get((name, labels), 0)
+                if value:
+                    counters.append({'name': name, 'labels': dict(labels), 'value': value})
+            gauges = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._gauges.items())
+            ]
+            histograms = []
+            for (name, labels), (buckets, counts, total, count) in sorted(self._histograms.items()):
+                previous = since['histograms'].get((name, labels))
+                if previous is not None:
+                    counts = [a - b for a, b in zip(counts, previous[1])]
+                    total -= previous[2]
+                    count -= previous[3]
+                if count == 0:
+                    continue
+                histograms.append({
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': count,
+                    'sum': round(total, 6),
+                    'mean': round(total / count, 6),
+                    'p50': _quantile(buckets, counts, count, 0.5),
+                    'p95': _quantile(buckets, counts, count, 0.95),
+                })
+            timings = {}
+            for kind, item, seconds in self._timings[since['timings']:]:
+                timings.setdefault(kind, []).append({'item': item, 'seconds': round(seconds, 3)})
+        for kind in timings:
+            items = timings[kind]
+            timings[kind] = {
+                'count': len(items),
+                'total_seconds': round(sum(x['seconds'] for x in items), 3),
+                'slowest': sorted(items, key=lambda x: x['seconds'], reverse=True)[:slowest],
+            }
+        return {
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': histograms,
+            'timings': timings,
+        }
+
+    def to_prometheus(self):
+        """
+        Export metrics in Prometheus text format
+
+        :returns: str
+        """
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    full_name = "{}_{}".format(NAMESPACE, name)
+                    if name not in typed:
+                        lines.append("# TYPE {} {}".format(full_name, kind))
+                        typed.add(name)
+                    lines.append("{}{} {}".format(full_name, _format_labels(labels), _format_value(value)))
+            typed = set()
+            for (name, labels), (buckets, counts, total, count) in sorted(self._histograms.items()):
+                full_name = "{}_{}".format(NAMESPACE, name)
+                if name not in typed:
+                    lines.append("# TYPE {} histogram".format(full_name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append("{}_bucket{} {}".format(
+                        full_name, _format_labels(labels + (('le', _format_value(bound)),)), cumulative))
+                lines.append("{}_bucket{} {}".format(full_name, _format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append("{}_sum{} {}".format(full_name, _format_labels(labels), _format_value(total)))
+                lines.append("{}_count{} {}".format(full_name, _format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def _quantile(buckets, counts, count, q):
+    """
+    Estimate a quantile as the upper bound of the bucket it falls into
+    """
+    cumulative = 0
+    for bound, bucket_count in zip(buckets, counts):
+        cumulative += bucket_count
+        if cumulative >= q * count:
+            return bound
+    return None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    ) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# registry used by all modules
+registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    """
+    Increase a counter
+    """
+    registry.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set a gauge to a value
+    """
+    registry.set_gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    """
+    Add a value (usually seconds) to a histogram
+    """
+    registry.observe(name, value, **labels)
+
+
+def record_timing(kind, item, seconds):
+    """
+    Record duration of an item (e.g. a repository) for the JSON summary
+    """
+    registry.record_timing(kind, item, seconds)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """
+    Context manager adding duration of the block to a histogram and
+    counting calls in a '<name without _duration_seconds>_total' counter
+    with a 'status' label: 'error' if the block raised an exception,
+    'ok' or the status set by the block otherwise
+
+    :returns: dict of labels, the block may set 'status' in it
+    """
+    start = time.perf_counter()
+    status = {}
+    try:
+        yield status
+    except BaseException:
+        status['status'] = 'error'
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+        counter = name[:-len('_duration_seconds')] if name.endswith('_duration_seconds') else name
+        inc(counter + '_total', status=status.get('status', 'ok'), **labels)
+
+
+def _write(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_prometheus(path):
+    """
+    Save metrics in Prometheus text format
+    """
+    _write(path, registry.to_prometheus())
+
+
+def write_summary(summary, path=None):
+    """
+    Save a summary returned by Registry.summary as JSON
+
+    :param path: file name, defaults to settings.metrics_summary_file
+    :returns: file name
+    """
+    path = path or getattr(settings, 'metrics_summary_file', DEFAULT_SUMMARY_FILE)
+    _write(path, json.dumps(summary, ensure_ascii=False, indent=1))
+    return path
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """
+    Serve metrics in Prometheus text format at http://host:port/metrics
+    from a background thread
+
+    :returns: http.server.ThreadingHTTPServer instance
+    """
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
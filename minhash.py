@@ -0,0 +1,191 @@
+"""
+Persistent MinHash/LSH index of submissions for cross-semester checks.
+
+Every submission is represented by the set of its winnowing fingerprints
+(see winnow.py). A MinHash signature estimates Jaccard similarity of two
+such sets, and banding of signatures (locality-sensitive hashing) finds
+submissions likely to be similar to a given one without comparing it to
+every stored submission. Signatures and band buckets are kept in a SQLite
+database, so the index grows incrementally from one run to another and
+submissions of previous years can be checked against the current ones.
+Only the candidates returned by the index need a detailed comparison.
+"""
+import array
+import random
+import sqlite3
+import hashlib
+import datetime
+
+import settings
+
+
+DEFAULT_HISTORY_DB = "moss_history.sqlite"
+DEFAULT_NUM_PERM = 128
+DEFAULT_BANDS = 32
+DEFAULT_THRESHOLD = 0.5
+
+# largest 32 bit prime, a * x mod p is computed in uint64 without overflow
+_PRIME = (1 << 32) - 5
+_MAX_HASH = _PRIME
+# same seed gives the same permutations, signatures stay comparable
+_SEED = 1
+
+
+def _band_key(rows):
+    """
+    Hash a band of signature rows into a signed 64 bit integer
+    """
+    digest = hashlib.blake2b(array.array('q', rows).tobytes(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class MinHashIndex:
+    """
+    SQLite backed MinHash/LSH index
+    """
+
+    def __init__(self, path=None, num_perm=DEFAULT_NUM_PERM, bands=DEFAULT_BANDS):
+        """
+        :param path: database file name, defaults to settings.moss_history_db
+        :param num_perm: number of hash functions of a signature
+        :param bands: number of LSH bands, num_perm must be divisible by it.
+        Pairs with Jaccard similarity above about (1/bands)^(bands/num_perm)
+        are likely to become candidates
+        """
+        if num_perm % bands != 0:
+            raise ValueError("Number of permutations ({}) is not divisible by number of bands ({})".format(num_perm, bands))
+        self.path = path or getattr(settings, 'moss_history_db', DEFAULT_HISTORY_DB)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        # random hash functions h(x) = (a * x + b) mod p
+        rnd = random.Random(_SEED)
+        self._a = [rnd.randrange(1, _PRIME) for _ in range(num_perm)]
+        self._b = [rnd.randrange(0, _PRIME) for _ in range(num_perm)]
+        self._db = sqlite3.connect(self.path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS submissions (
+                id INTEGER PRIMARY KEY,
+                lab_id TEXT NOT NULL,
+                repo TEXT NOT NULL,
+                name TEXT NOT NULL,
+                sha TEXT NOT NULL,
+                path TEXT,
+                added TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                UNIQUE (lab_id, repo, sha)
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                lab_id TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                submission_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS buckets_index ON buckets (lab_id, band, bucket);
+        """)
+
+    def signature(self, hashes):
+        """
+        Compute MinHash signature of a set of fingerprint hashes
+
+        :returns: list of num_perm integers
+        """
+        import numpy as np
+        if len(hashes) == 0:
+            return [_MAX_HASH] * self.num_perm
+        values = np.fromiter((h % _PRIME for h in hashes), dtype=np.uint64, count=len(hashes))
+        a = np.array(self._a, dtype=np.uint64)[:, np.newaxis]
+        b = np.array(self._b, dtype=np.uint64)[:, np.newaxis]
+        p = np.uint64(_PRIME)
+        return ((a * values % p + b) % p).min(axis=1).tolist()
+
+    def _band_keys(self, signature):
+        return [
+            _band_key(signature[band * self.rows:(band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+
+    def contains(self, lab_id, repo, sha):
+        """
+        Check if a submission has been added already
+        """
+        row = self._db.execute(
+            "SELECT 1 FROM submissions WHERE lab_id = ? AND repo = ? AND sha = ?",
+            (lab_id, repo, sha)
+        ).fetchone()
+        return row is not None
+
+    def add(self, lab_id, repo, name, sha, hashes, path=None):
+        """
+        Add a submission to the index (nothing is done if it has been added
+        already)
+
+        :param lab_id: lab identifier
+        :param repo: repository name, submissions of the same repository
+        are never reported as candidates of each other
+        :param name: display name of the submission
+        :param sha: blob SHA of the submitted file
+        :param hashes: fingerprint hashes of the submission
+        :param path: file name of the submission contents, used to compare
+        candidates in detail later
+        """
+        if self.contains(lab_id, repo, sha):
+            return
+        signature = self.signature(hashes)
+        cursor = self._db.execute(
+            "INSERT INTO submissions (lab_id, repo, name, sha, path, added, signature) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (lab_id, repo, name, sha, path, datetime.datetime.now().isoformat(),
+             array.array('q', signature).tobytes())
+        )
+        self._db.executemany(
+            "INSERT INTO buckets (lab_id, band, bucket, submission_id) VALUES (?, ?, ?, ?)",
+            [(lab_id, band, key, cursor.lastrowid) for band, key in enumerate(self._band_keys(signature))]
+        )
+
+    def query(self, lab_id, hashes, threshold=DEFAULT_THRESHOLD, exclude_repo=None):
+        """
+        Find stored submissions similar to a given one
+
+        :param lab_id: lab identifier
+        :param hashes: fingerprint hashes of the submission
+        :param threshold: minimal estimated Jaccard similarity
+        :param exclude_repo: skip submissions of this repository
+        :returns: list of dicts with keys 'repo', 'name', 'sha', 'path' and
+        'similarity' (estimated), most similar first
+        """
+        signature = self.signature(hashes)
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            for (submission_id,) in self._db.execute(
+                "SELECT submission_id FROM buckets WHERE lab_id = ? AND band = ? AND bucket = ?",
+                (lab_id, band, key)
+            ):
+                candidates.add(submission_id)
+        results = []
+        for submission_id in candidates:
+            repo, name, sha, path, stored = self._db.execute(
+                "SELECT repo, name, sha, path, signature FROM submissions WHERE id = ?",
+                (submission_id,)
+            ).fetchone()
+            if repo == exclude_repo:
+                continue
+            stored = array.array('q', stored)
+            similarity = sum(1 for x, y in zip(signature, stored) if x == y) / self.num_perm
+            if similarity >= threshold:
+                results.append({
+                    'repo': repo,
+                    'name': name,
+                    'sha': sha,
+                    'path': path,
+                    'similarity': similarity,
+                })
+        results.sort(key=lambda x: x['similarity'], reverse=True)
+        return results
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
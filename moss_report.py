@@ -0,0 +1,117 @@
+"""
+Resumable download of MOSS reports.
+
+A MOSS report is an index page with links to match pages, every match
+page is a frameset of three more pages (top, left and right file). All
+pages are downloaded concurrently and written to disk atomically, so an
+interrupted download can be continued later: pages that are already on
+disk are not requested again. Links are rewritten to the local copies.
+"""
+import os
+import re
+import concurrent.futures
+
+import settings
+import common
+
+
+DEFAULT_CONNECTIONS = 8
+
+LINK_FILE = "_link.txt"
+DONE_FILE = "_done"
+# report that could not be resumed, e.g. expired on MOSS server
+EXPIRED_FILE = "_expired"
+
+MATCH_RE = re.compile(r'match(\d+)\.html')
+
+
+def _save(filename, content):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_filename, filename)
+
+
+def _fetch(session, url):
+    res = session.get(url, timeout=settings.requests_timeout)
+    if res.status_code != 200:
+        raise Exception("MOSS server reported an error while trying to get '{}'! Message is '{}' ({}).".format(url, res.reason, res.status_code))
+    return res.content
+
+
+def _localize(content, url):
+    """
+    Make links to pages of the report relative
+    """
+    return content.replace(url.rstrip('/').encode('utf-8') + b'/', b'')
+
+
+def download_report(url, report_dir, connections=DEFAULT_CONNECTIONS, page_filename=None):
+    """
+    Download a MOSS report, pages downloaded by a previous (interrupted)
+    call are reused
+
+    :param url: report URL returned by MOSS server
+    :param report_dir: directory to save the report to
+    :param connections: number of concurrent downloads
+    :param page_filename: also save the original index page to this file
+    :returns: number of pages downloaded by this call
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    with open(os.path.join(report_dir, LINK_FILE), 'w') as f:
+        print(url, file=f)
+    url = url.rstrip('/')
+    session = common.get_session()
+    index_filename = os.path.join(report_dir, "index.html")
+    downloaded = 0
+    if os.path.exists(index_filename):
+        with open(index_filename, 'rb') as f:
+            index = f.read()
+    else:
+        raw_index = _fetch(session, url)
+        if page_filename is not None:
+            _save(page_filename, raw_index)
+        index = _localize(raw_index, url)
+        _save(index_filename, index)
+        downloaded += 1
+    pages = []
+    for number in sorted(set(int(n) for n in MATCH_RE.findall(index.decode('utf-8', 'replace')))):
+        for suffix in ("", "-top", "-0", "-1"):
+            pages.append("match{}{}.html".format(number, suffix))
+    missing = [page for page in pages if not os.path.exists(os.path.join(report_dir, page))]
+
+    def download(page):
+        _save(os.path.join(report_dir, page), _localize(_fetch(session, "{}/{}".format(url, page)), url))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        for _ in executor.map(download, missing):
+            downloaded += 1
+    _save(os.path.join(report_dir, DONE_FILE), b'')
+    return downloaded
+
+
+def unfinished_reports(submission_path):
+    """
+    Find reports whose download has been interrupted
+
+    :param submission_path: directory with reports of a lab
+    :returns: list of tuples (report URL, report directory)
+    """
+    reports = []
+    if not os.path.isdir(submission_path):
+        return reports
+    for name in sorted(os.listdir(submission_path)):
+        report_dir = os.path.join(submission_path, name)
+        link_filename = os.path.join(report_dir, LINK_FILE)
+        if os.path.exists(link_filename) and not os.path.exists(os.path.join(report_dir, DONE_FILE)) \
+                and not os.path.exists(os.path.join(report_dir, EXPIRED_FILE)):
+            with open(link_filename, 'r') as f:
+                reports.append((f.read().strip(), report_dir))
+    return reports
+
+
+def abandon_report(report_dir):
+    """
+    Mark an unfinished report as abandoned, it is not resumed any more
+    """
+    _save(os.path.join(report_dir, EXPIRED_FILE), b'')
@@ -0,0 +1,256 @@
+"""
+Deadline and penalty computation engine.
+
+Deadlines of a lab (one per group, read from the spreadsheet) and its
+penalty policy are compiled once into a table of numbers, which is then
+used to evaluate penalties for any number of completion timestamps.
+
+Penalty policy is set per lab in settings.os_labs[lab_id]['penalty_policy']:
+
+    'penalty_policy': {
+        'step_days': 7,       # penalty grows every started step
+        'step_penalty': 1,    # penalty points per step
+        'grace_hours': 0,     # time after deadline that is not penalized
+        'max': 10,            # maximum penalty, defaults to 'penalty_max'
+        'groups': {           # per-group overrides of any of the above,
+            "'4931'": {       # 'deadline' overrides the spreadsheet value
+                'deadline': '20.03',
+            },
+        },
+    }
+
+Completion timestamps of accepted labs are kept in a local store, so that
+penalties can be recomputed when a deadline is moved (--action recompute)
+without fetching CI results of every repository again.
+"""
+import os
+import json
+import math
+import datetime
+
+import settings
+import google_sheets
+
+
+DEFAULT_COMPLETIONS_FILE = "completions.json"
+
+DEFAULT_POLICY = {
+    'step_days': 7,
+    'step_penalty': 1,
+    'grace_hours': 0,
+}
+
+
+def parse_deadline(deadline_str, year=None):
+    """
+    Parse a deadline from the spreadsheet
+
+    :param deadline_str: deadline, either a full date/time or 'dd.mm',
+    in the latter case the deadline is at the end of that day (MSK)
+    :param year: year to be used for 'dd.mm' deadlines, defaults to current year
+    :returns: timezone aware datetime or None if deadline is not set
+    """
+    from dateutil.parser import parse
+    if deadline_str is None or deadline_str.strip() == "":
+        return None
+    if len(deadline_str.split('.')) == 2:
+        deadline_str += '.{} 23:59:59 MSK'.format(year or datetime.datetime.now().year)
+    return parse(deadline_str, dayfirst=True, tzinfos={'MSK': 3 * 3600})
+
+
+def parse_timestamp(timestamp):
+    """
+    Parse an ISO 8601 completion timestamp (as reported by GitHub)
+
+    :returns: POSIX timestamp as float
+    """
+    from dateutil.parser import isoparse
+    return isoparse(timestamp).timestamp()
+
+
+class PenaltyTable:
+    """
+    Compiled deadlines and penalty policy of a single lab
+    """
+
+    def __init__(self, lab_id, deadlines, policy):
+        """
+        :param lab_id: lab identifier
+        :param deadlines: dict with group as key and deadline datetime as value
+        :param policy: penalty policy, see module description
+        """
+        self.lab_id = lab_id
+        # group -> (penalty start, step length in seconds, points per step, maximum)
+        self._groups = {}
+        for group, deadline in deadlines.items():
+            overrides = policy.get('groups', {}).get(group, {})
+            group_policy = dict(policy)
+            group_policy.update(overrides)
+            if 'deadline' in overrides:
+                deadline = parse_deadline(overrides['deadline'])
+            if deadline is None:
+                continue
+            self._groups[group] = (
+                deadline.timestamp() + group_policy['grace_hours'] * 3600,
+                group_policy['step_days'] * 86400,
+                group_policy['step_penalty'],
+                group_policy['max'],
+            )
+
+    def deadline(self, group):
+        """
+        :returns: POSIX timestamp after which the group is penalized, None
+        if there is no deadline
+        """
+        compiled = self._groups.get(group)
+        return compiled[0] if compiled is not None else None
+
+    def evaluate(self, groups, timestamps):
+        """
+        Evaluate penalties for a vector of completion timestamps. The
+        whole vector is computed with numpy array operations if numpy is
+        installed, element by element otherwise.
+
+        :param groups: list of groups, one per timestamp
+        :param timestamps: list of completion timestamps (ISO 8601 strings,
+        datetimes or POSIX timestamps)
+        :returns: list of penalties, int unless fractional step_penalty
+        or max make them float
+        """
+        # compiled policy of the group of every timestamp, groups without a
+        # deadline are never penalized
+        no_deadline = (math.inf, 1, 0, 0)
+        compiled = [self._groups.get(group, no_deadline) for group in groups]
+        seconds = []
+        for timestamp in timestamps:
+            if isinstance(timestamp, str):
+                timestamp = parse_timestamp(timestamp)
+            elif isinstance(timestamp, datetime.datetime):
+                timestamp = timestamp.timestamp()
+            seconds.append(float(timestamp))
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is None or not seconds:
+            penalties = []
+            for (start, step, step_penalty, maximum), timestamp in zip(compiled, seconds):
+                overdue = timestamp - start
+                if overdue <= 0:
+                    penalties.append(0)
+                else:
+                    penalties.append(_number(min(math.ceil(overdue / step) * step_penalty, maximum)))
+            return penalties
+        start, step, step_penalty, maximum = (numpy.array(column, dtype=float) for column in zip(*compiled))
+        overdue = numpy.array(seconds) - start
+        penalties = numpy.minimum(numpy.ceil(numpy.maximum(overdue, 0) / step) * step_penalty, maximum)
+        return [_number(float(x)) for x in penalties]
+
+    def penalty(self, group, timestamp):
+        """
+        Evaluate penalty for a single completion timestamp, see evaluate
+        """
+        return self.evaluate([group], [timestamp])[0]
+
+
+def _number(value):
+    """
+    Round a penalty the same way in both evaluation paths, whole values
+    become int
+    """
+    value = round(value, 6)
+    return int(value) if value == int(value) else value
+
+
+def compile_lab(lab_id, groups, data):
+    """
+    Compile deadlines and penalty policy of a lab
+
+    :param lab_id: lab identifier (a key of settings.os_labs)
+    :param groups: list of groups (sheet names)
+    :param data: dict with sheet name as key and data as value
+    :returns: PenaltyTable instance
+    """
+    lab_settings = settings.os_labs[lab_id]
+    policy = dict(DEFAULT_POLICY)
+    policy['max'] = lab_settings.get('penalty_max', 0)
+    policy.update(lab_settings.get('penalty_policy', {}))
+    deadlines = {}
+    for group in groups:
+        deadlines[group] = parse_deadline(google_sheets.get_lab_deadline(data, group, int(lab_id)))
+    return PenaltyTable(lab_id, deadlines, policy)
+
+
+def format_status(base_status, penalty):
+    """
+    Append penalty to a lab status, e.g. 'v*0.85' and 2 give 'v*0.85-2'
+    """
+    if penalty > 0:
+        return "{}-{}".format(base_status, penalty)
+    return base_status
+
+
+def load_completions(path=None):
+    """
+    Load completion store
+
+    :param path: store file name, defaults to settings.completions_file
+    :returns: dict with lab id as key and dict {repo: completion} as value
+    """
+    path = path or getattr(settings, 'completions_file', DEFAULT_COMPLETIONS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_completions(completions, path=None):
+    """
+    Save completion store, see load_completions
+    """
+    path = path or getattr(settings, 'completions_file', DEFAULT_COMPLETIONS_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(completions, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def recompute_lab(lab_id, groups, data, completions, data_update=[]):
+    """
+    Recompute penalties of all accepted labs using the current deadlines
+
+    Only the statuses that were set by the grader and not changed by
+    course staff since are updated.
+
+    :param lab_id: lab identifier (a key of settings.os_labs)
+    :param groups: list of groups (sheet names)
+    :param data: dict with sheet name as key and data as value
+    :param completions: completion store, see load_completions
+    :param data_update: a list of pending data updates prepared for
+    spreadsheets.values.batchUpdate request
+    :returns: a list of pending data update requests
+    """
+    table = compile_lab(lab_id, groups, data)
+    lab_completions = completions.get(lab_id, {})
+    candidates = []
+    for repo, completion in lab_completions.items():
+        student = {'group': completion['group'], 'name': completion['name']}
+        try:
+            current_status = google_sheets.get_student_lab_status(data, student, int(lab_id))
+        except ValueError as e:
+            print(e)
+            continue
+        if current_status != completion['status']:
+            # status was changed manually, leave it as is
+            continue
+        candidates.append((repo, student, completion))
+    penalties = table.evaluate(
+        [student['group'] for _, student, _ in candidates],
+        [completion['completion_date'] for _, _, completion in candidates],
+    )
+    for (repo, student, completion), penalty in zip(candidates, penalties):
+        status = format_status(completion['base_status'], penalty)
+        if status != completion['status']:
+            google_sheets.set_student_lab_status(data, student, int(lab_id), status, data_update=data_update)
+            completion['status'] = status
+    return data_update
@@ -0,0 +1,246 @@
+"""
+API request budget of an update run (--plan, --max-requests).
+
+Before labs are graded, the number of GitHub, Travis and AppVeyor
+requests every pending repository needs is estimated from the lab
+settings (CI service, repo_requirements) and from the organization
+listing. A repository that fails early (no successful build, zero grade
+coefficient) makes fewer requests than estimated, one with more issues
+than DEFAULT_ISSUES_PER_REPO makes more.
+
+With a request cap, repositories not graded yet are preferred to the ones
+marked with '?' (re-checked every run), and recently pushed repositories
+to the others. Repositories that do not fit into the cap (or into the
+remaining GitHub rate limit) are deferred: their status is left as it is,
+so the next run picks them up. While grading, requests actually made by
+the process are counted as well, a repository is deferred if it could
+exceed the cap. Requests made by worker processes (--queue) are not seen
+by the update run, the cap relies on the estimates then.
+"""
+import datetime
+import threading
+import collections
+
+import settings
+import common
+import courses
+import metrics
+
+
+SERVICES = ('github', 'travis', 'appveyor')
+# page size of the AppVeyor project list, see common.get_appveyor_project_repo_names
+APPVEYOR_PROJECTS_PAGE_SIZE = 100
+# issues expected in a repository if the lab requires fewer
+DEFAULT_ISSUES_PER_REPO = 3
+
+
+def repo_requests(lab_id, appveyor_projects_count=0):
+    """
+    Estimate requests made to evaluate a repository of a lab, see
+    main.evaluate_repo
+
+    :param lab_id: lab identifier (a key of settings.os_labs)
+    :param appveyor_projects_count: number of AppVeyor projects, the
+    project list is requested for every repository of lab 3
+    :returns: collections.Counter with service as key
+    """
+    requests = collections.Counter()
+    requirements = settings.os_labs[lab_id].get('repo_requirements', {})
+    if 'commit' in requirements:
+        requests['github'] += 1
+    if 'issue' in requirements:
+        issues = max(int(requirements['issue'].get('min_quantity', 0)), DEFAULT_ISSUES_PER_REPO)
+        # issue list, referenced events of every issue and linked commits
+        per_issue = 2 if 'linked_commit_msg_part' in requirements['issue'] else 1
+        requests['github'] += 1 + issues * per_issue
+    if int(lab_id) == 3:
+        # commit status, project list pages, latest build and its log
+        requests['github'] += 1
+        requests['appveyor'] += appveyor_projects_count // APPVEYOR_PROJECTS_PAGE_SIZE + 1 + 2
+    else:
+        # check runs (requested once, see common.get_travis_log), build and its log
+        requests['github'] += 1
+        requests['travis'] += 2
+    return requests
+
+
+def appveyor_stage_requests(org_repos, appveyor_projects, dry_run=False):
+    """
+    Estimate requests made to add new lab 3 repositories to AppVeyor, see
+    main.create_appveyor_projects
+
+    :returns: collections.Counter with service as key
+    """
+    if dry_run:
+        return collections.Counter()
+    new_projects = [
+        x for x in org_repos
+        if x['name'].startswith('os-task3') and not x['private'] and x['full_name'] not in appveyor_projects
+    ]
+    # project is added and its build is triggered
+    return collections.Counter(appveyor=2 * len(new_projects))
+
+
+class Plan:
+    """
+    Repositories selected to be graded by a run within its request cap
+    """
+
+    def __init__(self, max_requests=None, baseline=None):
+        """
+        :param max_requests: cap on requests of the run, None for no cap
+        :param baseline: common.request_counts of the course at the start
+        of the run
+        """
+        self.max_requests = max_requests
+        self.course = courses.current()
+        self.baseline = baseline or collections.Counter()
+        # lab_id -> list of tuples (repo, requests Counter), in priority order
+        self.selected = collections.OrderedDict()
+        # lab_id -> list of repos
+        self.deferred = collections.OrderedDict()
+        # requests made before grading and reserved for other stages
+        self.spent = collections.Counter()
+        self.reserved = collections.Counter()
+        self._costs = {}
+        self._acquired = 0
+        self._lock = threading.Lock()
+
+    def requests_made(self):
+        """
+        :returns: collections.Counter of requests made by the run so far
+        """
+        made = common.request_counts(self.course)
+        made.subtract(self.baseline)
+        return +made
+
+    def estimated(self):
+        """
+        :returns: collections.Counter of requests the run is expected to make
+        """
+        total = self.spent + self.reserved
+        for repos in self.selected.values():
+            for _, cost in repos:
+                total += cost
+        return total
+
+    def select(self, lab_id, pending):
+        """
+        Restrict repositories of a lab to the selected ones
+
+        :param pending: list of tuples whose first item is a repository name
+        :returns: selected items of pending in priority order
+        """
+        if lab_id not in self.selected:
+            return pending
+        order = {repo: i for i, (repo, _) in enumerate(self.selected[lab_id])}
+        selected = sorted((x for x in pending if x[0] in order), key=lambda x: order[x[0]])
+        deferred = len(pending) - len(selected)
+        if deferred:
+            print("Lab {}: {} repositories deferred to the next run (request budget)".format(lab_id, deferred))
+            metrics.inc('repos_deferred_total', deferred, lab=lab_id)
+        return selected
+
+    def acquire(self, lab_id, repo):
+        """
+        Check that a repository can be evaluated within the cap, counting
+        requests actually made so far. Should be called right before the
+        evaluation.
+
+        :returns: True if the repository may be evaluated, False if it is
+        deferred to the next run
+        """
+        if self.max_requests is None:
+            return True
+        cost = sum(self._costs.get((lab_id, repo), repo_requests(lab_id)).values())
+        with self._lock:
+            committed = sum((self.spent + self.reserved).values()) + self._acquired
+            made = sum(self.requests_made().values())
+            if max(committed, made) + cost > self.max_requests:
+                print("Repository '{}' deferred to the next run: {} of {} requests used".format(
+                    repo, max(committed, made), self.max_requests))
+                metrics.inc('repos_deferred_total', lab=lab_id)
+                return False
+            self._acquired += cost
+        return True
+
+    def print_summary(self, rate_limit=None):
+        """
+        Print estimated requests of every lab and of the whole run
+
+        :param rate_limit: dict returned by common.get_github_rate_limit
+        """
+        print("Request plan{}:".format(
+            "" if self.course is None else " of course '{}'".format(self.course)))
+        print("  listings: {}".format(_format_requests(self.spent)))
+        if +self.reserved:
+            print("  AppVeyor projects: {}".format(_format_requests(self.reserved)))
+        for lab_id, repos in self.selected.items():
+            lab_requests = sum((cost for _, cost in repos), collections.Counter())
+            print("  lab {}: {} repositories, {}{}".format(
+                lab_id, len(repos), _format_requests(lab_requests),
+                ", {} deferred".format(len(self.deferred[lab_id])) if self.deferred[lab_id] else ""))
+        total = self.estimated()
+        print("  total: {} requests ({}){}".format(
+            sum(total.values()), _format_requests(total),
+            "" if self.max_requests is None else ", cap {}".format(self.max_requests)))
+        if rate_limit is not None:
+            reset = datetime.datetime.fromtimestamp(rate_limit['reset']).strftime("%H:%M:%S")
+            print("  GitHub rate limit: {} of {} remaining, resets at {}".format(
+                rate_limit['remaining'], rate_limit['limit'], reset))
+            if total['github'] > rate_limit['remaining']:
+                print("  Estimated GitHub requests exceed the remaining rate limit, "
+                      "the run would wait for the reset. Use --max-requests to defer repositories.")
+        deferred = sum(len(repos) for repos in self.deferred.values())
+        if deferred:
+            print("  {} repositories deferred to the next run".format(deferred))
+
+
+def _format_requests(requests):
+    return ", ".join("{} {}".format(service, requests[service]) for service in SERVICES if requests[service]) or "none"
+
+
+def make_plan(labs_pending, org_repos, appveyor_projects, max_requests=None, rate_limit=None, baseline=None,
+              reserved=None):
+    """
+    Select repositories to be graded by a run
+
+    :param labs_pending: dict lab_id -> list of tuples (repo, student,
+    current status), see main.find_pending_repos
+    :param org_repos: repositories of the organization as returned by
+    common.get_github_repos, their push dates set priorities
+    :param appveyor_projects: repository names of AppVeyor projects
+    :param max_requests: cap on requests of the run, None for no cap
+    :param rate_limit: dict returned by common.get_github_rate_limit, GitHub
+    requests are also limited by the remaining rate limit if set
+    :param baseline: common.request_counts of the course at the start of
+    the run, requests made since then (listings) are counted as spent
+    :param reserved: collections.Counter of requests other stages are
+    going to make, see appveyor_stage_requests
+    :returns: Plan instance
+    """
+    plan = Plan(max_requests, baseline)
+    plan.spent = plan.requests_made()
+    plan.reserved = reserved or collections.Counter()
+    pushed_at = {x['full_name']: x.get('pushed_at') or '' for x in org_repos}
+    candidates = []
+    for lab_id, pending in labs_pending.items():
+        plan.selected[lab_id] = []
+        plan.deferred[lab_id] = []
+        cost = repo_requests(lab_id, len(appveyor_projects))
+        for repo, _, status in pending:
+            candidates.append((lab_id, repo, status, cost))
+    # recently pushed first, then repositories never graded before the
+    # ones marked with '?' (sorts are stable)
+    candidates.sort(key=lambda x: pushed_at.get(x[1], ''), reverse=True)
+    candidates.sort(key=lambda x: x[2] is not None)
+    total = plan.spent + plan.reserved
+    for lab_id, repo, status, cost in candidates:
+        plan._costs[(lab_id, repo)] = cost
+        if max_requests is not None and sum(total.values()) + sum(cost.values()) > max_requests \
+                or rate_limit is not None and total['github'] + cost['github'] > rate_limit['remaining']:
+            plan.deferred[lab_id].append(repo)
+            continue
+        plan.selected[lab_id].append((repo, cost))
+        total += cost
+    return plan
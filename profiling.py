@@ -0,0 +1,206 @@
+"""
+Profiling of run stages (--profile).
+
+Every stage (mailbox processing, sheet load, grading of a lab, MOSS
+steps, ...) is run under cProfile and a sampling profiler:
+
+* ``<stage>.pstats`` - cProfile statistics of the stage thread, see
+  ``python -m pstats``, snakeviz etc.;
+* ``<stage>.folded`` - call stacks of the stage thread and of the threads
+  it has started, sampled every few milliseconds, in the collapsed format
+  of flamegraph.pl (also accepted by speedscope);
+* peak memory allocated by the stage, if tracemalloc is enabled.
+
+Stages are meant to be profiled one at a time (callers run them serially
+while profiling), otherwise their numbers would mix.
+"""
+import os
+import re
+import sys
+import time
+import cProfile
+import pstats
+import threading
+import contextlib
+import collections
+
+
+DEFAULT_PROFILE_DIR = "profile"
+# seconds between stack samples
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# profiler of the process, None if profiling is not enabled
+_profiler = None
+
+
+class _Sampler(threading.Thread):
+    """
+    Thread sampling call stacks of other threads
+    """
+
+    def __init__(self, interval, exclude):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        # ids of threads not to be sampled
+        self.exclude = exclude
+        self.stacks = collections.Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident or thread_id in self.exclude:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Profiler:
+    """
+    Profiles stages and keeps their results
+    """
+
+    def __init__(self, output_dir=DEFAULT_PROFILE_DIR, memory=False, interval=DEFAULT_SAMPLE_INTERVAL):
+        """
+        :param output_dir: directory for profile files
+        :param memory: trace memory allocations to find peak memory of
+        every stage (slows the run down considerably)
+        :param interval: seconds between stack samples
+        """
+        self.output_dir = output_dir
+        self.memory = memory
+        self.interval = interval
+        # list of dicts with keys 'stage', 'seconds', 'peak_memory', 'files', 'top'
+        self.results = []
+        self._names = collections.Counter()
+        self._lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+        if memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    def _file_base(self, name):
+        name = re.sub(r'[^\w.-]+', '_', name).strip('_') or 'stage'
+        with self._lock:
+            self._names[name] += 1
+            count = self._names[name]
+        if count > 1:
+            # e.g. the same stage of the next daemon run
+            name = "{}.{}".format(name, count)
+        return os.path.join(self.output_dir, name)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager profiling a stage
+        """
+        file_base = self._file_base(name)
+        current = threading.current_thread()
+        # only the stage thread and the threads it starts are sampled
+        sampler = _Sampler(self.interval, set(t.ident for t in threading.enumerate() if t is not current))
+        memory_start = None
+        if self.memory:
+            import tracemalloc
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        sampler.start()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start
+            sampler.stop()
+            peak_memory = None
+            if memory_start is not None:
+                import tracemalloc
+                peak_memory = tracemalloc.get_traced_memory()[1] - memory_start
+            profile.dump_stats(file_base + ".pstats")
+            with open(file_base + ".folded", 'w', encoding='utf-8') as f:
+                for stack, count in sorted(sampler.stacks.items()):
+                    print("{} {}".format(stack, count), file=f)
+            with self._lock:
+                self.results.append({
+                    'stage': name,
+                    'seconds': seconds,
+                    'peak_memory': peak_memory,
+                    'files': (file_base + ".pstats", file_base + ".folded"),
+                    'top': _top_functions(file_base + ".pstats"),
+                })
+
+    def print_summary(self):
+        """
+        Print time and peak memory of every profiled stage together with
+        the functions that took most of its time
+        """
+        print("Profile (saved to '{}'):".format(self.output_dir))
+        for result in self.results:
+            memory = "" if result['peak_memory'] is None else ", peak memory {:.1f} MiB".format(
+                result['peak_memory'] / 2 ** 20)
+            print("  {}: {:.2f}s{}".format(result['stage'], result['seconds'], memory))
+            for function, own_time in result['top']:
+                print("      {:8.3f}s  {}".format(own_time, function))
+
+
+def _top_functions(filename, limit=5):
+    """
+    Find functions that took the most time themselves (not counting
+    functions they called)
+
+    :returns: list of tuples (function description, seconds)
+    """
+    stats = pstats.Stats(filename)
+    top = [
+        ("{} ({}:{})".format(function, os.path.basename(path), line), own_time)
+        for (path, line, function), (_, _, own_time, _, _) in stats.stats.items()
+        if own_time >= 0.001
+    ]
+    top.sort(key=lambda x: x[1], reverse=True)
+    return top[:limit]
+
+
+def start(output_dir=DEFAULT_PROFILE_DIR, memory=False):
+    """
+    Enable profiling of stages for the rest of the process
+    """
+    global _profiler
+    _profiler = Profiler(output_dir, memory=memory)
+
+
+def active():
+    """
+    :returns: True if profiling is enabled
+    """
+    return _profiler is not None
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Context manager profiling a stage if profiling is enabled
+    """
+    if _profiler is None:
+        yield
+        return
+    with _profiler.stage(name):
+        yield
+
+
+def print_summary():
+    """
+    Print summary of profiled stages, if profiling is enabled
+    """
+    if _profiler is not None:
+        _profiler.print_summary()
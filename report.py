@@ -0,0 +1,158 @@
+"""
+Grade statistics and progress report across all groups.
+
+Sheet data (as returned by google_sheets.get_multiple_sheets_data) is
+loaded into a students x labs matrix of status strings. Statuses have very
+few distinct values, so they are dictionary-encoded: every distinct status
+is parsed once and the parsed values are broadcast back to the matrix,
+all aggregates are computed with array operations.
+"""
+import re
+
+import google_sheets
+
+
+# status categories
+STATUS_EMPTY = 0
+STATUS_ACCEPTED = 1
+STATUS_PENDING = 2
+STATUS_WRONG_TASKID = 3
+STATUS_OTHER = 4
+
+# e.g. "v", "v-2", "v*0.85-2", "?v*0.3"
+STATUS_RE = re.compile(r'^(?P<pending>\?)?v(?:\*(?P<coefficient>\d+(?:\.\d+)?))?(?:-(?P<penalty>\d+))?$')
+
+# aggregate tables in the order they are printed
+REPORT_TABLES = [
+    ('completion', "Completion rate, %"),
+    ('accepted', "Accepted"),
+    ('pending', "Pending (?)"),
+    ('wrong_taskid', "Wrong TASKID"),
+    ('overdue', "Overdue (accepted with penalty)"),
+    ('mean_penalty', "Mean penalty of accepted"),
+    ('mean_coefficient', "Mean grade coefficient of accepted"),
+]
+
+
+def parse_status(status):
+    """
+    Parse a single lab status string
+
+    :param status: lab status as stored in the spreadsheet
+    :returns: tuple (category, grade coefficient, penalty)
+    """
+    status = status.strip()
+    if status == "":
+        return STATUS_EMPTY, 0.0, 0
+    if "Wrong TASKID" in status:
+        return STATUS_WRONG_TASKID, 0.0, 0
+    match = STATUS_RE.match(status)
+    if match is None:
+        return STATUS_OTHER, 0.0, 0
+    coefficient = float(match.group('coefficient') or 1)
+    penalty = int(match.group('penalty') or 0)
+    if match.group('pending'):
+        return STATUS_PENDING, coefficient, penalty
+    return STATUS_ACCEPTED, coefficient, penalty
+
+
+def build_matrix(datasets, lab_ids):
+    """
+    Build a students x labs matrix of lab statuses
+
+    :param datasets: list of (label, data, groups) tuples, where data is a
+    dict with sheet name as key and data as value, groups is a list of
+    sheet names with student lists; label is prepended to group names,
+    so that several spreadsheets (courses, semesters) can be combined
+    :param lab_ids: list of integer lab identifiers
+    :returns: tuple (list of group names, array of group indices for each
+    student, 2D array of status strings)
+    """
+    import numpy as np
+    group_names = []
+    group_index = []
+    rows = []
+    for label, data, groups in datasets:
+        for group in groups:
+            columns = data.get(group) or []
+            if len(columns) <= google_sheets.STUDENT_NAME_COLUMN:
+                continue
+            names = columns[google_sheets.STUDENT_NAME_COLUMN]
+            lab_columns = []
+            for lab_id in lab_ids:
+                lab_column = google_sheets.LAB_COLUMN_OFFSET + lab_id
+                lab_columns.append(columns[lab_column] if lab_column < len(columns) else [])
+            group_names.append("{} {}".format(label, group) if label else group)
+            # row 0 is a header
+            for position in range(1, len(names)):
+                if names[position].strip() == "":
+                    continue
+                group_index.append(len(group_names) - 1)
+                rows.append([c[position] if position < len(c) else "" for c in lab_columns])
+    statuses = np.array(rows, dtype=str).reshape(len(rows), len(lab_ids))
+    return group_names, np.array(group_index, dtype=np.intp), statuses
+
+
+def parse_matrix(statuses):
+    """
+    Parse a matrix of lab statuses
+
+    :param statuses: 2D array of status strings
+    :returns: tuple of 2D arrays (categories, grade coefficients, penalties)
+    """
+    import numpy as np
+    unique, inverse = np.unique(statuses, return_inverse=True)
+    parsed = [parse_status(str(status)) for status in unique]
+    categories = np.array([p[0] for p in parsed], dtype=np.int8)
+    coefficients = np.array([p[1] for p in parsed], dtype=float)
+    penalties = np.array([p[2] for p in parsed], dtype=float)
+    inverse = inverse.reshape(statuses.shape)
+    return categories[inverse], coefficients[inverse], penalties[inverse]
+
+
+def compute_report(group_names, group_index, statuses):
+    """
+    Compute aggregate tables per group and lab
+
+    :param group_names: list of group names
+    :param group_index: array of group indices for each student
+    :param statuses: 2D students x labs array of status strings
+    :returns: dict with table name as key and 2D groups x labs array as
+    value, the last row of each table is a total over all groups
+    """
+    import numpy as np
+    categories, coefficients, penalties = parse_matrix(statuses)
+    # groups x students one-hot matrix, the last row selects all students
+    membership = np.zeros((len(group_names) + 1, len(group_index)))
+    membership[group_index, np.arange(len(group_index))] = 1
+    membership[-1, :] = 1
+    accepted = categories == STATUS_ACCEPTED
+    enrolled = membership.sum(axis=1)[:, np.newaxis]
+    accepted_count = membership @ accepted
+    with np.errstate(divide='ignore', invalid='ignore'):
+        report = {
+            'completion': np.where(enrolled > 0, 100 * accepted_count / enrolled, 0),
+            'accepted': accepted_count,
+            'pending': membership @ (categories == STATUS_PENDING),
+            'wrong_taskid': membership @ (categories == STATUS_WRONG_TASKID),
+            'overdue': membership @ (accepted & (penalties > 0)),
+            'mean_penalty': np.where(
+                accepted_count > 0, (membership @ (penalties * accepted)) / accepted_count, np.nan),
+            'mean_coefficient': np.where(
+                accepted_count > 0, (membership @ (coefficients * accepted)) / accepted_count, np.nan),
+        }
+    return report
+
+
+def print_report(group_names, lab_ids, report):
+    """
+    Print aggregate tables to console
+    """
+    row_names = list(group_names) + ["Total"]
+    name_width = max(len(name) for name in row_names)
+    for table, title in REPORT_TABLES:
+        print(title)
+        print("{:<{}} ".format("Group", name_width) + "".join("{:>9}".format("Lab " + str(l)) for l in lab_ids))
+        for name, row in zip(row_names, report[table]):
+            print("{:<{}} ".format(name, name_width) + "".join("{:>9.4g}".format(v) for v in row))
+        print("")
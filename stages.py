@@ -0,0 +1,150 @@
+"""
+Minimal executor of a DAG of stages.
+
+A stage is a function with a name and a list of names of the stages it
+depends on. Results of those stages are passed to the function as keyword
+arguments, its return value is the result of the stage. Stages are started
+as soon as all their dependencies are finished, independent stages run
+concurrently in a thread pool.
+
+    pipeline = stages.Pipeline()
+    pipeline.add('repos', lambda: list_repos())
+    pipeline.add('data', lambda: load_sheets())
+    pipeline.add('grade', lambda repos, data: grade(repos, data), requires=['repos', 'data'])
+    results = pipeline.run()
+    pipeline.print_timings()
+"""
+import time
+import contextvars
+import concurrent.futures
+
+
+class Stage:
+    def __init__(self, name, func, requires):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        # seconds since the start of the pipeline
+        self.started = None
+        self.finished = None
+
+
+class Pipeline:
+    """
+    DAG of stages executed with maximal overlap
+    """
+
+    def __init__(self, max_workers=None, around_stage=None):
+        """
+        :param max_workers: max number of concurrently running stages,
+        defaults to the number of stages
+        :param around_stage: function of stage name returning a context
+        manager every stage is run in (e.g. profiling.stage)
+        """
+        self.max_workers = max_workers
+        self.around_stage = around_stage
+        self._stages = {}
+        self._order = []
+
+    def add(self, name, func, requires=()):
+        """
+        Add a stage
+
+        :param name: stage name, also the keyword argument name its result
+        is passed with to the dependent stages
+        :param func: function accepting results of the required stages as
+        keyword arguments
+        :param requires: names of the stages that must be finished first
+        """
+        if name in self._stages:
+            raise ValueError("Stage '{}' is already defined".format(name))
+        for required in requires:
+            if required not in self._stages:
+                raise ValueError("Stage '{}' requires unknown stage '{}'".format(name, required))
+        self._stages[name] = Stage(name, func, requires)
+        self._order.append(name)
+
+    def run(self):
+        """
+        Execute all stages
+
+        If a stage fails, no more stages are started, the running ones are
+        waited for and the exception is raised.
+
+        :returns: dict with stage name as key and stage result as value
+        """
+        results = {}
+        pending = list(self._order)
+        running = {}
+        start = time.perf_counter()
+        error = None
+
+        def execute(stage, kwargs):
+            stage.started = time.perf_counter() - start
+            try:
+                if self.around_stage is None:
+                    return stage.func(**kwargs)
+                with self.around_stage(stage.name):
+                    return stage.func(**kwargs)
+            finally:
+                stage.finished = time.perf_counter() - start
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers or len(self._order) or 1) as executor:
+            while pending or running:
+                if error is None:
+                    for name in list(pending):
+                        stage = self._stages[name]
+                        if all(required in results for required in stage.requires):
+                            pending.remove(name)
+                            kwargs = {required: results[required] for required in stage.requires}
+                            # stages see context variables (e.g. current
+                            # course) of the caller
+                            context = contextvars.copy_context()
+                            running[executor.submit(context.run, execute, stage, kwargs)] = name
+                elif not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        print("Stage '{}' failed: {}".format(name, e))
+                        if error is None:
+                            error = e
+        if error is not None:
+            raise error
+        return results
+
+    def critical_path(self):
+        """
+        Find the chain of dependent stages that determined the total time
+
+        :returns: list of stage names
+        """
+        finished = [s for s in self._stages.values() if s.finished is not None]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda s: s.finished)
+        path = [stage.name]
+        while stage.requires:
+            stage = max((self._stages[name] for name in stage.requires), key=lambda s: s.finished or 0)
+            path.append(stage.name)
+        return path[::-1]
+
+    def print_timings(self):
+        """
+        Print start time and duration of every stage
+        """
+        print("Stage timings:")
+        total = 0.0
+        for name in self._order:
+            stage = self._stages[name]
+            if stage.finished is None:
+                print("  {:<32} {:>8}".format(name, "skipped"))
+                continue
+            total = max(total, stage.finished)
+            print("  {:<32} {:>7.2f}s  (started at {:.2f}s)".format(
+                name, stage.finished - stage.started, stage.started))
+        print("  {:<32} {:>7.2f}s".format("total", total))
+        print("Critical path: {}".format(" -> ".join(self.critical_path())))
@@ -0,0 +1,313 @@
+"""
+Concurrent download of student submissions from GitHub.
+
+Every repository is fetched once as a tarball of its default branch. The
+archive is read as a stream and only the requested files are extracted,
+so there is a single request per repository instead of one request per
+file plus one more for the latest commit date. Files are written into
+the ``<local_path>/<org>/<repo>/<file>`` layout used by check_plagiarism.
+
+Downloaded files are kept in a content-addressed store (by git blob SHA)
+and a manifest of every run is saved. Repositories that have not been
+pushed to since the previous run are not downloaded again, their files
+are hard-linked from the store. Exact duplicates among submissions are
+found by comparing blob SHAs.
+"""
+import os
+import json
+import shutil
+import hashlib
+import tarfile
+import threading
+import datetime
+import collections
+import concurrent.futures
+
+import settings
+import common
+
+
+GITHUB_TARBALL_API_URL = "https://api.github.com/repos/{}/tarball"
+
+DEFAULT_CONNECTIONS = 8
+
+STORE_OBJECTS_DIR = ".objects"
+STORE_MANIFESTS_DIR = ".manifests"
+LATEST_MANIFEST = "latest.json"
+
+
+def parse_pushed_at(pushed_at):
+    """
+    Parse repository 'pushed_at' timestamp as reported by GitHub
+
+    :returns: timezone aware datetime or None
+    """
+    if pushed_at is None:
+        return None
+    return datetime.datetime.fromisoformat(pushed_at.replace("Z", "+00:00"))
+
+
+def github_get_files(repo, filenames):
+    """
+    Get several files from a GitHub repository with a single request
+
+    :param repo: repository name (with organization/owner prefix)
+    :param filenames: paths of the files to be retrieved
+    :returns: dict with file path as key and file contents (bytes) as
+    value, files missing in the repository are not included
+    """
+    status_headers = {
+        "User-Agent": "GitHubGetFiles/1.0",
+        "Authorization": "token " + settings.github_token,
+    }
+    res = common.get_session().get(
+        GITHUB_TARBALL_API_URL.format(repo),
+        headers=status_headers,
+        timeout=settings.requests_timeout,
+        stream=True
+    )
+    if res.status_code != 200:
+        raise Exception("GitHub API reported an error while trying to get files from repository '{}'! Message is '{}' ({}).".format(repo, res.reason, res.status_code))
+    wanted = set(filenames)
+    files = {}
+    with res, tarfile.open(fileobj=res.raw, mode='r|gz') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            # archive root is a single '<owner>-<repo>-<sha>' directory
+            path = member.name.split('/', 1)[-1]
+            if path in wanted:
+                files[path] = archive.extractfile(member).read()
+                if len(files) == len(wanted):
+                    # do not download the rest of the archive
+                    break
+    return files
+
+
+def git_blob_sha(data):
+    """
+    Compute git blob SHA of file contents (same as `git hash-object`)
+    """
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class SubmissionStore:
+    """
+    Content-addressed store of downloaded files with per-run manifests
+
+    A manifest is a dict with repository name as key and dict with keys
+    'pushed_at' (ISO 8601 string), 'files' (dict with file path as key and
+    blob SHA as value) and 'missing' (list of paths) as value.
+    """
+
+    def __init__(self, local_path):
+        """
+        :param local_path: lab directory, the store is kept in its hidden
+        subdirectories
+        """
+        self.objects_path = os.path.join(local_path, STORE_OBJECTS_DIR)
+        self.manifests_path = os.path.join(local_path, STORE_MANIFESTS_DIR)
+
+    def object_path(self, sha):
+        return os.path.join(self.objects_path, sha[:2], sha[2:])
+
+    def has(self, sha):
+        return os.path.exists(self.object_path(sha))
+
+    def add(self, data):
+        """
+        Put file contents into the store
+
+        :returns: blob SHA of the contents
+        """
+        sha = git_blob_sha(data)
+        object_path = self.object_path(sha)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(object_path, threading.get_ident())
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, object_path)
+        return sha
+
+    def link(self, sha, local_filename):
+        """
+        Make a file with the contents of a stored object, hard links are
+        used where possible
+        """
+        os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+        if os.path.lexists(local_filename):
+            if os.path.samefile(local_filename, self.object_path(sha)):
+                return
+            os.remove(local_filename)
+        try:
+            os.link(self.object_path(sha), local_filename)
+        except OSError:
+            shutil.copyfile(self.object_path(sha), local_filename)
+
+    def load_manifest(self, name=LATEST_MANIFEST):
+        """
+        Load manifest of a run (the latest one by default)
+
+        :returns: manifest dict, empty if there is no such manifest
+        """
+        path = os.path.join(self.manifests_path, name)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest, run_id=None):
+        """
+        Save manifest of a run, it also becomes the latest manifest
+
+        :param run_id: run identifier, defaults to current date and time
+        """
+        run_id = run_id or "{:%Y-%m-%d_%H%M%S}".format(datetime.datetime.now())
+        os.makedirs(self.manifests_path, exist_ok=True)
+        for name in ("{}.json".format(run_id), LATEST_MANIFEST):
+            path = os.path.join(self.manifests_path, name)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, path)
+
+
+def _local_filename(local_path, repo, filename):
+    return os.path.join(local_path, *repo.split('/'), *filename.split('/'))
+
+
+def _save_files(repo, files, local_path, store=None):
+    """
+    Write downloaded files of a repository to disk
+
+    :returns: dict with file path as key and tuple (local file name,
+    blob SHA) as value
+    """
+    local_files = {}
+    for filename, file_contents in files.items():
+        local_filename = _local_filename(local_path, repo, filename)
+        if store is not None:
+            sha = store.add(file_contents)
+            store.link(sha, local_filename)
+        else:
+            sha = git_blob_sha(file_contents)
+            os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+            with open(local_filename, "wb") as f:
+                f.write(file_contents)
+        local_files[filename] = (local_filename, sha)
+    return local_files
+
+
+def _reuse_files(repo, filenames, pushed_at, local_path, store, previous):
+    """
+    Take files of a repository from the store if the repository has not
+    been pushed to since the previous run
+
+    :returns: same as _save_files or None if the files have to be downloaded
+    """
+    entry = previous.get(repo)
+    if store is None or entry is None or pushed_at is None or entry.get('pushed_at') != pushed_at.isoformat():
+        return None
+    if any(f not in entry['files'] and f not in entry['missing'] for f in filenames):
+        return None
+    local_files = {}
+    for filename in filenames:
+        sha = entry['files'].get(filename)
+        if sha is None:
+            continue
+        if not store.has(sha):
+            return None
+        local_files[filename] = (_local_filename(local_path, repo, filename), sha)
+    for local_filename, sha in local_files.values():
+        store.link(sha, local_filename)
+    return local_files
+
+
+def download_repos(repos, filenames, local_path, connections=DEFAULT_CONNECTIONS, store=None, previous=None):
+    """
+    Download files from a number of GitHub repositories concurrently
+
+    :param repos: list of repositories, either names (with organization/owner
+    prefix) or dicts as returned by common.get_github_repos. In the latter
+    case 'pushed_at' of the listing is reused, otherwise it is requested
+    :param filenames: paths of the files to be downloaded from every
+    repository, or dict with repository name as key and list of paths as
+    value to download different files from different repositories
+    :param local_path: directory to save files to
+    :param connections: number of concurrent downloads
+    :param store: SubmissionStore instance, files are saved to it if set
+    :param previous: manifest of the previous run (see SubmissionStore),
+    repositories not pushed to since then are taken from the store
+    :returns: list of dicts (in the order of repos) with keys 'repo',
+    'pushed_at' (datetime), 'files' (dict with file path as key and local
+    file name as value), 'shas' (dict with file path as key and blob SHA as
+    value), 'missing' (list of paths not found in the repository) and
+    'reused' (True if nothing was downloaded)
+    """
+    previous = previous or {}
+
+    def download(repo):
+        if isinstance(repo, str):
+            repo_name, pushed_at = repo, None
+        else:
+            repo_name, pushed_at = repo['full_name'], parse_pushed_at(repo.get('pushed_at'))
+        repo_filenames = filenames[repo_name] if isinstance(filenames, dict) else filenames
+        if pushed_at is None:
+            pushed_at = common.github_get_latest_commit_date(repo_name)
+        local_files = _reuse_files(repo_name, repo_filenames, pushed_at, local_path, store, previous)
+        reused = local_files is not None
+        if not reused:
+            files = github_get_files(repo_name, repo_filenames)
+            local_files = _save_files(repo_name, files, local_path, store)
+        return {
+            'repo': repo_name,
+            'pushed_at': pushed_at,
+            'files': {f: local_filename for f, (local_filename, _) in local_files.items()},
+            'shas': {f: sha for f, (_, sha) in local_files.items()},
+            'missing': [f for f in repo_filenames if f not in local_files],
+            'reused': reused,
+        }
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        for result in executor.map(download, repos):
+            for filename in result['missing']:
+                print("File '{}' not found in GitHub repo '{}'".format(filename, result['repo']))
+            results.append(result)
+    return results
+
+
+def make_manifest(results, manifest=None):
+    """
+    Make a manifest of downloaded repositories, see SubmissionStore
+
+    :param results: list returned by download_repos
+    :param manifest: manifest to be updated, a new one is made if None
+    :returns: manifest dict
+    """
+    manifest = {} if manifest is None else manifest
+    for result in results:
+        manifest[result['repo']] = {
+            'pushed_at': result['pushed_at'].isoformat(),
+            'files': result['shas'],
+            'missing': result['missing'],
+        }
+    return manifest
+
+
+def find_duplicates(results, key=None):
+    """
+    Find files with the same contents in different repositories
+
+    :param results: list returned by download_repos
+    :param key: function of (repo, file path) returning a key of file
+    contents, defaults to blob SHA (exact duplicates)
+    :returns: dict with key as key and list of (repo, file path) with
+    that key as value, only keys found more than once are included
+    """
+    owners = collections.OrderedDict()
+    for result in results:
+        for filename, sha in result['shas'].items():
+            owners.setdefault(sha if key is None else key(result['repo'], filename), []).append((result['repo'], filename))
+    return collections.OrderedDict((sha, files) for sha, files in owners.items() if len(files) > 1)
@@ -0,0 +1,137 @@
+"""
+Mailbox watcher for near-real-time student registration.
+
+Holds a single authenticated IMAP connection in IDLE state on INBOX and
+runs a processing callback as soon as the server reports new messages.
+The connection is re-established automatically if it is lost. Servers
+that do not support IDLE are polled instead.
+"""
+import time
+import select
+import imaplib
+
+import settings
+import mailbox
+
+
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes
+DEFAULT_IDLE_TIMEOUT = 10 * 60
+DEFAULT_RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 300
+
+
+def _wait_readable(imap_conn, timeout):
+    """
+    Wait until the server sends something or timeout expires
+
+    :returns: True if there is data to read
+    """
+    sock = imap_conn.sock
+    # data may already be decrypted and buffered by the SSL layer
+    if getattr(sock, 'pending', None) is not None and sock.pending() > 0:
+        return True
+    readable, _, _ = select.select([sock], [], [], timeout)
+    return len(readable) > 0
+
+
+def idle(imap_conn, timeout):
+    """
+    Wait for mailbox changes with IMAP IDLE command
+
+    :param imap_conn: connection object with a selected mailbox
+    :param timeout: max number of seconds to wait
+    :returns: True if the server reported new messages, False on timeout
+    :raises imaplib.IMAP4.abort: if connection was lost
+    """
+    tag = imap_conn._new_tag()
+    imap_conn.send(tag + b' IDLE\r\n')
+    line = imap_conn.readline()
+    if not line.startswith(b'+'):
+        raise imaplib.IMAP4.error("IDLE command failed: {}".format(line))
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not _wait_readable(imap_conn, remaining):
+            break
+        line = imap_conn.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed by server during IDLE")
+        if line.startswith(b'*') and (b'EXISTS' in line or b'RECENT' in line):
+            changed = True
+    imap_conn.send(b'DONE\r\n')
+    # read untagged responses up to the IDLE completion
+    while True:
+        line = imap_conn.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed by server during IDLE")
+        if line.startswith(tag):
+            if b' OK' not in line:
+                raise imaplib.IMAP4.error("IDLE command failed: {}".format(line))
+            break
+        if b'EXISTS' in line or b'RECENT' in line:
+            changed = True
+    return changed
+
+
+def watch(process, connect=None, idle_timeout=None, reconnect_delay=DEFAULT_RECONNECT_DELAY, cycles=None):
+    """
+    Watch INBOX and process new messages as soon as they arrive
+
+    :param process: callback accepting an IMAP connection, called once
+    after connecting and then every time the mailbox changes (or idle
+    timeout expires)
+    :param connect: function establishing an authenticated IMAP connection,
+    defaults to mailbox.get_imap_connection
+    :param idle_timeout: max number of seconds to stay in IDLE, defaults to
+    settings.mail_idle_timeout
+    :param reconnect_delay: initial delay before reconnecting, doubled
+    after every consecutive failure
+    :param cycles: stop after this many processing cycles (None - never stop)
+    """
+    if connect is None:
+        def connect():
+            return mailbox.get_imap_connection(exit_on_failure=False)
+    if idle_timeout is None:
+        idle_timeout = getattr(settings, 'mail_idle_timeout', DEFAULT_IDLE_TIMEOUT)
+    delay = reconnect_delay
+    processed = 0
+    while cycles is None or processed < cycles:
+        imap_conn = None
+        try:
+            imap_conn = connect()
+            supports_idle = 'IDLE' in imap_conn.capabilities
+            delay = reconnect_delay
+            while cycles is None or processed < cycles:
+                try:
+                    process(imap_conn)
+                finally:
+                    # a failed cycle counts too, so that cycles is not exceeded
+                    processed += 1
+                if cycles is not None and processed >= cycles:
+                    break
+                rv, data = imap_conn.select("INBOX")
+                if rv != 'OK':
+                    raise imaplib.IMAP4.error("Unable to open mailbox: {}".format(data))
+                if supports_idle:
+                    if idle(imap_conn, idle_timeout):
+                        print("New messages in mailbox")
+                else:
+                    time.sleep(idle_timeout)
+                    imap_conn.noop()
+        except (imaplib.IMAP4.error, OSError) as e:
+            print("Mailbox connection error: {}. Reconnecting in {} s...".format(e, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        except Exception as e:
+            # e.g. a Google Sheets error, process() leaves the new messages
+            # unprocessed and they are read again after the delay
+            print("Error while processing mailbox: {}. Retrying in {} s...".format(e, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        finally:
+            if imap_conn is not None:
+                try:
+                    imap_conn.logout()
+                except (imaplib.IMAP4.error, OSError):
+                    pass
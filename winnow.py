@@ -0,0 +1,368 @@
+"""
+Local plagiarism detection with document fingerprinting (winnowing).
+
+Implements the algorithm used by MOSS (Schleimer, Wilkerson, Aiken,
+"Winnowing: Local Algorithms for Document Fingerprinting", 2003):
+
+* source code is tokenized, whitespace and comments are dropped, names of
+  variables, literals and numbers are replaced by generic tokens, so that
+  renaming or reformatting does not hide a copy;
+* hashes of all k-grams of tokens are computed;
+* in every window of w consecutive hashes the minimal one is selected
+  (winnowing), selected hashes form the fingerprint of a file;
+* fingerprints of basefiles (code given to all students) and fingerprints
+  found in too many submissions are ignored;
+* two files are similar if they share fingerprints.
+
+Works offline and needs no third party packages. Results can be converted
+to mossum result sets to draw the same graphs as for MOSS reports.
+"""
+import re
+import zlib
+import hashlib
+import itertools
+import collections
+
+
+# noise threshold: matches shorter than k tokens are ignored
+DEFAULT_K = 5
+# guarantee threshold is w + k - 1 tokens
+DEFAULT_WINDOW = 4
+
+_HASH_BASE = 257
+_HASH_MOD = (1 << 61) - 1
+
+C_KEYWORDS = frozenset("""
+    auto break case char const continue default do double else enum extern
+    float for goto if inline int long register restrict return short signed
+    sizeof static struct switch typedef union unsigned void volatile while
+    bool true false nullptr class namespace template typename public private
+    protected virtual override new delete this throw try catch using operator
+    friend explicit mutable constexpr static_cast dynamic_cast const_cast
+    reinterpret_cast std include define ifdef ifndef endif pragma
+""".split())
+
+SHELL_KEYWORDS = frozenset("""
+    if then else elif fi case esac for while until do done in function select
+    time return exit break continue local export readonly declare shift set
+    unset read echo printf test let eval exec source trap wait
+""".split())
+
+C_TOKEN_RE = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+    |(?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+    |(?P<number>(?:0[xX][0-9a-fA-F]+|\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+)[uUlLfF]*)
+    |(?P<name>[A-Za-z_]\w*)
+    |(?P<operator>->|\+\+|--|<<=|>>=|<<|>>|<=|>=|==|!=|&&|\|\||::|[-+*/%&|^!~<>=?:;,.(){}\[\]#])
+    |(?P<space>\s+)
+    |(?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+SHELL_TOKEN_RE = re.compile(r"""
+    (?P<comment>\#[^\n]*)
+    |(?P<string>'[^']*'|"(?:\\.|[^"\\])*")
+    |(?P<variable>\$\{[^}]*\}|\$\w+|\$[#?@*!$-]|\w+(?==))
+    |(?P<number>\d+\b)
+    |(?P<name>[\w./-]+)
+    |(?P<operator>\|\||&&|;;|>>|<<|[|&;<>()\[\]{}=`!])
+    |(?P<space>\s+)
+    |(?P<other>.)
+""", re.VERBOSE)
+
+# file extension -> language
+EXTENSIONS = {
+    '.sh': 'sh', '.bash': 'sh',
+    '.c': 'c', '.h': 'c',
+    '.cpp': 'cc', '.cc': 'cc', '.cxx': 'cc', '.hpp': 'cc', '.hh': 'cc',
+}
+
+
+def detect_language(filename, language=None):
+    """
+    Choose tokenizer for a file
+
+    :param filename: file name, its extension takes precedence
+    :param language: MOSS language name from lab settings (e.g. 'c', 'cc')
+    :returns: 'sh' or 'c'
+    """
+    extension = '.' + filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    language = EXTENSIONS.get(extension, language)
+    return 'sh' if language in ('sh', 'bash', 'shell') else 'c'
+
+
+def tokenize(text, language='c', normalize_names=True, normalize_literals=True):
+    """
+    Split source code into normalized tokens
+
+    :param text: source code
+    :param language: 'c' (C and C++) or 'sh' (shell scripts)
+    :param normalize_names: replace identifiers (C) and variable names
+    (shell) with a generic token
+    :param normalize_literals: replace string and number literals with
+    generic tokens
+    :returns: list of tuples (token, line number), line numbers start at 1
+    """
+    shell = language == 'sh'
+    token_re = SHELL_TOKEN_RE if shell else C_TOKEN_RE
+    keywords = SHELL_KEYWORDS if shell else C_KEYWORDS
+    tokens = []
+    line = 1
+    for match in token_re.finditer(text):
+        kind = match.lastgroup
+        value = match.group()
+        if kind in ('comment', 'space'):
+            pass
+        elif kind == 'name':
+            # in shell scripts command names and arguments matter, in C
+            # only keywords do
+            keep = shell or value in keywords or not normalize_names
+            tokens.append((value if keep else 'N', line))
+        elif kind == 'variable':
+            tokens.append(('V' if normalize_names else value, line))
+        elif kind == 'string':
+            tokens.append(('S' if normalize_literals else value, line))
+        elif kind == 'number':
+            tokens.append(('0' if normalize_literals else value, line))
+        else:
+            tokens.append((value, line))
+        line += value.count('\n')
+    return tokens
+
+
+def normalized_hash(text, language='c', normalize_names=False):
+    """
+    Hash source code ignoring comments and whitespace
+
+    Files that differ only in formatting and comments (and names, if
+    normalize_names is set) get the same hash. Literal values are kept,
+    submissions of different variants differ in them.
+
+    :returns: hex digest
+    """
+    tokens = tokenize(text, language, normalize_names, normalize_literals=False)
+    return hashlib.sha1("\0".join(token for token, _ in tokens).encode('utf-8')).hexdigest()
+
+
+def kgram_hashes(tokens, k=DEFAULT_K):
+    """
+    Compute hashes of all k-grams of tokens with a rolling hash
+
+    Hashes do not depend on the Python hash seed, so they can be stored
+    and compared between runs.
+
+    :param tokens: list of tuples (token, line number)
+    :returns: list of tuples (hash, line number of the first token)
+    """
+    if len(tokens) < k:
+        return []
+    values = [zlib.crc32(token.encode('utf-8')) + 1 for token, _ in tokens]
+    top = pow(_HASH_BASE, k - 1, _HASH_MOD)
+    h = 0
+    for value in values[:k]:
+        h = (h * _HASH_BASE + value) % _HASH_MOD
+    hashes = [(h, tokens[0][1])]
+    for i in range(k, len(values)):
+        h = ((h - values[i - k] * top) * _HASH_BASE + values[i]) % _HASH_MOD
+        hashes.append((h, tokens[i - k + 1][1]))
+    return hashes
+
+
+def winnow(hashes, window=DEFAULT_WINDOW):
+    """
+    Select fingerprints from k-gram hashes (robust winnowing)
+
+    :param hashes: list of tuples (hash, line number)
+    :param window: window size
+    :returns: list of selected tuples (hash, line number)
+    """
+    if len(hashes) <= window:
+        return [min(hashes, key=lambda x: x[0])] if hashes else []
+    selected = []
+    min_index = -1
+    for start in range(len(hashes) - window + 1):
+        if min_index < start:
+            # previous minimum left the window, find the rightmost minimum
+            min_index = start
+            for i in range(start + 1, start + window):
+                if hashes[i][0] <= hashes[min_index][0]:
+                    min_index = i
+            selected.append(hashes[min_index])
+        elif hashes[start + window - 1][0] < hashes[min_index][0]:
+            # a new hash equal to the minimum does not replace it
+            min_index = start + window - 1
+            selected.append(hashes[min_index])
+    return selected
+
+
+class Fingerprint:
+    """
+    Fingerprint of a single submission
+    """
+
+    def __init__(self, name, hashes):
+        """
+        :param name: display name of the submission
+        :param hashes: dict with hash as key and set of line numbers as value
+        """
+        self.name = name
+        self.hashes = hashes
+
+    @classmethod
+    def from_text(cls, name, text, language='c', k=DEFAULT_K, window=DEFAULT_WINDOW):
+        hashes = collections.defaultdict(set)
+        for h, line in winnow(kgram_hashes(tokenize(text, language), k), window):
+            hashes[h].add(line)
+        return cls(name, dict(hashes))
+
+    @classmethod
+    def from_file(cls, name, filename, language=None, k=DEFAULT_K, window=DEFAULT_WINDOW):
+        with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        return cls.from_text(name, text, detect_language(filename, language), k, window)
+
+    def subtract(self, hashes):
+        """
+        Drop fingerprints that are in a given set of hashes
+        """
+        self.hashes = {h: lines for h, lines in self.hashes.items() if h not in hashes}
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class Match:
+    """
+    Similarity of a pair of submissions
+    """
+
+    def __init__(self, first, second, shared, first_percent, second_percent, first_lines, second_lines,
+                 first_index=None, second_index=None):
+        self.first = first
+        self.second = second
+        # positions of the submissions in the list passed to compare,
+        # display names of several files of one repository are the same
+        self.first_index = first_index
+        self.second_index = second_index
+        # number of shared fingerprints
+        self.shared = shared
+        self.first_percent = first_percent
+        self.second_percent = second_percent
+        # number of lines covered by shared fingerprints
+        self.first_lines = first_lines
+        self.second_lines = second_lines
+
+    @property
+    def percent(self):
+        return max(self.first_percent, self.second_percent)
+
+    @property
+    def lines(self):
+        return max(self.first_lines, self.second_lines)
+
+    def __repr__(self):
+        return "Match({!r} {}%, {!r} {}%, {} lines)".format(
+            self.first, self.first_percent, self.second, self.second_percent, self.lines)
+
+
+def compare(fingerprints, basefiles=(), max_matches=None, min_shared=1):
+    """
+    Compare fingerprints of all submissions pairwise
+
+    An inverted index (hash -> submissions) is used, so only pairs of
+    submissions that share at least one fingerprint are considered.
+
+    :param fingerprints: list of Fingerprint instances
+    :param basefiles: list of Fingerprint instances of basefiles, their
+    hashes are ignored
+    :param max_matches: fingerprints found in more than this number of
+    submissions are ignored (same as MOSS -m option)
+    :param min_shared: minimal number of shared fingerprints of a match
+    :returns: list of Match instances sorted by similarity (descending)
+    """
+    ignored = set()
+    for basefile in basefiles:
+        ignored.update(basefile.hashes)
+    for fingerprint in fingerprints:
+        fingerprint.subtract(ignored)
+    index = collections.defaultdict(list)
+    for i, fingerprint in enumerate(fingerprints):
+        for h in fingerprint.hashes:
+            index[h].append(i)
+    shared = collections.defaultdict(list)
+    for h, owners in index.items():
+        if len(owners) < 2 or (max_matches and len(owners) > max_matches):
+            continue
+        for pair in itertools.combinations(owners, 2):
+            shared[pair].append(h)
+    matches = []
+    for (i, j), hashes in shared.items():
+        if len(hashes) < min_shared:
+            continue
+        first, second = fingerprints[i], fingerprints[j]
+        matches.append(Match(
+            first.name,
+            second.name,
+            len(hashes),
+            round(100 * len(hashes) / len(first)),
+            round(100 * len(hashes) / len(second)),
+            len(set().union(*(first.hashes[h] for h in hashes))),
+            len(set().union(*(second.hashes[h] for h in hashes))),
+            first_index=i,
+            second_index=j,
+        ))
+    matches.sort(key=lambda m: (m.percent, m.lines), reverse=True)
+    return matches
+
+
+def similarity_matrix(fingerprints, matches):
+    """
+    Build a matrix of pairwise similarities
+
+    :param fingerprints: list of Fingerprint instances passed to compare
+    :param matches: list of Match instances returned by compare
+    :returns: tuple (names, matrix), matrix[i][j] is the percentage of
+    submission i found in submission j
+    """
+    names = [fingerprint.name for fingerprint in fingerprints]
+    matrix = [[0] * len(names) for _ in names]
+    for i in range(len(names)):
+        matrix[i][i] = 100
+    for match in matches:
+        i, j = match.first_index, match.second_index
+        matrix[i][j] = match.first_percent
+        matrix[j][i] = match.second_percent
+    return names, matrix
+
+
+def save_matrix(filename, names, matrix):
+    """
+    Save similarity matrix as CSV
+    """
+    import csv
+    with open(filename, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow([''] + names)
+        for name, row in zip(names, matrix):
+            writer.writerow([name] + row)
+
+
+def to_mossum_results(name, matches, url=None):
+    """
+    Convert matches to a mossum result set, so that mossum.merge_results
+    and mossum.image can be used as for MOSS reports
+
+    :param name: name of the result set
+    :param matches: list of Match instances
+    :param url: report location shown by mossum
+    :returns: mossum.Results instance
+    """
+    from mossum import mossum
+    return mossum.Results(name, [
+        mossum.Match(
+            mossum.File(match.first, match.first_percent),
+            mossum.File(match.second, match.second_percent),
+            match.lines,
+            url,
+        )
+        for match in matches
+    ])